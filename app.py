@@ -1,29 +1,50 @@
 import os
+import atexit
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
 import json
 import requests
+import requests.adapters
 import uuid
 import threading
+import time
+import queue
 import pytz
 import re
-from psycopg2.extras import Json, RealDictCursor
-from flask import Flask, request, session, redirect, url_for, render_template, flash, jsonify, g
+import tempfile
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from flask import Flask, Request, request, session, redirect, url_for, render_template, flash, jsonify, g, Response, stream_with_context, get_template_attribute
 from functools import wraps
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import traceback
 import pandas as pd
-import matplotlib
-matplotlib.use('Agg') # Use a non-interactive backend
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import numpy as np
-from google.cloud import storage
 from werkzeug.utils import secure_filename
-import io
 import base64
+import hashlib
 from markdown_it import MarkdownIt
+from job_store import create_job_store
+from charts import ChartCache, ChartRenderer, render_calorie_chart, render_value_chart
+from gcs_storage import GCS_PARALLEL_UPLOAD_THRESHOLD, StorageService
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from image_derivatives import DerivativeWorker, build_srcsets, delete_derivatives, load_derivatives, trim_for_display
+from editorjs import SNQL_REF_PATTERN, RenderedNoteCache, extract_references, render_note_html
+from note_links import find_link_targets, update_note_links
+from notes_tree import (NotesTreeCache, bump_notes_tree_version, build_sidebar_tree, get_folder_deletion_stats,
+                        get_folder_descendant_ids, get_folder_path, get_notes_tree_version, load_tree_levels)
+from search import SEARCH_CONFIG, HEADLINE_OPTIONS, build_prefix_tsquery, escape_like, render_headline
+
+class UploadRequest(Request):
+    """Spools large uploads to a named temp file, so they can be sent to GCS in parallel parts by path."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length >= GCS_PARALLEL_UPLOAD_THRESHOLD:
+            return tempfile.NamedTemporaryFile("wb+")
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # --- Configuration and Secrets ---
 app.secret_key = os.environ.get("SECRET_KEY")
@@ -41,29 +62,621 @@ GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON")
 
 if not ORACLE_API_ENDPOINT_URL:
     print("[WARNING] ORACLE_API_ENDPOINT_URL not set. Oracle Chat functionality will be significantly impaired or disabled.")
-if not GCS_BUCKET_NAME or not GOOGLE_CREDENTIALS_JSON:
+
+# --- Cloud Storage ---
+# One lazily created client per worker process (STORAGE_EMULATOR_HOST points it at a local emulator).
+storage_service = StorageService(GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON)
+MAX_SIGNED_URL_BATCH = 200
+
+# Browser-direct uploads: the page asks for a resumable session URL, PUTs the
+# file straight to GCS and then calls the finalize endpoint, so no worker
+# handles the file body. Needs a CORS rule on the bucket for this site's origin.
+FILES_DIRECT_UPLOAD = os.environ.get("FILES_DIRECT_UPLOAD", "0") == "1"
+UPLOAD_SESSION_MAX_AGE = 7 * 24 * 3600 # GCS resumable sessions last a week
+upload_tokens = URLSafeTimedSerializer(app.secret_key, salt="files-direct-upload")
+if not storage_service.configured:
     print("[WARNING] GCS environment variables not set. Image uploads will not work.")
 
-# --- In-memory store for background job status ---
-oracle_jobs = {}
+# --- Store for background Oracle job status ---
+# 'postgres' (default) and 'sqlite' are shared between gunicorn workers; 'memory' is per-process.
+ORACLE_JOB_STORE = os.environ.get("ORACLE_JOB_STORE", "postgres")
+ORACLE_JOB_STORE_PATH = os.environ.get("ORACLE_JOB_STORE_PATH", "/tmp/byzantium_oracle_jobs.sqlite3")
+ORACLE_JOB_TTL_SECONDS = int(os.environ.get("ORACLE_JOB_TTL_SECONDS", "3600"))
+ORACLE_JOB_MAX_JOBS = int(os.environ.get("ORACLE_JOB_MAX_JOBS", "1000"))
 
 # --- Markdown Renderer ---
-md = MarkdownIt()
+# Raw HTML in Markdown is escaped rather than passed through.
+md = MarkdownIt('commonmark', {'html': False})
+
+# --- Rendered Note Cache ---
+# Server-rendered note HTML for read-only views, exports and api_render_markdown.
+RENDERED_NOTE_CACHE_MAX_CHARS = int(os.environ.get("RENDERED_NOTE_CACHE_MAX_CHARS", str(16 * 1024 * 1024)))
+rendered_note_cache = RenderedNoteCache(RENDERED_NOTE_CACHE_MAX_CHARS)
+
+# --- Chart Cache ---
+# Rendered chart PNGs, keyed by a fingerprint of the rows they were drawn from.
+CHART_CACHE_MAX_BYTES = int(os.environ.get("CHART_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+chart_cache = ChartCache(CHART_CACHE_MAX_BYTES)
+
+# Charts render in separate processes; a render that cannot start or finish in
+# time is answered with a placeholder image instead of stalling the request.
+CHART_RENDER_WORKERS = int(os.environ.get("CHART_RENDER_WORKERS", "1"))
+CHART_RENDER_MAX_PENDING = int(os.environ.get("CHART_RENDER_MAX_PENDING", "4"))
+CHART_RENDER_TIMEOUT = float(os.environ.get("CHART_RENDER_TIMEOUT", "15"))
+chart_renderer = ChartRenderer(CHART_RENDER_WORKERS, CHART_RENDER_MAX_PENDING, CHART_RENDER_TIMEOUT)
+atexit.register(chart_renderer.shutdown)
+
+# --- Database Connection Pool ---
+# Sized per gunicorn worker process; gunicorn.conf.py defaults the maximum to
+# the number of worker threads (plus one for the activity log writer).
+DB_POOL_MIN_CONN = int(os.environ.get("DB_POOL_MIN_CONN", "1"))
+DB_POOL_MAX_CONN = int(os.environ.get("DB_POOL_MAX_CONN", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))
+
+class DatabasePoolTimeout(Exception):
+    pass
+
+class DatabasePool:
+    """
+    A thread-safe pool of psycopg2 connections shared by every request handled
+    in this process. Connections that have been idle for longer than the
+    health-check interval are pinged before being handed out, and broken or
+    expired connections are replaced transparently.
+    """
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_interval, max_lifetime):
+        self.dsn = dsn
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.max_lifetime = max_lifetime
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._created_at = {}  # id(connection) -> monotonic creation time
+        self._checked_out = 0
+        self._waiting = 0
+        self._closed = False
+        self._counters = {"created": 0, "recycled": 0, "checkouts": 0, "timeouts": 0, "healthcheck_failures": 0}
+
+        for _ in range(min(self.minconn, self.maxconn)):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self._counters["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, conn, last_used):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        created_at = self._created_at.get(id(conn), now)
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if now - last_used > self.healthcheck_interval:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                with self._cond:
+                    self._counters["healthcheck_failures"] += 1
+                return False
+        return True
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._checked_out < self.maxconn:
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise DatabasePoolTimeout(f"No database connection available after {self.timeout}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._checked_out += 1
+            self._counters["checkouts"] += 1
+
+        # Connecting and health-checking happen outside the lock so a slow
+        # handshake does not stall other threads returning connections.
+        try:
+            if conn is not None and not self._is_usable(conn, last_used):
+                self._close(conn)
+                with self._cond:
+                    self._counters["recycled"] += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        keep = not discard and not conn.closed and not self._closed
+        if keep and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Never hand the next request a connection with an open or failed transaction.
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        if not keep:
+            self._close(conn)
+        with self._cond:
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            elif not self._closed:
+                self._counters["recycled"] += 1
+            self._checked_out -= 1
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "checked_out": self._checked_out,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "max_connections": self.maxconn,
+                **self._counters,
+            }
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """
+    Returns this process's connection pool, creating it on first use.
+    The pool is keyed by PID so gunicorn workers forked from a preloaded
+    master never share sockets with their parent.
+    """
+    global _db_pool, _db_pool_pid
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        return _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            db_url = os.environ.get("DATABASE_URL")
+            if not db_url:
+                raise Exception("DATABASE_URL is not set")
+            _db_pool = DatabasePool(
+                db_url,
+                minconn=DB_POOL_MIN_CONN,
+                maxconn=DB_POOL_MAX_CONN,
+                timeout=DB_POOL_TIMEOUT,
+                healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+            )
+            _db_pool_pid = os.getpid()
+    return _db_pool
+
+@atexit.register
+def close_db_pool():
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        _db_pool.closeall()
+
+oracle_jobs = create_job_store(
+    ORACLE_JOB_STORE,
+    ttl_seconds=ORACLE_JOB_TTL_SECONDS,
+    max_jobs=ORACLE_JOB_MAX_JOBS,
+    sqlite_path=ORACLE_JOB_STORE_PATH,
+    getconn=lambda: get_db_pool().getconn(),
+    putconn=lambda conn: get_db_pool().putconn(conn),
+)
+
+# --- Oracle API Client ---
+ORACLE_MAX_CONCURRENCY = int(os.environ.get("ORACLE_MAX_CONCURRENCY", "4"))
+ORACLE_MAX_QUEUED = int(os.environ.get("ORACLE_MAX_QUEUED", "16"))
+ORACLE_REQUEST_TIMEOUT = float(os.environ.get("ORACLE_REQUEST_TIMEOUT", "300"))
+# How often a streaming reply's partial text is written to the job store, and how
+# often a stream re-reads the store for jobs owned by another worker process.
+ORACLE_STREAM_PUBLISH_INTERVAL = float(os.environ.get("ORACLE_STREAM_PUBLISH_INTERVAL", "0.25"))
+ORACLE_STREAM_POLL_INTERVAL = float(os.environ.get("ORACLE_STREAM_POLL_INTERVAL", "1.0"))
+# How often a running job re-reads the job store for a cancel handled by another worker process.
+ORACLE_CANCEL_CHECK_INTERVAL = float(os.environ.get("ORACLE_CANCEL_CHECK_INTERVAL", "2.0"))
+# Reply streams open at once per worker process. Each holds a worker thread
+# until its reply finishes (up to ORACLE_REQUEST_TIMEOUT), so this must stay
+# below the thread count (gunicorn.conf.py sets it to half); beyond it the
+# chat page polls the status endpoint instead.
+ORACLE_MAX_STREAMS = int(os.environ.get("ORACLE_MAX_STREAMS", "2"))
+
+_oracle_session = None
+_oracle_session_pid = None
+_oracle_session_lock = threading.Lock()
+
+def get_oracle_session():
+    """
+    Returns a process-wide requests.Session so calls to ORACLE_API_ENDPOINT_URL
+    reuse kept-alive connections instead of paying a TLS handshake each time.
+    """
+    global _oracle_session, _oracle_session_pid
+    if _oracle_session is not None and _oracle_session_pid == os.getpid():
+        return _oracle_session
+    with _oracle_session_lock:
+        if _oracle_session is None or _oracle_session_pid != os.getpid():
+            session_ = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=ORACLE_MAX_CONCURRENCY + 2)
+            session_.mount("https://", adapter)
+            session_.mount("http://", adapter)
+            _oracle_session = session_
+            _oracle_session_pid = os.getpid()
+    return _oracle_session
+
+class OracleExecutor:
+    """
+    Runs Oracle queries on a fixed set of worker threads fed by a bounded
+    queue. When every worker is busy and the queue is full, submit() refuses
+    the job so the caller can answer 429 instead of spawning more threads.
+    """
+    def __init__(self, max_workers, max_queued):
+        self.max_workers = max(1, max_workers)
+        self.max_queued = max(0, max_queued)
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self._cancel_events = {}  # job_id -> threading.Event, for queued and running jobs
+        self._running = 0
+        self._counters = {"submitted": 0, "rejected": 0, "completed": 0, "cancelled": 0}
+
+    def _ensure_started_locked(self):
+        # Worker threads do not survive a fork, so each gunicorn worker starts its own.
+        if self._queue is not None and self._pid == os.getpid():
+            return
+        # Queue.put_nowait treats maxsize 0 as unbounded, so always allow at least one waiting job.
+        self._queue = queue.Queue(maxsize=max(1, self.max_queued))
+        self._cancel_events = {}
+        self._running = 0
+        self._pid = os.getpid()
+        for i in range(self.max_workers):
+            threading.Thread(target=self._worker, name=f"oracle-worker-{i}", daemon=True).start()
+
+    def submit(self, job_id, fn, *args):
+        """Queues fn(job_id, *args, cancel_event). Returns False if the executor is full."""
+        cancel_event = threading.Event()
+        with self._lock:
+            self._ensure_started_locked()
+            try:
+                self._queue.put_nowait((job_id, fn, args, cancel_event))
+            except queue.Full:
+                self._counters["rejected"] += 1
+                return False
+            self._cancel_events[job_id] = cancel_event
+            self._counters["submitted"] += 1
+        return True
+
+    def cancel(self, job_id):
+        """Flags a queued or running job as cancelled. Returns False if this worker does not own it."""
+        with self._lock:
+            cancel_event = self._cancel_events.get(job_id)
+            if cancel_event is None or cancel_event.is_set():
+                return False
+            cancel_event.set()
+            self._counters["cancelled"] += 1
+        return True
+
+    def _worker(self):
+        while True:
+            job_id, fn, args, cancel_event = self._queue.get()
+            with self._lock:
+                if cancel_event.is_set():
+                    self._cancel_events.pop(job_id, None)
+                    continue
+                self._running += 1
+            try:
+                fn(job_id, *args, cancel_event)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._cancel_events.pop(job_id, None)
+                    self._counters["completed"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._running,
+                "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "max_workers": self.max_workers,
+                "max_queued": self.max_queued,
+                **self._counters,
+            }
+
+oracle_executor = OracleExecutor(ORACLE_MAX_CONCURRENCY, ORACLE_MAX_QUEUED)
+
+class JobNotifier:
+    """
+    Wakes threads waiting on a job as soon as a worker in this process updates
+    it. Waiters on jobs owned by another process simply time out and re-read
+    the shared job store. Every update, including the final one, bumps the
+    job's version; versions are dropped by discard() once a stream is done
+    with the job, or after ttl_seconds without an update.
+    """
+    def __init__(self, ttl_seconds=300):
+        self.ttl_seconds = ttl_seconds
+        self._cond = threading.Condition()
+        self._versions = {}  # job_id -> (version, last updated)
+
+    def _version_locked(self, job_id):
+        return self._versions.get(job_id, (0, None))[0]
+
+    def notify(self, job_id, finished=False):
+        with self._cond:
+            now = time.monotonic()
+            self._versions[job_id] = (self._version_locked(job_id) + 1, now)
+            if finished:
+                # Finishing jobs are rare enough to sweep out versions no stream came back for.
+                stale = [other for other, (_, updated) in self._versions.items() if now - updated > self.ttl_seconds]
+                for other in stale:
+                    del self._versions[other]
+            self._cond.notify_all()
+
+    def discard(self, job_id):
+        with self._cond:
+            self._versions.pop(job_id, None)
+
+    def wait(self, job_id, seen_version, timeout):
+        """Blocks until the job changes or the timeout passes, returning the latest version seen."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version_locked(job_id) != seen_version, timeout)
+            return self._version_locked(job_id)
+
+oracle_job_notifier = JobNotifier(ttl_seconds=ORACLE_REQUEST_TIMEOUT + 60)
+
+class StreamSlots:
+    """Counts the reply streams open in this process, refusing new ones beyond max_streams."""
+    def __init__(self, max_streams):
+        self.max_streams = max(0, max_streams)
+        self._lock = threading.Lock()
+        self._open = 0
+        self._counters = {"opened": 0, "rejected": 0}
+
+    def acquire(self):
+        with self._lock:
+            if self._open >= self.max_streams:
+                self._counters["rejected"] += 1
+                return False
+            self._open += 1
+            self._counters["opened"] += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._open -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"open": self._open, "max_streams": self.max_streams, **self._counters}
+
+oracle_stream_slots = StreamSlots(ORACLE_MAX_STREAMS)
+
+def publish_oracle_job(job_id, status, reply=None, only_if_not_in=()):
+    """Updates the job and wakes local waiters. Returns False if the job was gone or its status was in only_if_not_in."""
+    updated = oracle_jobs.update(job_id, status, reply, only_if_not_in=only_if_not_in)
+    oracle_job_notifier.notify(job_id, finished=status in ('complete', 'error', 'cancelled'))
+    return updated
 
 # --- Database Helper ---
 def get_db():
     if 'db' not in g:
-        db_url = os.environ.get("DATABASE_URL")
-        if not db_url:
-            raise Exception("DATABASE_URL is not set")
-        g.db = psycopg2.connect(db_url)
+        g.db = get_db_pool().getconn()
     return g.db
 
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_db_pool().putconn(db)
+
+# --- Activity Log Writer ---
+# Activity events are buffered in-process and written to activity_log in
+# batches by a background thread, so requests never wait on the INSERT.
+ACTIVITY_LOG_QUEUE_SIZE = int(os.environ.get("ACTIVITY_LOG_QUEUE_SIZE", "10000"))
+ACTIVITY_LOG_BATCH_SIZE = int(os.environ.get("ACTIVITY_LOG_BATCH_SIZE", "200"))
+ACTIVITY_LOG_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_LOG_FLUSH_INTERVAL", "2.0"))
+# What to do when the queue is full: 'drop_oldest', 'drop_newest' or 'block'
+# (block waits up to ACTIVITY_LOG_BLOCK_TIMEOUT seconds, then drops the event).
+ACTIVITY_LOG_OVERFLOW_POLICY = os.environ.get("ACTIVITY_LOG_OVERFLOW_POLICY", "drop_oldest")
+ACTIVITY_LOG_BLOCK_TIMEOUT = float(os.environ.get("ACTIVITY_LOG_BLOCK_TIMEOUT", "0.1"))
+
+class ActivityLogWriter:
+    """
+    Bounded queue plus a background thread that flushes activity events in
+    multi-row INSERTs whenever a batch fills up or the flush interval elapses.
+    """
+    INSERT_SQL = """
+        INSERT INTO activity_log (user_id, activity_type, ip_address, user_agent, path, details, timestamp)
+        VALUES %s
+    """
+
+    def __init__(self, queue_size, batch_size, flush_interval, overflow_policy, block_timeout):
+        if overflow_policy not in ('drop_oldest', 'drop_newest', 'block'):
+            raise ValueError(f"Unknown activity log overflow policy: {overflow_policy}")
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._counters = {"enqueued": 0, "flushed": 0, "dropped": 0, "failed": 0, "batches": 0}
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self._max_event_age_ms = 0.0
+
+    def _ensure_started(self):
+        # Started lazily (and re-started after a fork) so each gunicorn worker runs its own writer.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._stop_event = threading.Event()
+                self._thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._counters[key] += amount
+
+    def enqueue(self, row):
+        self._ensure_started()
+        item = (time.monotonic(), row)
+        try:
+            if self.overflow_policy == 'block':
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow_policy != 'drop_oldest':
+                self._count("dropped")
+                return False
+            try:
+                self._queue.get_nowait()
+                self._count("dropped")
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._count("dropped")
+                return False
+        self._count("enqueued")
+        return True
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not self._stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+        # Shutdown requested: write whatever is still buffered.
+        remaining = self._drain()
+        for i in range(0, len(remaining), self.batch_size):
+            self._write(remaining[i:i + self.batch_size])
+
+    def _write(self, batch):
+        started = time.monotonic()
+        pool = get_db_pool()
+        conn = None
+        try:
+            conn = pool.getconn()
+            with conn.cursor() as cur:
+                execute_values(cur, self.INSERT_SQL, [row for _, row in batch], page_size=self.batch_size)
+            conn.commit()
+        except Exception as e:
+            print(f"--- CRITICAL: Error flushing {len(batch)} activity log events: {e} ---")
+            traceback.print_exc()
+            if conn is not None:
+                pool.putconn(conn, discard=True)
+            self._count("failed", len(batch))
+            return
+        pool.putconn(conn)
+
+        finished = time.monotonic()
+        flush_ms = (finished - started) * 1000
+        oldest_age_ms = (finished - batch[0][0]) * 1000
+        with self._stats_lock:
+            self._counters["flushed"] += len(batch)
+            self._counters["batches"] += 1
+            self._last_flush_ms = flush_ms
+            self._max_flush_ms = max(self._max_flush_ms, flush_ms)
+            self._total_flush_ms += flush_ms
+            self._max_event_age_ms = max(self._max_event_age_ms, oldest_age_ms)
+
+    def shutdown(self, timeout=10):
+        """Stops the writer and flushes buffered events. Safe to call more than once."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._counters["batches"]
+            return {
+                **self._counters,
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "overflow_policy": self.overflow_policy,
+                "last_flush_ms": round(self._last_flush_ms, 2),
+                "max_flush_ms": round(self._max_flush_ms, 2),
+                "avg_flush_ms": round(self._total_flush_ms / batches, 2) if batches else 0.0,
+                "max_event_age_ms": round(self._max_event_age_ms, 2),
+            }
+
+activity_log_writer = ActivityLogWriter(
+    queue_size=ACTIVITY_LOG_QUEUE_SIZE,
+    batch_size=ACTIVITY_LOG_BATCH_SIZE,
+    flush_interval=ACTIVITY_LOG_FLUSH_INTERVAL,
+    overflow_policy=ACTIVITY_LOG_OVERFLOW_POLICY,
+    block_timeout=ACTIVITY_LOG_BLOCK_TIMEOUT,
+)
+
+# Registered after close_db_pool, so it runs first at exit and can still borrow a connection.
+atexit.register(activity_log_writer.shutdown)
 
 # --- Activity Logging Helper ---
 def log_activity(activity_type, details=None, ip_address=None, user_agent=None, path=None):
@@ -82,14 +695,10 @@ def log_activity(activity_type, details=None, ip_address=None, user_agent=None,
         if details is not None and not isinstance(details, dict):
             details = {"info": str(details)}
 
-        sql = """
-            INSERT INTO activity_log (user_id, activity_type, ip_address, user_agent, path, details)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """
-        conn = get_db()
-        with conn.cursor() as cur:
-            cur.execute(sql, (user_id, activity_type, final_ip_address, final_user_agent, final_path, Json(details) if details else None))
-        conn.commit()
+        activity_log_writer.enqueue((
+            user_id, activity_type, final_ip_address, final_user_agent, final_path,
+            Json(details) if details else None, datetime.now(timezone.utc)
+        ))
     except Exception as e:
         print(f"--- CRITICAL: Error logging activity '{activity_type}': {e} ---")
         traceback.print_exc()
@@ -106,8 +715,6 @@ def login_required(f):
     return decorated_function
 
 # --- SNQL Helper Functions ---
-REFERENCE_PATTERN = re.compile(r'\[\[(.*?)\]\]')
-SNQL_REF_PATTERN = re.compile(r'snql-ref:([0-9a-fA-F\-]{36})')
 SNQL_BROKEN_REF_PATTERN = re.compile(r'snql-ref-broken:(.*?)(?=\s|\[\[|$$)')
 
 def convert_db_content_to_raw_for_editing(cursor, db_content):
@@ -131,129 +738,177 @@ def convert_db_content_to_raw_for_editing(cursor, db_content):
     return raw_content
 
 
-def process_and_update_note_content(cursor, note_id, content_json):
+class NoteSaveConflict(Exception):
+    """
+    Raised when a save was based on an old version of the note, or when a
+    delta names blocks the server does not have (resync=True: the client
+    should send the whole document instead).
+    """
+    def __init__(self, current_version, resync=False):
+        super().__init__(f"Note is at version {current_version}")
+        self.current_version = current_version
+        self.resync = resync
+
+# Whole-document save. FOR UPDATE makes a concurrent save wait and then
+# re-check the version, so two saves from the same base cannot both win.
+NOTE_SAVE_SQL = """
+    WITH current AS (
+        SELECT id, title FROM notes
+        WHERE id = %(note_id)s AND user_id = 1 AND (%(base_version)s::integer IS NULL OR version = %(base_version)s::integer)
+        FOR UPDATE
+    )
+    UPDATE notes SET title = %(title)s, content = %(content)s, version = notes.version + 1, updated_at = NOW()
+    FROM current
+    WHERE notes.id = current.id
+    RETURNING notes.version, current.title AS old_title
+"""
+
+# Block-level save: `order` lists every block id in the new document order and
+# `changed` maps ids to blocks that are new or edited. Unchanged blocks are
+# copied from the stored document, so the client only sends what it touched.
+# Nothing is written if any id in `order` can be found in neither.
+NOTE_DELTA_SAVE_SQL = """
+    WITH current AS (
+        SELECT id, title, content FROM notes
+        WHERE id = %(note_id)s AND user_id = 1 AND (%(base_version)s::integer IS NULL OR version = %(base_version)s::integer)
+        FOR UPDATE
+    ),
+    merged AS (
+        SELECT jsonb_agg(coalesce(%(changed)s::jsonb -> o.block_id, old.block) ORDER BY o.ord) AS blocks,
+               count(*) FILTER (WHERE %(changed)s::jsonb -> o.block_id IS NULL AND old.block IS NULL) AS missing
+        FROM current
+        CROSS JOIN unnest(%(order)s::text[]) WITH ORDINALITY AS o(block_id, ord)
+        LEFT JOIN LATERAL (
+            SELECT b AS block FROM jsonb_array_elements(
+                CASE WHEN jsonb_typeof(current.content -> 'blocks') = 'array' THEN current.content -> 'blocks' ELSE '[]' END
+            ) AS b
+            WHERE b ->> 'id' = o.block_id
+            LIMIT 1
+        ) old ON TRUE
+    )
+    UPDATE notes SET
+        title = %(title)s,
+        content = jsonb_build_object('time', %(time)s::bigint, 'version', %(editor_version)s::text, 'blocks', coalesce(merged.blocks, '[]'::jsonb)),
+        version = notes.version + 1,
+        updated_at = NOW()
+    FROM current, merged
+    WHERE notes.id = current.id AND merged.missing = 0
+    RETURNING notes.version, notes.content, current.title AS old_title
+"""
+
+def save_note_content(cursor, note_id, title, base_version, content=None, delta=None):
     """
-    A simplified and corrected function to save note content.
-    The complex link-processing has been temporarily removed to fix the data corruption bug.
+    Saves a note's title and either its whole content or a block delta in one
+    UPDATE, then brings its note_references rows up to date with the links it
+    now contains. Returns the new version, or None if the note does not exist.
+    A duplicate title surfaces as psycopg2.errors.UniqueViolation from the
+    idx_notes_user_title index. The caller commits.
     """
-    # For now, we will just save the content directly without modification.
-    # This ensures that what the editor sends is exactly what gets saved.
-    cursor.execute("UPDATE notes SET content = %s, updated_at = NOW() WHERE id = %s", (Json(content_json), note_id))
+    if delta is not None:
+        changed = {block_id: dict(block, id=block_id) for block_id, block in delta['blocks'].items()}
+        cursor.execute(NOTE_DELTA_SAVE_SQL, {
+            "note_id": note_id, "base_version": base_version, "title": title,
+            "order": delta['order'], "changed": Json(changed),
+            "time": delta.get('time'), "editor_version": delta.get('version'),
+        })
+    else:
+        cursor.execute(NOTE_SAVE_SQL, {"note_id": note_id, "base_version": base_version, "title": title, "content": Json(content)})
+    row = cursor.fetchone()
 
-    # We will clear note references to prevent stale data.
-    # A future version can rebuild these references safely.
-    cursor.execute("DELETE FROM note_references WHERE source_note_id = %s", (note_id,))
+    if row is None:
+        cursor.execute("SELECT version FROM notes WHERE id = %s AND user_id = 1", (note_id,))
+        current = cursor.fetchone()
+        if current is None:
+            return None
+        if base_version is not None and current['version'] != base_version:
+            raise NoteSaveConflict(current['version'])
+        raise NoteSaveConflict(current['version'], resync=True)
 
-    # The final commit is handled by the calling `update_note` function.
+    # Only the links that were added or removed are written; see note_links.update_note_links.
+    update_note_links(cursor, note_id, row['content'] if delta is not None else content)
+    if row['old_title'] != title:
+        bump_notes_tree_version(cursor) # Renamed, so the sidebar and breadcrumbs change
+    return row['version']
 
 
-# --- Helper for building the notes and folders tree ---
+def is_duplicate_note_title(error):
+    return error.diag.constraint_name == 'idx_notes_user_title'
+
 
-def get_breadcrumbs(cursor, note=None):
+def get_rendered_note(cursor, note_id):
     """
-    Generates a breadcrumb trail for a given note or the root.
+    Returns (note, html) for a note, or (None, None) if it does not exist.
+    The note's content is only read from the database when the HTML is not
+    already cached for its current updated_at and the current notes tree
+    version (which changes whenever a link target could have been renamed or deleted).
     """
-    # Fetch all folders into a map for efficient lookup
-    cursor.execute("SELECT id, name, parent_folder_id FROM folders WHERE user_id = 1")
-    all_folders_list = cursor.fetchall()
-    folders_by_id = {f['id']: f for f in all_folders_list}
-
-    breadcrumbs = []
-    if note:
-        # Start with the current note
-        breadcrumbs.append({'type': 'note', 'name': note['title']})
-        # Traverse up the folder hierarchy
-        folder_id = note.get('folder_id')
-        while folder_id:
-            folder = folders_by_id.get(folder_id)
-            if folder:
-                breadcrumbs.append({'type': 'folder', 'name': folder['name'], 'id': folder['id']})
-                folder_id = folder.get('parent_folder_id')
-            else:
-                folder_id = None
-        breadcrumbs.reverse() # Reverse to get root -> parent -> note order
-    else:
-        # Default for the main notes page
-        breadcrumbs.append({'type': 'root', 'name': "Scribe's Desk"})
-
-    return breadcrumbs
+    cursor.execute("SELECT id, title, folder_id, updated_at FROM notes WHERE id = %s AND user_id = 1", (note_id,))
+    note = cursor.fetchone()
+    if not note:
+        return None, None
+
+    cache_key = (note['id'], note['updated_at'], get_notes_tree_version(cursor))
+    rendered = rendered_note_cache.get(cache_key)
+    if rendered is None:
+        cursor.execute("SELECT content FROM notes WHERE id = %s", (note_id,))
+        content = cursor.fetchone()['content']
+        titles, guids = extract_references(content)
+        targets = {}
+        for target_id, title, guid in find_link_targets(cursor, titles, guids):
+            link = (url_for('view_note_readonly', note_id=target_id), title)
+            targets[('title', title)] = targets[('guid', guid)] = link
+        rendered = render_note_html(content, lambda kind, key: targets.get((kind, key)), md.render)
+        rendered_note_cache.put(cache_key, rendered)
+    return note, rendered
 
 
-def get_full_notes_hierarchy(cursor):
-    cursor.execute("SELECT id, name, parent_folder_id FROM folders WHERE user_id = 1 ORDER BY name")
-    all_folders = cursor.fetchall()
-    
-    cursor.execute("SELECT id, title, folder_id FROM notes WHERE user_id = 1 ORDER BY title")
-    all_notes = cursor.fetchall()
+# --- Helper for building the notes and folders tree ---
+notes_tree_cache = NotesTreeCache()
 
-    folder_map = {f['id']: f for f in all_folders}
-    
-    for folder_id in folder_map:
-        folder_map[folder_id]['children'] = []
-        folder_map[folder_id]['notes'] = []
-
-    for note in all_notes:
-        folder_id = note['folder_id']
-        if folder_id in folder_map:
-            folder_map[folder_id]['notes'].append(note)
-
-    tree = []
-    for folder in all_folders:
-        parent_id = folder['parent_folder_id']
-        if parent_id in folder_map:
-            folder_map[parent_id]['children'].append(folder)
-        else: # Top-level folder
-            tree.append(folder)
-            
-    orphaned_notes = [note for note in all_notes if not note['folder_id']]
-    
-    return tree, orphaned_notes
+def get_breadcrumbs(cursor, note=None, folder_path=None):
+    """
+    Generates a breadcrumb trail for a given note or the root.
+    Pass folder_path when the note's ancestor folders have already been loaded.
+    """
+    if not note:
+        return [{'type': 'root', 'name': "Scribe's Desk"}]
+    if folder_path is None:
+        folder_path = get_folder_path(cursor, note.get('folder_id'))
+    breadcrumbs = [{'type': 'folder', 'name': folder['name'], 'id': folder['id']} for folder in folder_path]
+    breadcrumbs.append({'type': 'note', 'name': note['title']})
+    return breadcrumbs
 
 # --- GCS Helpers ---
+def new_blob_name(filename):
+    """A unique blob name that keeps the extension of the uploaded file."""
+    filename_ext = os.path.splitext(secure_filename(filename))[1]
+    return f"{uuid.uuid4().hex}{filename_ext}"
+
 def upload_to_gcs(file_to_upload, bucket_name):
     if not file_to_upload or not file_to_upload.filename:
         return None
-    
-    try:
-        credentials_info = json.loads(os.environ.get('GOOGLE_CREDENTIALS_JSON'))
-        storage_client = storage.Client.from_service_account_info(credentials_info)
-    except Exception as e:
-        print(f"Error creating GCS client: {e}")
+    if not storage_service.configured:
+        print("Error uploading to GCS: storage is not configured.")
         return None
 
-    bucket = storage_client.bucket(bucket_name)
-    
-    original_filename = secure_filename(file_to_upload.filename)
-    filename_ext = os.path.splitext(original_filename)[1]
-    unique_filename = f"{uuid.uuid4().hex}{filename_ext}"
-    
-    blob = bucket.blob(unique_filename)
-    
+    unique_filename = new_blob_name(file_to_upload.filename)
+
     try:
-        blob.upload_from_file(file_to_upload, content_type=file_to_upload.content_type)
-        return unique_filename 
+        # The underlying stream, not the FileStorage wrapper: large uploads are
+        # spooled to a named file (see UploadRequest) and uploaded by path.
+        return storage_service.upload_file(file_to_upload.stream, unique_filename, content_type=file_to_upload.content_type,
+                                           size=get_file_size(file_to_upload) or None, bucket_name=bucket_name)
     except Exception as e:
         print(f"Error uploading to GCS: {e}")
         traceback.print_exc()
         return None
 
 def delete_from_gcs(blob_name, bucket_name):
-    if not blob_name or not GCS_BUCKET_NAME:
+    if not blob_name or not storage_service.configured:
         return
 
     try:
-        credentials_json_str = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-        if not credentials_json_str:
-            print("ERROR: GOOGLE_CREDENTIALS_JSON environment variable not set.")
-            return
-
-        credentials_info = json.loads(credentials_json_str)
-        storage_client = storage.Client.from_service_account_info(credentials_info)
-        bucket = storage_client.bucket(bucket_name)
-
-        blob = bucket.blob(blob_name)
-        if blob.exists():
-            blob.delete()
+        if storage_service.delete(blob_name, bucket_name=bucket_name):
             log_activity('gcs_file_deleted', details={'blob_name': blob_name})
         else:
             print(f"Blob '{blob_name}' not found for deletion.")
@@ -261,6 +916,55 @@ def delete_from_gcs(blob_name, bucket_name):
         print(f"Error deleting from GCS: {e}")
         log_activity('gcs_delete_error', details={'blob_name': blob_name, 'error': str(e)})
 
+def known_blob_names(cursor, blob_names):
+    """The subset of blob_names recorded in our own files, antiques, log_attachments or image_derivatives rows."""
+    blob_names = list({name for name in blob_names if name})
+    if not blob_names:
+        return set()
+    with cursor.connection.cursor() as cur:
+        cur.execute("""
+            SELECT gcs_blob_name FROM files WHERE gcs_blob_name = ANY(%(names)s)
+            UNION SELECT image_url FROM antiques WHERE image_url = ANY(%(names)s)
+            UNION SELECT file_name FROM log_attachments WHERE file_name = ANY(%(names)s)
+            UNION SELECT blob_name FROM image_derivatives WHERE blob_name = ANY(%(names)s)
+        """, {'names': blob_names})
+        return {row[0] for row in cur.fetchall()}
+
+def signed_file_urls(blob_names):
+    """
+    Signed GCS URLs for blobs read from our own tables, so images on a page
+    load directly instead of through a serve_private_file redirect each.
+    Cached URLs are only reused while they have most of their lifetime left
+    (see SIGNED_URL_EMBED_MAX_AGE); plain links should still point at
+    serve_private_file, which signs when clicked. Returns {} when storage is
+    unavailable; callers fall back to the redirect.
+    """
+    if not storage_service.configured:
+        return {}
+    try:
+        return storage_service.signed_urls(blob_names)
+    except Exception as e:
+        print(f"Error signing GCS URLs: {e}")
+        return {}
+
+# --- Image Derivatives ---
+# Thumbnails for collection and gardening photos, built off the request path.
+IMAGE_DERIVATIVE_MAX_QUEUED = int(os.environ.get("IMAGE_DERIVATIVE_MAX_QUEUED", "100"))
+derivative_worker = DerivativeWorker(storage_service, get_db_pool, IMAGE_DERIVATIVE_MAX_QUEUED)
+
+def image_srcsets(cursor, blob_names, display_width=None):
+    """
+    {original blob name: {"webp", "jpeg", "src"}} for the originals that have
+    derivatives; see build_srcsets. Pass display_width (CSS pixels) for images
+    shown at a fixed size, so only the widths that could be picked are signed.
+    """
+    derivatives = load_derivatives(cursor, blob_names)
+    if not derivatives:
+        return {}
+    if display_width:
+        derivatives = trim_for_display(derivatives, display_width)
+    return build_srcsets(derivatives, signed_file_urls(row['blob_name'] for rows in derivatives.values() for row in rows))
+
 def get_file_size(file_storage):
     """Safely gets the size of a file stream."""
     try:
@@ -337,7 +1041,7 @@ def logout():
 def before_request_handler():
     if 'logged_in' in session and \
        request.endpoint and \
-       request.endpoint not in ['login', 'static', 'logout', 'api_oracle_chat_start', 'api_oracle_chat_status', 'api_notes_search', 'api_render_markdown', 'api_update_task_status']:
+       request.endpoint not in ['login', 'static', 'logout', 'api_oracle_chat_start', 'api_oracle_chat_status', 'api_oracle_chat_stream', 'api_oracle_chat_cancel', 'api_notes_search', 'api_notes_fulltext_search', 'api_notes_tree', 'api_folder_delete_stats', 'api_collection_search', 'api_signed_urls', 'api_files_upload_session', 'api_files_upload_finalize', 'api_render_markdown', 'api_update_task_status', 'api_logs', 'admin_metrics', 'chart_image']:
         log_activity('pageview')
 
 @app.route('/')
@@ -357,11 +1061,14 @@ def hello():
             # 3. Get Today's Calorie Count
             london_tz = pytz.timezone("Europe/London")
             today_london = datetime.now(london_tz).date()
+            # A range on log_time (rather than DATE(log_time ...) = today) can use idx_food_log_user_log_time.
             cur.execute("""
                 SELECT SUM(calories) as total
                 FROM food_log
-                WHERE user_id = 1 AND DATE(log_time AT TIME ZONE 'Europe/London') = %s;
-            """, (today_london,))
+                WHERE user_id = 1
+                  AND log_time >= (%(today)s::date)::timestamp AT TIME ZONE 'Europe/London'
+                  AND log_time < (%(today)s::date + 1)::timestamp AT TIME ZONE 'Europe/London';
+            """, {'today': today_london})
             calories_today_result = cur.fetchone()
             calories_today = calories_today_result['total'] if calories_today_result and calories_today_result['total'] is not None else 0
 
@@ -401,12 +1108,11 @@ def notes_page():
     try:
         conn = get_db()
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            notes_tree, orphaned_notes = get_full_notes_hierarchy(cur)
+            sidebar_tree = build_sidebar_tree(cur, [])
             breadcrumbs = get_breadcrumbs(cur) # Generate breadcrumbs
 
         return render_template('notes.html',
-                               notes_tree=notes_tree,
-                               orphaned_notes=orphaned_notes,
+                               sidebar_tree=sidebar_tree,
                                current_note=None,
                                breadcrumbs=breadcrumbs) # Pass breadcrumbs to template
     except Exception as e:
@@ -433,6 +1139,7 @@ def move_note(note_id):
             
             # Update the folder_id for the note
             cur.execute("UPDATE notes SET folder_id = %s, updated_at = NOW() WHERE id = %s AND user_id = 1", (folder_id, note_id))
+            bump_notes_tree_version(cur)
         conn.commit()
         flash('Note moved successfully.', 'success')
         log_activity('note_moved', details={'note_id': note_id, 'target_folder_id': folder_id})
@@ -451,10 +1158,7 @@ def view_note(note_id):
     try:
         conn = get_db()
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            notes_tree, orphaned_notes = get_full_notes_hierarchy(cur)
-            
-            cur.execute("SELECT id, name FROM folders WHERE user_id = 1 ORDER BY name")
-            all_folders_for_move = cur.fetchall()
+            all_folders_for_move = notes_tree_cache.get(cur).folders
 
             cur.execute("SELECT * FROM notes WHERE id = %s AND user_id = 1", (note_id,))
             current_note = cur.fetchone()
@@ -462,7 +1166,10 @@ def view_note(note_id):
                 flash('Note not found.', 'error')
                 return redirect(url_for('notes_page'))
             
-            breadcrumbs = get_breadcrumbs(cur, current_note) # Generate breadcrumbs for the current note
+            # Only the folders on the way to this note are expanded; the rest load on demand.
+            folder_path = get_folder_path(cur, current_note.get('folder_id'))
+            sidebar_tree = build_sidebar_tree(cur, folder_path)
+            breadcrumbs = get_breadcrumbs(cur, current_note, folder_path) # Generate breadcrumbs for the current note
 
             # --- DATA PREPARATION ---
             raw_content_from_db = current_note.get('content')
@@ -485,8 +1192,7 @@ def view_note(note_id):
             outgoing_links = cur.fetchall()
 
         return render_template('notes.html', 
-                               notes_tree=notes_tree,
-                               orphaned_notes=orphaned_notes,
+                               sidebar_tree=sidebar_tree,
                                current_note=current_note,
                                backlinks=backlinks,
                                outgoing_links=outgoing_links,
@@ -499,6 +1205,108 @@ def view_note(note_id):
         return redirect(url_for('notes_page'))
     
 
+@app.route('/api/notes/tree')
+@login_required
+def api_notes_tree():
+    """
+    One level of the notes sidebar: the child folders (with counts) and notes
+    of ?folder_id=, or of the root when it is omitted. `html` is the same
+    markup the sidebar renders server-side, ready to insert when a folder is expanded.
+    """
+    folder_id_str = request.args.get('folder_id', '')
+    folder_id = int(folder_id_str) if folder_id_str.isdigit() else None
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            if folder_id is not None:
+                cur.execute("SELECT id FROM folders WHERE id = %s AND user_id = 1", (folder_id,))
+                if not cur.fetchone():
+                    return jsonify({"error": "Folder not found."}), 404
+            level = load_tree_levels(cur, [folder_id], include_root=folder_id is None)[folder_id]
+
+        render_level = get_template_attribute('_notes_tree.html', 'render_level')
+        return jsonify({
+            "folder_id": folder_id,
+            "folders": [{k: folder[k] for k in ('id', 'name', 'folder_count', 'note_count')} for folder in level['folders']],
+            "notes": [{'id': note['id'], 'title': note['title']} for note in level['notes']],
+            "html": str(render_level(level, False, None)),
+        })
+    except Exception as e:
+        log_activity('error', details={"function": "api_notes_tree", "folder_id": folder_id, "error": str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/note/<int:note_id>/read')
+@login_required
+def view_note_readonly(note_id):
+    """Server-rendered view of a note, without loading the editor or its JSON."""
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            note, note_html = get_rendered_note(cur, note_id)
+            if not note:
+                flash('Note not found.', 'error')
+                return redirect(url_for('notes_page'))
+            breadcrumbs = get_breadcrumbs(cur, note)
+        return render_template('note_read.html', note=note, note_html=note_html, breadcrumbs=breadcrumbs)
+    except Exception as e:
+        traceback.print_exc()
+        log_activity('view_note_error', details={'note_id': note_id, 'error': str(e)})
+        flash(f"Error viewing note: {e}", "error")
+        return redirect(url_for('notes_page'))
+
+@app.route('/note/<int:note_id>/export')
+@login_required
+def export_note(note_id):
+    """Downloads a note as a standalone HTML document."""
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            note, note_html = get_rendered_note(cur, note_id)
+        if not note:
+            flash('Note not found.', 'error')
+            return redirect(url_for('notes_page'))
+        log_activity('note_exported', details={'note_id': note_id})
+        filename = secure_filename(note['title']) or f"note-{note_id}"
+        return Response(render_template('note_export.html', note=note, note_html=note_html), mimetype='text/html',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}.html"'})
+    except Exception as e:
+        traceback.print_exc()
+        log_activity('export_note_error', details={'note_id': note_id, 'error': str(e)})
+        flash(f"Error exporting note: {e}", "error")
+        return redirect(url_for('notes_page'))
+
+@app.route('/api/render_markdown', methods=['GET', 'POST'])
+@login_required
+def api_render_markdown():
+    """
+    GET ?note_id= returns a note rendered to HTML (Editor.js blocks, or legacy
+    Markdown), served from the rendered-note cache when it is current.
+    POST {"markdown": "..."} renders arbitrary Markdown, e.g. for previews.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data.get('markdown'), str):
+            return jsonify({"error": "Request body must be JSON with a 'markdown' string."}), 400
+        return jsonify({"html": md.render(data['markdown'])})
+
+    note_id_str = request.args.get('note_id', '')
+    if not note_id_str.isdigit():
+        return jsonify({"error": "note_id is required."}), 400
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            note, note_html = get_rendered_note(cur, int(note_id_str))
+        if not note:
+            return jsonify({"error": "Note not found."}), 404
+        return jsonify({"note_id": note['id'], "title": note['title'], "updated_at": note['updated_at'].isoformat(), "html": note_html})
+    except Exception as e:
+        log_activity('error', details={"function": "api_render_markdown", "error": str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/add_folder', methods=['POST'])
 @login_required
 def add_folder():
@@ -513,6 +1321,7 @@ def add_folder():
         try:
             with conn.cursor() as cur:
                 cur.execute("INSERT INTO folders (name, parent_folder_id, user_id, created_at, updated_at) VALUES (%s, %s, 1, NOW(), NOW())", (folder_name, parent_folder_id))
+                bump_notes_tree_version(cur)
             conn.commit()
             log_activity('folder_created', details={'folder_name': folder_name, 'parent_id': parent_folder_id})
             flash(f"Folder '{folder_name}' created.", 'success')
@@ -534,10 +1343,12 @@ def delete_folder(folder_id):
             if not folder: 
                 flash("Folder not found.", "error")
             else:
+                stats = get_folder_deletion_stats(cur, folder_id)
                 cur.execute("DELETE FROM folders WHERE id = %s AND user_id = 1", (folder_id,))
+                bump_notes_tree_version(cur)
                 conn.commit()
-                log_activity('folder_deleted', details={'folder_id': folder_id, 'folder_name': folder['name']})
-                flash(f"Folder '{folder['name']}' and all its contents have been deleted.", 'success')
+                log_activity('folder_deleted', details={'folder_id': folder_id, 'folder_name': folder['name'], **stats})
+                flash(f"Folder '{folder['name']}' deleted, along with {stats['subfolder_count']} subfolder(s) and {stats['note_count']} note(s).", 'success')
     except Exception as e:
         conn.rollback()
         log_activity('folder_delete_error', details={'folder_id': folder_id, 'error': str(e)})
@@ -545,6 +1356,24 @@ def delete_folder(folder_id):
         
     return redirect(url_for('notes_page'))
 
+@app.route('/api/folder/<int:folder_id>/delete_stats')
+@login_required
+def api_folder_delete_stats(folder_id):
+    """What deleting a folder would remove, for the confirmation prompt."""
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT name FROM folders WHERE id = %s AND user_id = 1", (folder_id,))
+            folder = cur.fetchone()
+            if not folder:
+                return jsonify({"error": "Folder not found."}), 404
+            stats = get_folder_deletion_stats(cur, folder_id)
+        return jsonify({"folder_id": folder_id, "name": folder['name'], **stats})
+    except Exception as e:
+        log_activity('error', details={"function": "api_folder_delete_stats", "folder_id": folder_id, "error": str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/add_note', methods=['POST'])
 @login_required
 def add_note():
@@ -559,11 +1388,6 @@ def add_note():
     conn = get_db()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT id FROM notes WHERE title = %s AND user_id = 1", (note_title,))
-            if cur.fetchone():
-                flash(f"A note with the title '{note_title}' already exists.", 'error')
-                return redirect(url_for('notes_page'))
-            
             # Create a default content structure for the new note
             initial_content = {
                 "time": int(datetime.now().timestamp() * 1000),
@@ -576,10 +1400,17 @@ def add_note():
             
             cur.execute("INSERT INTO notes (title, content, folder_id, user_id, created_at, updated_at) VALUES (%s, %s, %s, 1, NOW(), NOW()) RETURNING id", (note_title, Json(initial_content), folder_id))
             new_note_id = cur.fetchone()[0]
+            bump_notes_tree_version(cur)
         conn.commit()
         log_activity('note_created', details={'note_title': note_title, 'folder_id': folder_id, 'note_id': new_note_id})
         flash(f"Note '{note_title}' created.", 'success')
         return redirect(url_for('view_note', note_id=new_note_id))
+    except psycopg2.errors.UniqueViolation as e:
+        conn.rollback()
+        if not is_duplicate_note_title(e):
+            raise
+        flash(f"A note with the title '{note_title}' already exists.", 'error')
+        return redirect(url_for('notes_page'))
     except Exception as e:
         conn.rollback()
         log_activity('note_create_error', details={'note_title': note_title, 'folder_id': folder_id, 'error': str(e)})
@@ -590,41 +1421,55 @@ def add_note():
 @app.route('/note/<int:note_id>/update', methods=['POST'])
 @login_required
 def update_note(note_id):
+    """
+    Saves a note from the editor. The body is {title, base_version, content}
+    for a whole document, or {title, base_version, delta: {order, blocks,
+    time, version}} for a block-level save. Responds 409 if the note has been
+    saved elsewhere since base_version, or if the delta cannot be applied.
+    """
     # Ensure the request content type is JSON
     if not request.is_json:
         return jsonify({"success": False, "error": "Invalid content type, request must be JSON."}), 415
 
     data = request.get_json()
     note_content_json = data.get('content')
-    note_title = data.get('title', '').strip()
+    delta = data.get('delta')
+    base_version = data.get('base_version')
+    note_title = (data.get('title') or '').strip()
 
     # Validate incoming data
     if not note_title:
         return jsonify({"success": False, "error": "Note title cannot be empty."}), 400
-    if note_content_json is None:
+    if note_content_json is None and delta is None:
         return jsonify({"success": False, "error": "Note content is missing from the request."}), 400
+    if delta is not None and not (isinstance(delta, dict)
+                                  and isinstance(delta.get('order'), list) and all(isinstance(block_id, str) for block_id in delta['order'])
+                                  and isinstance(delta.get('blocks'), dict) and all(isinstance(block, dict) for block in delta['blocks'].values())):
+        return jsonify({"success": False, "error": "Invalid delta: expected 'order' (block ids) and 'blocks' (id -> block)."}), 400
+    if base_version is not None and not isinstance(base_version, int):
+        return jsonify({"success": False, "error": "base_version must be an integer."}), 400
 
     conn = get_db()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Check if note exists
-            cur.execute("SELECT id FROM notes WHERE id = %s AND user_id = 1", (note_id,))
-            if not cur.fetchone():
-                return jsonify({"success": False, "error": "Note not found."}), 404
-            
-            # Check if new title is unique (excluding the current note)
-            cur.execute("SELECT id FROM notes WHERE title = %s AND user_id = 1 AND id != %s", (note_title, note_id))
-            if cur.fetchone():
-                return jsonify({"success": False, "error": f"Another note with the title '{note_title}' already exists."}), 400
-
-            # Update the title and process the JSON content for links
-            cur.execute("UPDATE notes SET title = %s, updated_at = NOW() WHERE id = %s", (note_title, note_id))
-            process_and_update_note_content(cur, note_id, note_content_json)
+            new_version = save_note_content(cur, note_id, note_title, base_version, content=note_content_json, delta=delta)
+        if new_version is None:
+            conn.rollback()
+            return jsonify({"success": False, "error": "Note not found."}), 404
         
         conn.commit()
-        log_activity('note_updated', details={'note_id': note_id, 'note_title': note_title})
-        return jsonify({"success": True, "message": "Note updated successfully."})
-        
+        log_activity('note_updated', details={'note_id': note_id, 'note_title': note_title, 'version': new_version, 'delta': delta is not None})
+        return jsonify({"success": True, "message": "Note updated successfully.", "version": new_version})
+
+    except NoteSaveConflict as e:
+        conn.rollback()
+        error = "The editor is out of sync; resending the whole note." if e.resync else "This note was changed elsewhere. Reload it before saving."
+        return jsonify({"success": False, "error": error, "version": e.current_version, "resync": e.resync}), 409
+    except psycopg2.errors.UniqueViolation as e:
+        conn.rollback()
+        if not is_duplicate_note_title(e):
+            raise
+        return jsonify({"success": False, "error": f"Another note with the title '{note_title}' already exists."}), 400
     except Exception as e:
         conn.rollback()
         log_activity('note_update_error', details={'note_id': note_id, 'error': str(e)})
@@ -644,6 +1489,7 @@ def api_delete_note(note_id):
                 return jsonify({"success": False, "error": "Note not found."}), 404
 
             cur.execute("DELETE FROM notes WHERE id = %s AND user_id = 1", (note_id,))
+            bump_notes_tree_version(cur)
         conn.commit()
         log_activity('note_deleted', details={'note_id': note_id, 'note_title': note_data['title']})
         return jsonify({"success": True})
@@ -711,34 +1557,116 @@ def api_update_task_status(task_id):
         return jsonify({"error": str(e)}), 500
         
 # --- Log Routes ---
+LOG_TYPES = ['workout', 'reading', 'gardening', 'general']
+LOGS_PAGE_SIZE = 20
+
+def encode_log_cursor(log):
+    """Opaque keyset cursor pointing just after `log` in (log_time, id) DESC order."""
+    raw = f"{log['log_time'].isoformat()}|{log['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_log_cursor(cursor):
+    try:
+        log_time_str, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(log_time_str), int(log_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def fetch_logs_page(cur, log_type=None, cursor=None, limit=LOGS_PAGE_SIZE):
+    """
+    Fetches one page of logs, newest first, using keyset pagination on
+    (log_time, id) so every page costs the same regardless of history size.
+    Attachments are loaded only for the logs on the page.
+    Returns (logs, next_cursor); next_cursor is None on the last page.
+    """
+    where_clauses = ["user_id = 1"]
+    params = []
+    if log_type:
+        where_clauses.append("log_type = %s")
+        params.append(log_type)
+    position = decode_log_cursor(cursor) if cursor else None
+    if position:
+        where_clauses.append("(log_time, id) < (%s, %s)")
+        params.extend(position)
+    params.append(limit + 1)
+
+    cur.execute(f"""
+        SELECT * FROM logs
+        WHERE {' AND '.join(where_clauses)}
+        ORDER BY log_time DESC, id DESC
+        LIMIT %s
+    """, tuple(params))
+    logs = cur.fetchall()
+    has_more = len(logs) > limit
+    logs = logs[:limit]
+
+    log_ids = [log['id'] for log in logs]
+    attachments = {}
+    if log_ids:
+        cur.execute("SELECT log_id, file_name FROM log_attachments WHERE log_id = ANY(%s) ORDER BY id", (log_ids,))
+        for row in cur.fetchall():
+            if row['log_id'] not in attachments:
+                attachments[row['log_id']] = []
+            attachments[row['log_id']].append(row['file_name'])
+
+    variants = image_srcsets(cur, [name for names in attachments.values() for name in names], display_width=96)
+    for log in logs:
+        log['attachments'] = attachments.get(log['id'], [])
+        log['attachment_variants'] = {name: variants[name] for name in log['attachments'] if name in variants}
+
+    next_cursor = encode_log_cursor(logs[-1]) if has_more else None
+    return logs, next_cursor
+
 @app.route('/logs')
 @login_required
 def logs_page():
+    log_type = request.args.get('type', '').strip()
+    if log_type not in LOG_TYPES:
+        log_type = None
     try:
         conn = get_db()
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM logs WHERE user_id = 1 ORDER BY log_time DESC")
-            logs = cur.fetchall()
-            
-            log_ids = [log['id'] for log in logs]
-            attachments = {}
-            if log_ids:
-                cur.execute("SELECT log_id, file_name FROM log_attachments WHERE log_id = ANY(%s)", (log_ids,))
-                for row in cur.fetchall():
-                    if row['log_id'] not in attachments:
-                        attachments[row['log_id']] = []
-                    attachments[row['log_id']].append(row['file_name'])
-            
-            for log in logs:
-                log['attachments'] = attachments.get(log['id'], [])
+            logs, next_cursor = fetch_logs_page(cur, log_type=log_type)
 
-        return render_template('logs.html', logs=logs)
+        return render_template('logs.html', logs=logs, next_cursor=next_cursor, log_type=log_type, log_types=LOG_TYPES)
     except Exception as e:
         log_activity('error', details={'function': 'logs_page', 'error': str(e)})
         flash("Error fetching logs.", "error")
         traceback.print_exc()
         return redirect(url_for('hello'))
 
+@app.route('/api/logs')
+@login_required
+def api_logs():
+    """Next page of logs for infinite scroll: structured data plus the rendered cards."""
+    log_type = request.args.get('type', '').strip()
+    if log_type not in LOG_TYPES:
+        log_type = None
+    cursor = request.args.get('cursor')
+    try:
+        limit = min(max(int(request.args.get('limit', LOGS_PAGE_SIZE)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if cursor and not decode_log_cursor(cursor):
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            logs, next_cursor = fetch_logs_page(cur, log_type=log_type, cursor=cursor, limit=limit)
+
+        html = render_template('_log_cards.html', logs=logs)
+        for log in logs:
+            log['log_time'] = log['log_time'].isoformat()
+            for key in ('created_at', 'updated_at'):
+                if log.get(key):
+                    log[key] = log[key].isoformat()
+        return jsonify({"logs": logs, "html": html, "next_cursor": next_cursor})
+    except Exception as e:
+        log_activity('error', details={'function': 'api_logs', 'error': str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/logs/add', methods=['GET', 'POST'])
 @login_required
 def add_log():
@@ -761,6 +1689,7 @@ def add_log():
             elif log_type == 'gardening':
                 structured_data['plants_tended'] = request.form.get('plants_tended')
 
+            photo_blob_name = None
             conn = get_db()
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute(
@@ -778,6 +1707,7 @@ def add_log():
                     if photo.filename != '':
                         file_name = upload_to_gcs(photo, GCS_BUCKET_NAME)
                         if file_name:
+                            photo_blob_name = file_name
                             cur.execute(
                                 """
                                 INSERT INTO log_attachments (log_id, file_name, file_type, user_id, created_at)
@@ -789,6 +1719,8 @@ def add_log():
                             flash("Photo upload failed.", "error")
 
             conn.commit()
+            if photo_blob_name:
+                derivative_worker.submit(photo_blob_name)
             flash(f"{log_type.capitalize()} log added successfully!", "success")
             log_activity(f'{log_type}_log_added', details={'title': title, 'log_id': log_id})
             return redirect(url_for('logs_page'))
@@ -809,17 +1741,77 @@ def add_log():
 @app.route('/api/notes/search')
 @login_required
 def api_notes_search():
-    query = request.args.get('q', '')
+    """Title autocomplete for [[...]] links. The ILIKE is served by the idx_notes_title_trgm trigram index."""
+    query = request.args.get('q', '').strip()
     if not query:
         return jsonify([])
     
     conn = get_db()
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT title FROM notes WHERE title ILIKE %s AND user_id = 1 LIMIT 10", (f"%{query}%",))
+        cur.execute("""
+            SELECT title FROM notes
+            WHERE user_id = 1 AND title ILIKE %(pattern)s
+            ORDER BY title ILIKE %(prefix)s DESC, similarity(title, %(query)s) DESC, title
+            LIMIT 10
+        """, {"pattern": f"%{escape_like(query)}%", "prefix": f"{escape_like(query)}%", "query": query})
         results = cur.fetchall()
         
     return jsonify([row['title'] for row in results])
 
+@app.route('/api/notes/fulltext')
+@login_required
+def api_notes_fulltext_search():
+    """
+    Ranked search over note titles and bodies using notes.search_vector
+    (migration 3). Snippets are only built for the page being returned, since
+    ts_headline has to re-read each note's content.
+    """
+    tsquery = build_prefix_tsquery(request.args.get('q', ''))
+    if not tsquery:
+        return jsonify({"results": [], "limit": 0, "offset": 0})
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 50)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        folder_id = int(request.args['folder_id']) if request.args.get('folder_id') else None
+    except ValueError:
+        return jsonify({"error": "limit, offset and folder_id must be integers"}), 400
+
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # ?folder_id= limits the search to that folder and everything beneath it.
+            folder_ids = get_folder_descendant_ids(cur, folder_id) if folder_id is not None else None
+            folder_sql = "AND n.folder_id = ANY(%(folder_ids)s::integer[])" if folder_ids is not None else ""
+            cur.execute(f"""
+                WITH query AS (SELECT to_tsquery('{SEARCH_CONFIG}', %(tsquery)s) AS q),
+                hits AS (
+                    SELECT n.id, n.title, n.content, n.updated_at, ts_rank_cd(n.search_vector, query.q) AS rank
+                    FROM notes n, query
+                    WHERE n.user_id = 1 AND n.search_vector @@ query.q {folder_sql}
+                    ORDER BY rank DESC, n.updated_at DESC
+                    LIMIT %(limit)s OFFSET %(offset)s
+                )
+                SELECT hits.id, hits.title, hits.updated_at, hits.rank,
+                       ts_headline('{SEARCH_CONFIG}', note_plain_text(hits.content), query.q, %(options)s) AS headline
+                FROM hits, query
+                ORDER BY hits.rank DESC, hits.updated_at DESC
+            """, {"tsquery": tsquery, "limit": limit, "offset": offset, "options": HEADLINE_OPTIONS, "folder_ids": folder_ids})
+            rows = cur.fetchall()
+
+        results = [{
+            "id": row['id'],
+            "title": row['title'],
+            "snippet": str(render_headline(row['headline'])),
+            "rank": round(float(row['rank']), 4),
+            "updated_at": row['updated_at'].isoformat() if row['updated_at'] else None,
+            "url": url_for('view_note', note_id=row['id']),
+        } for row in rows]
+        return jsonify({"results": results, "limit": limit, "offset": offset})
+    except Exception as e:
+        log_activity('error', details={"function": "api_notes_fulltext_search", "error": str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 # --- Food Log Routes ---
 @app.route('/food_log/add', methods=['GET', 'POST'])
 @login_required
@@ -859,6 +1851,7 @@ def add_food_log():
                     """
                     cur.execute(sql, (log_type, description, calories, log_time_dt))
                 conn.commit()
+                chart_cache.invalidate('food_log')
                 flash('Food log saved successfully!', 'success')
                 log_activity('food_logged', details={
                     'log_type': log_type,
@@ -885,10 +1878,7 @@ def view_food_log():
     try:
         conn = get_db()
         london_tz = pytz.timezone("Europe/London")
-        today_london = datetime.now(london_tz).date()
         thirty_days_ago = datetime.now() - timedelta(days=30)
-        
-        today_total_calories = 0
 
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT * FROM food_log WHERE user_id = 1 AND log_time >= %s ORDER BY log_time DESC", (thirty_days_ago,))
@@ -896,60 +1886,15 @@ def view_food_log():
 
             for log in logs:
                 if log.get('log_time'):
-                    log['log_date'] = log['log_time'].date()
+                    log['log_date'] = log['log_time'].astimezone(london_tz).date()
 
-            sql_today_calories = """
-                SELECT SUM(calories) as total
-                FROM food_log
-                WHERE user_id = 1 AND DATE(log_time AT TIME ZONE 'Europe/London') = %s;
-            """
-            cur.execute(sql_today_calories, (today_london,))
-            result = cur.fetchone()
-            if result and result['total'] is not None:
-                today_total_calories = int(result['total'])
+        with conn.cursor() as cur:
+            # The last day of the chart's series is today (London time).
+            _, daily_totals = get_daily_calorie_series(cur, days=1)
+        today_total_calories = daily_totals[-1]
         
-        chart_url = None
-        if logs:
-            df = pd.DataFrame(logs)
-            df['date'] = pd.to_datetime(df['log_time']).dt.date
-            daily_calories = df.groupby('date')['calories'].sum().reset_index()
-            
-            today = datetime.now().date()
-            date_range = pd.date_range(start=today - timedelta(days=29), end=today, freq='D').to_frame(index=False, name='date')
-            date_range['date'] = date_range['date'].dt.date
-            daily_calories = pd.merge(date_range, daily_calories, on='date', how='left').fillna(0)
-            daily_calories = daily_calories.sort_values(by='date', ascending=True)
-
-            plt.style.use('seaborn-v0_8-whitegrid')
-            fig, ax = plt.subplots(figsize=(12, 6))
-            bar_color, line_color, bg_color, text_color, grid_color = '#4B0082', '#C59B08', '#FDFDF6', '#2d3748', '#e2e8f0'
-            fig.patch.set_facecolor(bg_color)
-            ax.set_facecolor(bg_color)
-            ax.bar(daily_calories['date'], daily_calories['calories'], color=bar_color, width=0.6, label='Total Daily Calories')
-            ax.axhline(y=2000, color=line_color, linestyle='--', linewidth=2, label='2000 Calorie Target')
-            ax.set_title('Total Daily Calories for the Last 30 Days', fontsize=16, fontweight='bold', color=text_color, pad=20)
-            ax.set_xlabel('Date', fontsize=12, color=text_color, labelpad=10)
-            ax.set_ylabel('Total Calories', fontsize=12, color=text_color, labelpad=10)
-            ax.tick_params(axis='x', colors=text_color, rotation=45)
-            ax.tick_params(axis='y', colors=text_color)
-            ax.grid(color=grid_color)
-            ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
-            ax.xaxis.set_major_locator(mdates.DayLocator(interval=3))
-            plt.setp(ax.get_xticklabels(), ha="right")
-            ax.spines['top'].set_visible(False); ax.spines['right'].set_visible(False)
-            ax.spines['left'].set_color(grid_color); ax.spines['bottom'].set_color(grid_color)
-            ax.legend(frameon=False, loc='upper left', bbox_to_anchor=(0, 1.1))
-            plt.tight_layout()
-            
-            img = io.BytesIO()
-            plt.savefig(img, format='png')
-            img.seek(0)
-            # --- FIX ---
-            # Prepend the data URI scheme to the base64 string
-            chart_data = base64.b64encode(img.getvalue()).decode()
-            chart_url = f"data:image/png;base64,{chart_data}"
-            # --- END FIX ---
-            plt.close(fig)
+        # The chart itself is served (and cached) by chart_image.
+        chart_url = url_for('chart_image', chart_name='food_log_calories') if logs else None
 
         return render_template('view_food_log.html', logs=logs, chart_url=chart_url, today_total=today_total_calories)
 
@@ -1008,11 +1953,12 @@ def edit_food_log(log_id):
                 with conn.cursor() as cur:
                     sql = """
                         UPDATE food_log 
-                        SET log_type = %s, description = %s, calories = %s, log_time = %s
+                        SET log_type = %s, description = %s, calories = %s, log_time = %s, updated_at = NOW()
                         WHERE id = %s AND user_id = 1
                     """
                     cur.execute(sql, (log_type, description, calories, log_time_dt, log_id))
                 conn.commit()
+                chart_cache.invalidate('food_log')
                 flash('Food log updated successfully!', 'success')
                 log_activity('food_log_updated', details={'log_id': log_id, 'description': description})
                 return redirect(url_for('view_food_log'))
@@ -1045,6 +1991,7 @@ def delete_food_log(log_id):
 
             cur.execute("DELETE FROM food_log WHERE id = %s AND user_id = 1", (log_id,))
         conn.commit()
+        chart_cache.invalidate('food_log')
         flash('Food log entry deleted.', 'success')
         log_activity('food_log_deleted', details={'log_id': log_id, 'description': log_entry['description']})
     except Exception as e:
@@ -1081,7 +2028,7 @@ def api_estimate_calories():
         
         # 4. Make the synchronous API call
         # A simple request is better here than the async job pattern used for the main chat.
-        response = requests.post(ORACLE_API_ENDPOINT_URL, json=payload, headers=headers, timeout=20) # 20 second timeout
+        response = get_oracle_session().post(ORACLE_API_ENDPOINT_URL, json=payload, headers=headers, timeout=20) # 20 second timeout
         response.raise_for_status()
         
         api_response = response.json()
@@ -1109,43 +2056,70 @@ def api_estimate_calories():
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
 
 # --- Collection Log Routes ---
+def build_collection_filters(args):
+    """
+    Builds the WHERE clause shared by the collection list, dashboard and
+    charts from the filter form's query parameters.
+    Returns (where_sql, params, current_filters).
+    """
+    query_search = args.get('q', '').strip()
+    item_type_filter = args.get('item_type', '').strip()
+    period_filter = args.get('period', '').strip()
+    sellable_filter = args.get('is_sellable', '').strip()
+
+    where_clauses = ["user_id = 1"]
+    params = []
+
+    if query_search:
+        tsquery = build_prefix_tsquery(query_search)
+        if tsquery:
+            # Uses the GIN index on the generated antiques.search_vector column (migration 2).
+            where_clauses.append(f"search_vector @@ to_tsquery('{SEARCH_CONFIG}', %s)")
+            params.append(tsquery)
+        else:
+            # Nothing word-like to index on (e.g. just "£"); fall back to substring matching.
+            where_clauses.append("(name ILIKE %s OR description ILIKE %s OR item_type ILIKE %s OR period ILIKE %s OR provenance ILIKE %s)")
+            search_term = f"%{query_search}%"
+            params.extend([search_term] * 5)
+
+    if item_type_filter:
+        where_clauses.append("item_type = %s")
+        params.append(item_type_filter)
+
+    if period_filter:
+        where_clauses.append("period = %s")
+        params.append(period_filter)
+
+    if sellable_filter == 'yes':
+        where_clauses.append("is_sellable = TRUE")
+    elif sellable_filter == 'no':
+        where_clauses.append("is_sellable = FALSE")
+
+    current_filters = {
+        'q': query_search,
+        'item_type': item_type_filter,
+        'period': period_filter,
+        'is_sellable': sellable_filter
+    }
+    return ' AND '.join(where_clauses), params, current_filters
+
+def collection_search_order(query_search):
+    """ORDER BY for collection results: best full-text match first when searching, else newest first."""
+    tsquery = build_prefix_tsquery(query_search) if query_search else None
+    if not tsquery:
+        return "created_at DESC", []
+    return f"ts_rank(search_vector, to_tsquery('{SEARCH_CONFIG}', %s)) DESC, created_at DESC", [tsquery]
+
 @app.route('/collection')
 @login_required
 def collection_page():
     try:
         conn = get_db()
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query_search = request.args.get('q', '').strip()
-            item_type_filter = request.args.get('item_type', '').strip()
-            period_filter = request.args.get('period', '').strip()
-            sellable_filter = request.args.get('is_sellable', '').strip()
-
-            base_query = "SELECT * FROM antiques WHERE user_id = 1"
-            where_clauses = []
-            params = []
-            
-            if query_search:
-                where_clauses.append("(name ILIKE %s OR description ILIKE %s OR item_type ILIKE %s OR period ILIKE %s OR provenance ILIKE %s)")
-                search_term = f"%{query_search}%"
-                params.extend([search_term] * 5)
-
-            if item_type_filter:
-                where_clauses.append("item_type = %s")
-                params.append(item_type_filter)
-            
-            if period_filter:
-                where_clauses.append("period = %s")
-                params.append(period_filter)
-
-            if sellable_filter == 'yes':
-                where_clauses.append("is_sellable = TRUE")
-            elif sellable_filter == 'no':
-                where_clauses.append("is_sellable = FALSE")
-
-            sql_query = f"{base_query} AND {' AND '.join(where_clauses)}" if where_clauses else base_query
-            sql_query += " ORDER BY created_at DESC"
+            where_sql, params, current_filters = build_collection_filters(request.args)
+            order_sql, order_params = collection_search_order(current_filters['q'])
 
-            cur.execute(sql_query, tuple(params))
+            cur.execute(f"SELECT * FROM antiques WHERE {where_sql} ORDER BY {order_sql}", tuple(params + order_params))
             items = cur.fetchall()
 
             cur.execute("SELECT DISTINCT item_type FROM antiques WHERE user_id = 1 AND item_type IS NOT NULL AND item_type != '' ORDER BY item_type")
@@ -1154,18 +2128,14 @@ def collection_page():
             cur.execute("SELECT DISTINCT period FROM antiques WHERE user_id = 1 AND period IS NOT NULL AND period != '' ORDER BY period")
             periods = [row['period'] for row in cur.fetchall()]
 
-        current_filters = {
-            'q': query_search,
-            'item_type': item_type_filter,
-            'period': period_filter,
-            'is_sellable': sellable_filter
-        }
+            image_variants = image_srcsets(cur, [item['image_url'] for item in items], display_width=64)
 
         return render_template('collection.html', 
                                items=items, 
                                item_types=item_types, 
                                periods=periods,
-                               filters=current_filters)
+                               filters=current_filters,
+                               image_variants=image_variants)
     except Exception as e:
         log_activity('error', details={"function": "collection_page", "error": str(e)})
         traceback.print_exc()
@@ -1174,65 +2144,67 @@ def collection_page():
 
 
 
-@app.route('/collection/dashboard')
+@app.route('/api/collection/search')
 @login_required
-def collection_dashboard():
+def api_collection_search():
+    """Ranked collection search for type-ahead UIs. Accepts the same filters as the collection page plus limit/offset."""
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+
     try:
         conn = get_db()
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # 1. Get filter values from query parameters
-            query_search = request.args.get('q', '').strip()
-            item_type_filter = request.args.get('item_type', '').strip()
-            period_filter = request.args.get('period', '').strip()
-            sellable_filter = request.args.get('is_sellable', '').strip()
-
-            # 2. Build a dynamic query based on filters
-            base_query = "SELECT * FROM antiques WHERE user_id = 1"
-            where_clauses = []
-            params = []
-            
-            if query_search:
-                where_clauses.append("(name ILIKE %s OR description ILIKE %s OR item_type ILIKE %s OR period ILIKE %s OR provenance ILIKE %s)")
-                search_term = f"%{query_search}%"
-                params.extend([search_term] * 5)
-
-            if item_type_filter:
-                where_clauses.append("item_type = %s")
-                params.append(item_type_filter)
-            
-            if period_filter:
-                where_clauses.append("period = %s")
-                params.append(period_filter)
+            where_sql, params, current_filters = build_collection_filters(request.args)
+            order_sql, order_params = collection_search_order(current_filters['q'])
+            cur.execute(f"""
+                SELECT id, name, item_type, period, approximate_value, is_sellable, image_url,
+                       COUNT(*) OVER () AS total_count
+                FROM antiques
+                WHERE {where_sql}
+                ORDER BY {order_sql}
+                LIMIT %s OFFSET %s
+            """, tuple(params + order_params + [limit, offset]))
+            rows = cur.fetchall()
+
+        total = rows[0]['total_count'] if rows else 0
+        file_urls = signed_file_urls(row['image_url'] for row in rows)
+        items = []
+        for row in rows:
+            row.pop('total_count')
+            row['approximate_value'] = float(row['approximate_value']) if row['approximate_value'] is not None else None
+            row['url'] = url_for('view_collection_item', item_id=row['id'])
+            row['image_signed_url'] = file_urls.get(row['image_url'])
+            items.append(row)
+        return jsonify({"items": items, "total": total, "limit": limit, "offset": offset})
+    except Exception as e:
+        log_activity('error', details={"function": "api_collection_search", "error": str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
 
-            if sellable_filter == 'yes':
-                where_clauses.append("is_sellable = TRUE")
-            elif sellable_filter == 'no':
-                where_clauses.append("is_sellable = FALSE")
 
-            if where_clauses:
-                sql_query = f"{base_query} AND {' AND '.join(where_clauses)}"
-            else:
-                sql_query = base_query
+@app.route('/collection/dashboard')
+@login_required
+def collection_dashboard():
+    try:
+        conn = get_db()
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # 1. Build a dynamic query from the filter query parameters
+            where_sql, params, current_filters = build_collection_filters(request.args)
 
-            # 3. Execute the query to get the filtered items
-            cur.execute(sql_query, tuple(params))
+            # 2. Execute the query to get the filtered items
+            cur.execute(f"SELECT item_type, period, approximate_value FROM antiques WHERE {where_sql}", tuple(params))
             items = cur.fetchall()
 
-            # 4. Get distinct values for filter dropdowns (these should be from all items, not just filtered ones)
+            # 3. Get distinct values for filter dropdowns (these should be from all items, not just filtered ones)
             cur.execute("SELECT DISTINCT item_type FROM antiques WHERE user_id = 1 AND item_type IS NOT NULL AND item_type != '' ORDER BY item_type")
             item_types = [row['item_type'] for row in cur.fetchall()]
             
             cur.execute("SELECT DISTINCT period FROM antiques WHERE user_id = 1 AND period IS NOT NULL AND period != '' ORDER BY period")
             periods = [row['period'] for row in cur.fetchall()]
 
-        # Store current filters to pass back to the template
-        current_filters = {
-            'q': query_search,
-            'item_type': item_type_filter,
-            'period': period_filter,
-            'is_sellable': sellable_filter
-        }
-
         # If no items match the filters, render the dashboard with a message
         if not items:
             return render_template('collection_dashboard.html', 
@@ -1243,7 +2215,7 @@ def collection_dashboard():
                                    item_types=item_types,
                                    periods=periods)
 
-        # 5. If items are found, proceed with calculations and plotting
+        # 4. If items are found, proceed with calculations
         df = pd.DataFrame(items)
         df['approximate_value'] = pd.to_numeric(df['approximate_value'], errors='coerce').fillna(0)
 
@@ -1259,50 +2231,12 @@ def collection_dashboard():
             "average_value": total_value / items_with_value if items_with_value > 0 else 0
         }
 
-        # --- Plotting ---
+        # --- Charts (rendered and cached by chart_image) ---
         plot_url1, plot_url2 = None, None
-        plt.style.use('seaborn-v0_8-whitegrid')
-        bg_color, text_color, bar_color = '#FDFDF6', '#2d3748', '#4B0082'
-
-        # Plot 1: Value by Type
-        if not df.empty and 'item_type' in df.columns and df['item_type'].notna().any():
-            value_by_type = df.groupby('item_type')['approximate_value'].sum().nlargest(10).sort_values()
-            if not value_by_type.empty:
-                fig1, ax1 = plt.subplots(figsize=(10, 6))
-                fig1.patch.set_facecolor(bg_color)
-                ax1.set_facecolor(bg_color)
-                value_by_type.plot(kind='barh', ax=ax1, color=bar_color)
-                ax1.set_title('Top 10 Collection Value by Item Type', fontsize=16, color=text_color, pad=20)
-                ax1.set_xlabel('Total Approximate Value (£)', color=text_color)
-                ax1.set_ylabel('Item Type', color=text_color)
-                ax1.tick_params(colors=text_color)
-                ax1.spines['top'].set_visible(False); ax1.spines['right'].set_visible(False)
-                plt.tight_layout()
-                img1 = io.BytesIO()
-                plt.savefig(img1, format='png', bbox_inches='tight')
-                img1.seek(0)
-                plot_url1 = base64.b64encode(img1.getvalue()).decode()
-                plt.close(fig1)
-
-        # Plot 2: Value by Period
-        if not df.empty and 'period' in df.columns and df['period'].notna().any():
-            value_by_period = df.groupby('period')['approximate_value'].sum().nlargest(10).sort_values()
-            if not value_by_period.empty:
-                fig2, ax2 = plt.subplots(figsize=(10, 6))
-                fig2.patch.set_facecolor(bg_color)
-                ax2.set_facecolor(bg_color)
-                value_by_period.plot(kind='barh', ax=ax2, color=bar_color)
-                ax2.set_title('Top 10 Collection Value by Period', fontsize=16, color=text_color, pad=20)
-                ax2.set_xlabel('Total Approximate Value (£)', color=text_color)
-                ax2.set_ylabel('Period', color=text_color)
-                ax2.tick_params(colors=text_color)
-                ax2.spines['top'].set_visible(False); ax2.spines['right'].set_visible(False)
-                plt.tight_layout()
-                img2 = io.BytesIO()
-                plt.savefig(img2, format='png', bbox_inches='tight')
-                img2.seek(0)
-                plot_url2 = base64.b64encode(img2.getvalue()).decode()
-                plt.close(fig2)
+        if df['item_type'].notna().any():
+            plot_url1 = url_for('chart_image', chart_name='collection_value_by_type', **current_filters)
+        if df['period'].notna().any():
+            plot_url2 = url_for('chart_image', chart_name='collection_value_by_period', **current_filters)
 
         return render_template('collection_dashboard.html', 
                                stats=stats, 
@@ -1332,7 +2266,11 @@ def view_collection_item(item_id):
             flash('Collection item not found.', 'error')
             return redirect(url_for('collection_page'))
 
-        return render_template('view_item.html', item=item)
+        with conn.cursor() as cur:
+            image_variants = image_srcsets(cur, [item['image_url']])
+        # With derivatives the original is only reached through the serve_private_file link.
+        originals = [item['image_url']] if item['image_url'] not in image_variants else []
+        return render_template('view_item.html', item=item, file_urls=signed_file_urls(originals), image_variants=image_variants)
     except Exception as e:
         log_activity('error', details={"function": "view_collection_item", "error": str(e)})
         flash("Error fetching item details.", "error")
@@ -1383,6 +2321,9 @@ def add_collection_item():
                     approximate_value, is_sellable, image_url
                 ))
             conn.commit()
+            chart_cache.invalidate('collection')
+            if image_url:
+                derivative_worker.submit(image_url)
 
             flash(f"Item '{name}' added to your collection!", 'success')
             log_activity('collection_item_added', details={'name': name, 'image_url': image_url})
@@ -1439,7 +2380,8 @@ def edit_collection_item(item_id):
             image_file = request.files.get('image')
             if image_file and image_file.filename != '':
                 if GCS_BUCKET_NAME:
-                    if item['image_url']: # Delete old image if it exists
+                    if item['image_url']: # Delete old image (and its thumbnails) if it exists
+                        delete_derivatives(storage_service, conn, [item['image_url']])
                         delete_from_gcs(item['image_url'], GCS_BUCKET_NAME)
                     
                     new_image_url = upload_to_gcs(image_file, GCS_BUCKET_NAME)
@@ -1466,6 +2408,9 @@ def edit_collection_item(item_id):
                     approximate_value, 'is_sellable' in request.form, image_url, item_id
                 ))
             conn.commit()
+            chart_cache.invalidate('collection')
+            if image_url != item['image_url']:
+                derivative_worker.submit(image_url)
 
             flash(f"Item '{name}' has been updated!", 'success')
             log_activity('collection_item_updated', details={'item_id': item_id, 'name': name})
@@ -1500,12 +2445,14 @@ def delete_collection_item(item_id):
             flash("Item not found.", "error")
             return redirect(url_for('collection_page'))
 
-        if item['image_url']: # Delete image from GCS
+        if item['image_url']: # Delete image and its thumbnails from GCS
+            delete_derivatives(storage_service, conn, [item['image_url']])
             delete_from_gcs(item['image_url'], GCS_BUCKET_NAME)
 
         with conn.cursor() as cur: # Delete item from database
             cur.execute("DELETE FROM antiques WHERE id = %s AND user_id = 1", (item_id,))
         conn.commit()
+        chart_cache.invalidate('collection')
         
         log_activity('collection_item_deleted', details={'item_id': item_id, 'name': item['name']})
         flash(f"Item '{item['name']}' has been deleted.", 'success')
@@ -1518,6 +2465,110 @@ def delete_collection_item(item_id):
     return redirect(url_for('collection_page'))
 
 
+# --- Chart Routes ---
+# chart_name -> (grouping column, title, axis label)
+COLLECTION_CHARTS = {
+    'collection_value_by_type': ('item_type', 'Top 10 Collection Value by Item Type', 'Item Type'),
+    'collection_value_by_period': ('period', 'Top 10 Collection Value by Period', 'Period'),
+}
+
+def chart_fingerprint(cur, sql, params, *extra):
+    """Hashes a cheap aggregate over a chart's source rows; any insert, update or delete changes it."""
+    cur.execute(sql, params)
+    return hashlib.sha1(repr((cur.fetchone(), extra)).encode()).hexdigest()[:20]
+
+def get_daily_calorie_series(cur, days=30):
+    """
+    Total calories for each of the last `days` Europe/London calendar dates,
+    oldest first, aggregated in Postgres and gap-filled with zeros.
+    Returns (dates, totals).
+    """
+    cur.execute("""
+        WITH bounds AS (
+            SELECT (NOW() AT TIME ZONE 'Europe/London')::date AS today
+        ),
+        days AS (
+            SELECT generate_series(bounds.today - (%(days)s - 1), bounds.today, INTERVAL '1 day')::date AS day
+            FROM bounds
+        ),
+        totals AS (
+            SELECT (log_time AT TIME ZONE 'Europe/London')::date AS day, SUM(calories) AS total
+            FROM food_log, bounds
+            WHERE user_id = 1
+              AND log_time >= (bounds.today - (%(days)s - 1))::timestamp AT TIME ZONE 'Europe/London'
+            GROUP BY 1
+        )
+        SELECT days.day, COALESCE(totals.total, 0)
+        FROM days LEFT JOIN totals ON totals.day = days.day
+        ORDER BY days.day
+    """, {'days': days})
+    rows = cur.fetchall()
+    return [row[0] for row in rows], [int(row[1]) for row in rows]
+
+def get_collection_value_series(cur, where_sql, params, column):
+    cur.execute(f"SELECT {column}, approximate_value FROM antiques WHERE {where_sql}", tuple(params))
+    df = pd.DataFrame(cur.fetchall(), columns=[column, 'approximate_value'])
+    df['approximate_value'] = pd.to_numeric(df['approximate_value'], errors='coerce').fillna(0)
+    series = df.groupby(column)['approximate_value'].sum().nlargest(10).sort_values()
+    return [str(label) for label in series.index], [float(value) for value in series.values]
+
+@app.route('/charts/<chart_name>.png')
+@login_required
+def chart_image(chart_name):
+    """
+    Serves a chart PNG, rendering it only when its fingerprint is not already
+    cached. The fingerprint doubles as the ETag so browsers revalidate cheaply.
+    """
+    if chart_name != 'food_log_calories' and chart_name not in COLLECTION_CHARTS:
+        return "Unknown chart.", 404
+
+    try:
+        conn = get_db()
+        with conn.cursor() as cur:
+            if chart_name == 'food_log_calories':
+                today = datetime.now(pytz.timezone("Europe/London")).date()
+                fingerprint = chart_fingerprint(
+                    cur,
+                    "SELECT COUNT(*), MAX(id), MAX(updated_at), SUM(calories) FROM food_log WHERE user_id = 1 AND log_time >= %s",
+                    (today - timedelta(days=31),), today
+                )
+            else:
+                where_sql, params, current_filters = build_collection_filters(request.args)
+                fingerprint = chart_fingerprint(
+                    cur,
+                    f"SELECT COUNT(*), MAX(id), MAX(updated_at), SUM(approximate_value) FROM antiques WHERE {where_sql}",
+                    tuple(params), sorted(current_filters.items())
+                )
+
+            if request.if_none_match.contains(fingerprint):
+                response = Response(status=304)
+            else:
+                png = chart_cache.get(chart_name, fingerprint)
+                if png is None:
+                    if chart_name == 'food_log_calories':
+                        dates, calories = get_daily_calorie_series(cur)
+                        png, rendered = chart_renderer.render(render_calorie_chart, dates, calories)
+                    else:
+                        column, title, ylabel = COLLECTION_CHARTS[chart_name]
+                        labels, values = get_collection_value_series(cur, where_sql, params, column)
+                        png, rendered = chart_renderer.render(render_value_chart, labels, values, title, ylabel)
+                    if not rendered:
+                        # Never cache or validate the placeholder; the next load should try again.
+                        response = Response(png, mimetype='image/png')
+                        response.headers['Cache-Control'] = 'no-store'
+                        return response
+                    chart_cache.put(chart_name, fingerprint, png)
+                response = Response(png, mimetype='image/png')
+
+        response.set_etag(fingerprint)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    except Exception as e:
+        log_activity('error', details={"function": "chart_image", "chart": chart_name, "error": str(e)})
+        traceback.print_exc()
+        return "Error rendering chart.", 500
+
+
 # --- Oracle Chat (Gemini) Routes ---
 @app.route('/oracle_chat')
 @login_required
@@ -1526,42 +2577,129 @@ def oracle_chat_page():
         flash("Oracle Chat is currently unavailable (API endpoint not configured). Please check server logs.", "error")
     return render_template('oracle_chat.html')
 
-def run_oracle_query_in_background(job_id, payload, ip_address, user_agent, path):
+class OracleJobCancelled(Exception):
+    pass
+
+class OracleCancelCheck:
+    """
+    Raises OracleJobCancelled once a job has been cancelled: at once for a
+    cancel handled by this process (cancel_event), and within
+    ORACLE_CANCEL_CHECK_INTERVAL for one handled by another worker, which is
+    only visible in the shared job store. A job that has vanished from the
+    store counts as cancelled, since nobody is left to read its reply.
+    """
+    def __init__(self, job_id, cancel_event):
+        self.job_id = job_id
+        self.cancel_event = cancel_event
+        self._last_checked = None
+
+    def __call__(self, force=False):
+        if self.cancel_event.is_set():
+            raise OracleJobCancelled()
+        now = time.monotonic()
+        if force or self._last_checked is None or now - self._last_checked >= ORACLE_CANCEL_CHECK_INTERVAL:
+            self._last_checked = now
+            job = oracle_jobs.get(self.job_id)
+            if job is None or job['status'] == 'cancelled':
+                raise OracleJobCancelled()
+
+def read_oracle_reply(response, job_id, check_cancelled):
+    """
+    Reads the Oracle API response. Plain JSON replies ({"reply": ...}) are read
+    in chunks; Server-Sent Events or NDJSON replies carrying {"delta": ...}
+    pieces are accumulated and published to the job store as they arrive, so
+    the chat page can show the answer while it is still being written.
+    """
+    content_type = response.headers.get('Content-Type', '')
+    if 'text/event-stream' not in content_type and 'ndjson' not in content_type:
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=8192):
+            check_cancelled()
+            body.extend(chunk)
+        return json.loads(body).get("reply")
+
+    is_sse = 'text/event-stream' in content_type
+    reply = ""
+    last_published = time.monotonic()
+    for line in response.iter_lines(decode_unicode=True):
+        check_cancelled()
+        if not line:
+            continue
+        if is_sse:
+            if not line.startswith('data:'):
+                continue # event names, ids and keep-alive comments
+            line = line[5:].strip()
+        if line == '[DONE]':
+            break
+        try:
+            chunk = json.loads(line)
+        except json.JSONDecodeError:
+            chunk = {"delta": line}
+        if not isinstance(chunk, dict):
+            continue
+        if chunk.get("reply") is not None:
+            reply = chunk["reply"] # A final message may carry the whole reply
+        else:
+            reply += chunk.get("delta") or chunk.get("text") or ""
+
+        now = time.monotonic()
+        if now - last_published >= ORACLE_STREAM_PUBLISH_INTERVAL:
+            # Nothing changed means another worker cancelled it (or it expired): stop reading.
+            if not publish_oracle_job(job_id, "streaming", reply, only_if_not_in=('cancelled',)):
+                raise OracleJobCancelled()
+            last_published = now
+    return reply or None
+
+def run_oracle_query_in_background(job_id, payload, ip_address, user_agent, path, cancel_event):
+    check_cancelled = OracleCancelCheck(job_id, cancel_event)
     try:
-        headers = { "Content-Type": "application/json" }
+        # It may have been cancelled on another worker while it sat in this one's queue.
+        check_cancelled(force=True)
+        headers = { "Content-Type": "application/json", "Accept": "text/event-stream, application/x-ndjson, application/json" }
         if ORACLE_API_FUNCTION_KEY:
             headers["X-Api-Key"] = ORACLE_API_FUNCTION_KEY
 
-        response = requests.post(ORACLE_API_ENDPOINT_URL, json=payload, headers=headers, timeout=300)
-        response.raise_for_status()
-        
-        response_data = response.json()
-        llm_reply = response_data.get("reply")
-        
+        # Stream the body so a cancellation is noticed between chunks rather than after the whole reply.
+        with get_oracle_session().post(ORACLE_API_ENDPOINT_URL, json=payload, headers=headers,
+                                       timeout=ORACLE_REQUEST_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            llm_reply = read_oracle_reply(response, job_id, check_cancelled)
+
+        if cancel_event.is_set():
+            raise OracleJobCancelled()
         if llm_reply is None:
             raise ValueError("Received an empty or invalid reply from the Oracle API.")
-            
-        oracle_jobs[job_id] = {"status": "complete", "reply": llm_reply}
+
+        # Conditional, so a cancel written by another worker since the last check is not overwritten.
+        if not publish_oracle_job(job_id, "complete", llm_reply, only_if_not_in=('cancelled',)):
+            raise OracleJobCancelled()
         log_activity(
             'oracle_response_received_from_external_api',
             details={'job_id': job_id, 'response_start': llm_reply[:100]},
             ip_address=ip_address, user_agent=user_agent, path=path
         )
+    except OracleJobCancelled:
+        oracle_job_notifier.notify(job_id, finished=True)
+        log_activity(
+            'oracle_query_cancelled',
+            details={'job_id': job_id},
+            ip_address=ip_address, user_agent=user_agent, path=path
+        )
     except requests.exceptions.Timeout:
         print(f"[ERROR] Timeout error for job {job_id}")
         traceback.print_exc()
-        error_message = "The Oracle took more than 5 minutes to respond. The request has been cancelled. Please try a simpler question or try again later."
-        oracle_jobs[job_id] = {"status": "error", "reply": error_message}
+        error_message = f"The Oracle took more than {int(ORACLE_REQUEST_TIMEOUT // 60)} minutes to respond. The request has been cancelled. Please try a simpler question or try again later."
+        publish_oracle_job(job_id, "error", error_message, only_if_not_in=('cancelled',))
         log_activity(
             'oracle_api_error',
-            details={'job_id': job_id, 'error': 'Timeout after 300 seconds'},
+            details={'job_id': job_id, 'error': f'Timeout after {int(ORACLE_REQUEST_TIMEOUT)} seconds'},
             ip_address=ip_address, user_agent=user_agent, path=path
         )
     except Exception as e:
-        print(f"[ERROR] Background thread error for job {job_id}: {e}")
+        print(f"[ERROR] Background worker error for job {job_id}: {e}")
         traceback.print_exc()
         error_message = f"The Oracle could not respond due to an unexpected error. Details: {str(e)}"
-        oracle_jobs[job_id] = {"status": "error", "reply": error_message}
+        publish_oracle_job(job_id, "error", error_message, only_if_not_in=('cancelled',))
         log_activity(
             'oracle_api_error',
             details={'job_id': job_id, 'error': str(e)},
@@ -1579,16 +2717,25 @@ def api_oracle_chat_start():
         return jsonify({"error": "Invalid request payload."}), 400
 
     job_id = str(uuid.uuid4())
-    oracle_jobs[job_id] = {"status": "pending", "reply": None}
+    try:
+        oracle_jobs.create(job_id)
+    except Exception as e:
+        log_activity('oracle_api_error', details={'job_id': job_id, 'error': f"Job store unavailable: {e}"})
+        traceback.print_exc()
+        return jsonify({"error": "Could not queue the request. Please try again."}), 503
     
     payload = { "message": client_data.get('message'), "history": client_data.get('history', []) }
     
-    thread = threading.Thread(
-        target=run_oracle_query_in_background,
-        args=(job_id, payload, request.remote_addr, request.headers.get('User-Agent'), request.path)
+    accepted = oracle_executor.submit(
+        job_id, run_oracle_query_in_background,
+        payload, request.remote_addr, request.headers.get('User-Agent'), request.path
     )
-    thread.daemon = True
-    thread.start()
+    if not accepted:
+        oracle_jobs.delete(job_id)
+        log_activity('oracle_query_rejected', details={'job_id': job_id, 'reason': 'executor full'})
+        response = jsonify({"error": "The Oracle is busy with other questions. Please try again shortly."})
+        response.headers['Retry-After'] = '10'
+        return response, 429
     
     log_activity('oracle_query_sent_to_external_api', details={'job_id': job_id, 'prompt_start': payload['message'][:100]})
 
@@ -1599,12 +2746,87 @@ def api_oracle_chat_start():
 def api_oracle_chat_status(job_id):
     job = oracle_jobs.get(job_id)
     if not job:
-        return jsonify({"status": "error", "reply": "Job not found. It may have been cleared from memory."}), 404
+        return jsonify({"status": "error", "reply": "Job not found. It may have expired."}), 404
         
-    if job['status'] == 'complete' or job['status'] == 'error':
-        return jsonify(oracle_jobs.pop(job_id))
-    else:
-        return jsonify(job)
+    if job['status'] in ('complete', 'error', 'cancelled'):
+        oracle_jobs.delete(job_id)
+    return jsonify(job)
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/oracle_chat_stream/<job_id>', methods=['GET'])
+@login_required
+def api_oracle_chat_stream(job_id):
+    """
+    Server-Sent Events stream for one job: 'delta' events carry new reply text
+    as it arrives, then a single 'complete', 'oracle_error' or 'cancelled'
+    event ends the stream. Replaces client-side polling of the status endpoint,
+    except when ORACLE_MAX_STREAMS are already open: the 429 makes the chat
+    page fall back to polling.
+    """
+    if not oracle_jobs.get(job_id):
+        return jsonify({"status": "error", "reply": "Job not found. It may have expired."}), 404
+    if not oracle_stream_slots.acquire():
+        response = jsonify({"error": "Too many open reply streams. Poll the status endpoint instead."})
+        response.headers['Retry-After'] = '2'
+        return response, 429
+
+    def generate():
+        sent_length = 0
+        seen_version = 0
+        deadline = time.monotonic() + ORACLE_REQUEST_TIMEOUT + 60
+        last_sent = time.monotonic()
+        try:
+            while time.monotonic() < deadline:
+                job = oracle_jobs.get(job_id)
+                if job is None:
+                    yield format_sse('oracle_error', {"reply": "Job not found. It may have expired."})
+                    return
+                status, reply = job['status'], job['reply'] or ""
+                if status in ('complete', 'error', 'cancelled'):
+                    oracle_jobs.delete(job_id)
+                    event = 'oracle_error' if status == 'error' else status
+                    yield format_sse(event, {"reply": reply})
+                    return
+                if status == 'streaming' and len(reply) > sent_length:
+                    yield format_sse('delta', {"text": reply[sent_length:]})
+                    sent_length = len(reply)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent > 15:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+                seen_version = oracle_job_notifier.wait(job_id, seen_version, ORACLE_STREAM_POLL_INTERVAL)
+            yield format_sse('oracle_error', {"reply": "The request timed out. The Oracle is taking too long to respond."})
+        finally:
+            oracle_job_notifier.discard(job_id)
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Released when the server closes the response, even if the generator never started.
+    response.call_on_close(oracle_stream_slots.release)
+    return response
+
+@app.route('/api/oracle_chat_cancel/<job_id>', methods=['POST'])
+@login_required
+def api_oracle_chat_cancel(job_id):
+    job = oracle_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found. It may have expired."}), 404
+    if job['status'] not in ('pending', 'streaming'):
+        return jsonify({"status": job['status']}), 409
+
+    # Mark it in the shared store first so the owning worker sees it even if it is another process.
+    # Conditional, so a reply that finished in the meantime is not thrown away.
+    if not publish_oracle_job(job_id, "cancelled", "The request was cancelled.", only_if_not_in=('complete', 'error', 'cancelled')):
+        job = oracle_jobs.get(job_id)
+        return jsonify({"status": job['status'] if job else "error"}), 409
+    oracle_executor.cancel(job_id)
+    log_activity('oracle_query_cancel_requested', details={'job_id': job_id})
+    return jsonify({"status": "cancelled"})
 
 # --- Other Routes ---
 @app.route('/db_test')
@@ -1619,6 +2841,23 @@ def db_test():
     except Exception as e:
         return f"Database connection failed: {e}", 500
 
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    return jsonify({
+        "db_pool": get_db_pool().stats(),
+        "activity_log": activity_log_writer.stats(),
+        "oracle_jobs": oracle_jobs.stats(),
+        "oracle_executor": oracle_executor.stats(),
+        "oracle_streams": oracle_stream_slots.stats(),
+        "chart_cache": chart_cache.stats(),
+        "chart_renderer": chart_renderer.stats(),
+        "notes_tree_cache": notes_tree_cache.stats(),
+        "rendered_note_cache": rendered_note_cache.stats(),
+        "storage": storage_service.stats(),
+        "image_derivatives": derivative_worker.stats(),
+    })
+
 @app.route('/admin/activity_log')
 @login_required
 def view_activity_log():
@@ -1650,7 +2889,7 @@ def files_page():
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT *, COALESCE(file_size_bytes, 0) as file_size_bytes FROM files WHERE user_id = 1 ORDER BY created_at DESC")
             files = cur.fetchall()
-        return render_template('files.html', files=files)
+        return render_template('files.html', files=files, direct_upload=FILES_DIRECT_UPLOAD)
     except Exception as e:
         log_activity('error', details={"function": "files_page", "error": str(e)})
         flash("Error loading files page.", "error")
@@ -1699,6 +2938,68 @@ def upload_file():
         
     return redirect(url_for('files_page'))
 
+@app.route('/api/files/upload_session', methods=['POST'])
+@login_required
+def api_files_upload_session():
+    """Starts a browser-direct upload. Returns the GCS session URL to PUT the file to and a token for api_files_upload_finalize."""
+    if not FILES_DIRECT_UPLOAD or not storage_service.configured:
+        return jsonify({"error": "Direct uploads are not enabled."}), 404
+
+    data = request.get_json(silent=True) or {}
+    original_filename = secure_filename(data.get('filename') or '')
+    content_type = data.get('content_type') or 'application/octet-stream'
+    size = data.get('size')
+    if not original_filename:
+        return jsonify({"error": "filename is required"}), 400
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({"error": "size must be a non-negative integer"}), 400
+
+    try:
+        gcs_blob_name = new_blob_name(original_filename)
+        session_url = storage_service.create_upload_session(gcs_blob_name, content_type, size=size, origin=request.host_url.rstrip('/'))
+        token = upload_tokens.dumps({'blob': gcs_blob_name, 'filename': original_filename})
+        return jsonify({"session_url": session_url, "token": token})
+    except Exception as e:
+        log_activity('file_upload_error', details={'error': str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/files/upload_finalize', methods=['POST'])
+@login_required
+def api_files_upload_finalize():
+    """Records a browser-direct upload in the files table once GCS has the whole object. Safe to retry."""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = upload_tokens.loads(data.get('token') or '', max_age=UPLOAD_SESSION_MAX_AGE)
+    except BadSignature:
+        return jsonify({"error": "Invalid or expired upload token."}), 400
+
+    conn = get_db()
+    try:
+        blob = storage_service.get_blob(upload['blob'])
+        if blob is None:
+            return jsonify({"error": "The upload has not completed."}), 409
+
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO files (original_filename, gcs_blob_name, file_type, file_size_bytes, user_id, description, created_at)
+                VALUES (%s, %s, %s, %s, 1, %s, NOW())
+                ON CONFLICT (gcs_blob_name) DO NOTHING
+                RETURNING id
+            """, (upload['filename'], upload['blob'], blob.content_type, blob.size, data.get('description', '')))
+            created = cur.fetchone() is not None
+        conn.commit()
+
+        if created:
+            log_activity('file_uploaded', details={'filename': upload['filename'], 'gcs_blob': upload['blob'], 'direct': True})
+            flash(f"File '{upload['filename']}' uploaded successfully.", 'success')
+        return jsonify({"success": True, "created": created})
+    except Exception as e:
+        conn.rollback()
+        log_activity('file_upload_error', details={'error': str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/files/delete/<int:file_id>', methods=['POST'])
 @login_required
 def delete_file(file_id):
@@ -1733,31 +3034,52 @@ def delete_file(file_id):
 @app.route('/files/<path:filename>')
 @login_required
 def serve_private_file(filename):
-    if not GCS_BUCKET_NAME or not GOOGLE_CREDENTIALS_JSON:
+    if not storage_service.configured:
         return "File serving is not configured.", 500
 
     try:
-        credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-        storage_client = storage.Client.from_service_account_info(credentials_info)
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(filename)
+        signed_url = storage_service.cached_signed_url(filename)
+        if signed_url is None:
+            # Blobs recorded in our own tables are trusted to exist; only
+            # unknown names cost a GCS round trip.
+            with get_db().cursor() as cur:
+                known = filename in known_blob_names(cur, [filename])
+            if not known and not storage_service.exists(filename):
+                return "File not found.", 404
+            signed_url = storage_service.sign(filename)
 
-        if not blob.exists():
-            return "File not found.", 404
-            
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(minutes=15),
-            method="GET",
-        )
-        
         return redirect(signed_url)
         
     except Exception as e:
         log_activity('error', details={"function": "serve_private_file", "error": str(e)})
         traceback.print_exc()
         return "Error serving file.", 500
-        
+
+@app.route('/api/files/signed_urls', methods=['POST'])
+@login_required
+def api_signed_urls():
+    """Signed URLs for up to MAX_SIGNED_URL_BATCH blob names. Names not found in our own tables are returned under "missing"."""
+    if not storage_service.configured:
+        return jsonify({"error": "File serving is not configured."}), 500
+
+    names = (request.get_json(silent=True) or {}).get('names')
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        return jsonify({"error": "names must be a list of strings"}), 400
+    if len(names) > MAX_SIGNED_URL_BATCH:
+        return jsonify({"error": f"At most {MAX_SIGNED_URL_BATCH} names per request"}), 400
+
+    try:
+        with get_db().cursor() as cur:
+            known = known_blob_names(cur, names)
+        return jsonify({
+            "urls": storage_service.signed_urls(name for name in names if name in known),
+            "missing": [name for name in dict.fromkeys(names) if name not in known],
+        })
+    except Exception as e:
+        log_activity('error', details={"function": "api_signed_urls", "error": str(e)})
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5167)), debug=False)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+import psycopg2.pool
+from PIL import UnidentifiedImageError
+
+from gcs_storage import StorageService
+from image_derivatives import build_derivatives, is_image_blob, record_derivatives
+
+# --- Configuration ---
+# Builds thumbnails for collection images and gardening log attachments that
+# were uploaded before the derivative pipeline existed, or whose background
+# job was dropped:
+#   python backfill_image_derivatives.py [--force] [--limit N] [--workers N] [--dry-run]
+# Each image is committed on its own, so an interrupted run can simply be
+# started again. Requires migration 7.
+DB_URL = os.environ.get("DATABASE_URL")
+GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
+GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+
+SOURCES_SQL = """
+    SELECT blob_name FROM (
+        SELECT image_url AS blob_name FROM antiques WHERE image_url IS NOT NULL
+        UNION
+        SELECT file_name FROM log_attachments
+    ) sources
+    WHERE %(force)s OR NOT EXISTS (SELECT 1 FROM image_derivatives d WHERE d.source_blob_name = sources.blob_name)
+    ORDER BY blob_name
+"""
+
+
+def find_sources(conn, force):
+    with conn.cursor() as cur:
+        cur.execute(SOURCES_SQL, {'force': force})
+        return [row[0] for row in cur.fetchall() if is_image_blob(row[0])]
+
+
+def process(storage_service, pool, blob_name):
+    rows = build_derivatives(storage_service, blob_name)
+    if not rows:
+        return 0
+    conn = pool.getconn()
+    try:
+        record_derivatives(conn, blob_name, rows)
+        conn.commit()
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate thumbnails for existing collection and log images.")
+    parser.add_argument("--force", action="store_true", help="Rebuild derivatives for images that already have them.")
+    parser.add_argument("--limit", type=int, help="Process at most this many images.")
+    parser.add_argument("--workers", type=int, default=4, help="Images processed in parallel (default 4).")
+    parser.add_argument("--dry-run", action="store_true", help="List the images that would be processed.")
+    args = parser.parse_args()
+
+    storage_service = StorageService(GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON)
+    if not DB_URL or not storage_service.configured:
+        print("[ERROR] Missing one or more required environment variables (DATABASE_URL, GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON).")
+        return 1
+
+    workers = max(1, args.workers)
+    pool = psycopg2.pool.ThreadedConnectionPool(1, workers, DB_URL)
+    try:
+        conn = pool.getconn()
+        try:
+            sources = find_sources(conn, args.force)
+        finally:
+            pool.putconn(conn)
+        if args.limit is not None:
+            sources = sources[:args.limit]
+
+        print(f"{len(sources)} images to process.")
+        if args.dry_run:
+            for blob_name in sources:
+                print(f"  {blob_name}")
+            print("--- Dry run: nothing generated ---")
+            return 0
+
+        started = time.monotonic()
+        done = derivatives = missing = skipped = failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process, storage_service, pool, blob_name): blob_name for blob_name in sources}
+            for future in as_completed(futures):
+                blob_name = futures[future]
+                try:
+                    written = future.result()
+                except UnidentifiedImageError:
+                    skipped += 1
+                    print(f"[WARNING] Not a readable image, skipped: {blob_name}")
+                    continue
+                except Exception as e:
+                    failed += 1
+                    print(f"[ERROR] {blob_name}: {e}")
+                    continue
+                done += 1 if written else 0
+                missing += 0 if written else 1
+                derivatives += written
+
+        print(f"--- {done} images processed ({derivatives} derivatives), {missing} missing from storage, "
+              f"{skipped} skipped, {failed} failed in {time.monotonic() - started:.1f}s ---")
+        return 1 if failed else 0
+    finally:
+        pool.closeall()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,18 @@
 import os
+import re
+import sys
+import time
+import zlib
+import tarfile
+import tempfile
+import hashlib
+import argparse
+import threading
 import subprocess
-import json
-from datetime import datetime
-from google.cloud import storage
-import io
+from collections import deque
+from datetime import datetime, timedelta
+
+from gcs_storage import StorageService
 
 # --- Configuration ---
 # These are the same environment variables your main Flask app uses.
@@ -11,93 +20,376 @@ DB_URL = os.environ.get("DATABASE_URL")
 GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
 GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON")
 
-def main():
+# The dump is streamed into a resumable GCS upload (straight from pg_dump's
+# stdout for the custom format, as a tar of the dump directory for the
+# parallel directory format), so memory use is bounded by READ_SIZE plus one
+# upload chunk (GCS_UPLOAD_CHUNK_SIZE) however large the database is. Optional gzip/zstd compression and a SHA-256
+# of the stored bytes are computed on the fly; the checksum, sizes and
+# compression are saved as object metadata for restores to check against.
+BACKUP_PREFIX = "database_backups/"
+READ_SIZE = 1024 * 1024
+STDERR_TAIL_LINES = 200
+COMPRESSION_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class StreamCompressor:
+    """Incremental gzip or zstd compression; 'none' passes data through."""
+    def __init__(self, kind, level=None):
+        self.kind = kind
+        if kind == "gzip":
+            self._compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)  # 31: gzip container
+        elif kind == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd compression needs the 'zstandard' package (pip install zstandard).")
+            self._compressor = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        elif kind == "none":
+            self._compressor = None
+        else:
+            raise ValueError(f"Unknown compression: {kind}")
+
+    def compress(self, data):
+        return self._compressor.compress(data) if self._compressor else data
+
+    def flush(self):
+        return self._compressor.flush() if self._compressor else b""
+
+
+class StderrReader:
+    """Drains a process's stderr on a thread, keeping the last lines, so a chatty child can never block on a full pipe."""
+    def __init__(self, stream):
+        self._lines = deque(maxlen=STDERR_TAIL_LINES)
+        self._thread = threading.Thread(target=self._run, args=(stream,), name="stderr-reader", daemon=True)
+        self._thread.start()
+
+    def _run(self, stream):
+        for line in iter(stream.readline, b""):
+            self._lines.append(line.decode("utf-8", errors="replace").rstrip())
+        stream.close()
+
+    def text(self, timeout=10):
+        self._thread.join(timeout)
+        return "\n".join(self._lines)
+
+
+class BackupWriter:
     """
-    Main function to run the database backup and upload process.
+    File-like sink for a backup: compresses, hashes and streams everything
+    written to it into a resumable upload of blob. The object only comes into
+    existence on commit(); a failed backup must call abort(), since simply
+    dropping the writer would close it and so finalize a truncated object.
     """
-    print("--- Starting database backup process ---")
+    def __init__(self, blob, compression="none", level=None, chunk_size=None):
+        self.blob = blob
+        self._compressor = StreamCompressor(compression, level)
+        self._digest = hashlib.sha256()
+        self._writer = blob.open("wb", chunk_size=chunk_size, content_type="application/octet-stream")
+        self.raw_bytes = 0
+        self.stored_bytes = 0
 
-    # 1. Validate environment variables
-    if not all([DB_URL, GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON]):
-        print("[ERROR] Missing one or more required environment variables (DATABASE_URL, GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON).")
-        return
+    def _store(self, data):
+        if data:
+            self._digest.update(data)
+            self._writer.write(data)
+            self.stored_bytes += len(data)
 
-    try:
-        # 2. Set up GCS client
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self._store(self._compressor.compress(data))
+        return len(data)
+
+    def copy_from(self, source):
+        """Copies a binary stream in READ_SIZE pieces."""
+        while True:
+            data = source.read(READ_SIZE)
+            if not data:
+                return
+            self.write(data)
+
+    def commit(self):
+        """Finishes the upload. Returns {"raw_bytes", "stored_bytes", "sha256"}."""
+        self._store(self._compressor.flush())
+        self._writer.close()
+        return {"raw_bytes": self.raw_bytes, "stored_bytes": self.stored_bytes, "sha256": self._digest.hexdigest()}
+
+    def abort(self):
+        """Cancels the resumable upload, discarding everything written so far."""
         try:
-            credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-            storage_client = storage.Client.from_service_account_info(credentials_info)
-            bucket = storage_client.bucket(GCS_BUCKET_NAME)
-            print(f"Successfully connected to GCS bucket: '{GCS_BUCKET_NAME}'")
+            self._writer.terminate()
         except Exception as e:
-            print(f"[ERROR] Failed to create GCS client: {e}")
-            return
-
-        # 3. Define the backup command and filename
-        timestamp = datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')
-        backup_filename = f"db_backup_{timestamp}.dump"
-        
-        # Using pg_dump with the database URL.
-        # -Fc: Custom format, compressed and flexible.
-        # --no-owner: Improves portability by not tying objects to the original owner.
-        # --clean: Adds commands to clean (drop) database objects before recreating.
-        command = [
-            'pg_dump',
-            '--format=custom',
-            '--no-owner',
-            '--clean',
-            DB_URL
-        ]
-        
-        print(f"Running pg_dump and streaming to '{backup_filename}' in GCS...")
-
-        # 4. Run pg_dump and stream the output to GCS
-        # We use a pipe to capture the output of pg_dump without saving it to a local file.
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # The backup content is streamed directly from the command's output.
-        backup_blob = bucket.blob(f"database_backups/{backup_filename}")
-        
-        # Use io.BytesIO to handle the stream in memory
-        with io.BytesIO(process.stdout.read()) as backup_stream:
-            backup_stream.seek(0) # Go to the beginning of the stream
-            backup_blob.upload_from_file(backup_stream, content_type='application/octet-stream')
-
-        # Wait for the process to complete and check for errors
-        _, stderr = process.communicate()
-        if process.returncode != 0:
-            error_message = stderr.decode('utf-8').strip()
-            print(f"[ERROR] pg_dump failed with return code {process.returncode}.")
-            print(f"Error details: {error_message}")
-            return
-            
-        print(f"--- Successfully uploaded backup to GCS: {backup_blob.name} ---")
-
-        # 5. (Optional) Implement a retention policy
-        cleanup_old_backups(bucket, days_to_keep=30)
+            print(f"[WARNING] Could not cancel the incomplete backup upload: {e}")
 
-    except Exception as e:
-        print(f"[CRITICAL] An unexpected error occurred during the backup process: {e}")
 
-def cleanup_old_backups(bucket, days_to_keep):
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def backup_blob_name(started_at, backup_format, compression):
+    """Date-prefixed name (database_backups/YYYY/MM/DD/...) so retention can list one month at a time."""
+    extension = ".dump" if backup_format == "custom" else ".dir.tar"
+    return f"{BACKUP_PREFIX}{started_at:%Y/%m/%d}/db_backup_{started_at:%H-%M-%S}{extension}{COMPRESSION_EXTENSIONS[compression]}"
+
+
+def pg_dump_command(backup_format, compression, jobs=1, output_dir=None):
+    # --no-owner: Improves portability by not tying objects to the original owner.
+    # --clean: Adds commands to clean (drop) database objects before recreating.
+    # With client-side compression pg_dump's own is switched off, so the data is not compressed twice.
+    command = ['pg_dump', f'--format={backup_format}', '--no-owner', '--clean']
+    if compression != "none":
+        command.append('--compress=0')
+    if backup_format == "directory":
+        command += [f'--jobs={jobs}', f'--file={output_dir}']
+    command.append(DB_URL)
+    return command
+
+
+def run_custom_backup(writer, compression):
+    """Single pg_dump process in custom format, streamed from stdout into writer as it is produced."""
+    process = subprocess.Popen(pg_dump_command("custom", compression), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = StderrReader(process.stderr)
+    try:
+        writer.copy_from(process.stdout)
+        if process.wait() != 0:
+            raise RuntimeError(f"pg_dump failed with return code {process.returncode}: {stderr.text()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return {}
+
+
+def run_directory_backup(writer, compression, jobs):
     """
-    Deletes backups in the 'database_backups/' folder older than the specified number of days.
+    pg_dump --format=directory with one worker per table up to jobs, into a
+    local scratch directory (BACKUP_WORK_DIR or the system temp dir), which is
+    then streamed into writer as an uncompressed tar. Needs free disk space for
+    the dump; pg_restore can restore the extracted directory in parallel too.
     """
-    print(f"--- Running cleanup task: Deleting backups older than {days_to_keep} days ---")
+    with tempfile.TemporaryDirectory(prefix="db_backup_", dir=os.environ.get("BACKUP_WORK_DIR")) as work_dir:
+        output_dir = os.path.join(work_dir, "dump")
+        dump_started = time.monotonic()
+        result = subprocess.run(pg_dump_command("directory", compression, jobs, output_dir), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            error = result.stderr.decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"pg_dump failed with return code {result.returncode}: {error}")
+        dump_seconds = time.monotonic() - dump_started
+
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            tar.add(output_dir, arcname="dump")
+    return {"dump_seconds": dump_seconds}
+
+
+def run_backup(storage_service, backup_format="custom", compression="none", level=None, jobs=1):
+    """Dumps DB_URL into a new blob and returns (blob, stats). Raises RuntimeError if pg_dump fails."""
+    started_at = datetime.utcnow()
+    backup_blob = storage_service.bucket().blob(backup_blob_name(started_at, backup_format, compression))
+    jobs_note = f", {jobs} jobs" if backup_format == "directory" else ""
+    print(f"Running pg_dump ({backup_format}{jobs_note}) and streaming to '{backup_blob.name}' in GCS (compression: {compression})...")
+
+    # Sent with the upload itself; the checksum and size are added once the dump is complete.
+    backup_blob.metadata = {"compression": compression, "format": backup_format}
+    started = time.monotonic()
+    writer = BackupWriter(backup_blob, compression, level, chunk_size=storage_service.chunk_size)
+    try:
+        if backup_format == "directory":
+            timings = run_directory_backup(writer, compression, jobs)
+        else:
+            timings = run_custom_backup(writer, compression)
+        stats = writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    stats.update(timings, seconds=time.monotonic() - started)
+
+    backup_blob.metadata = {**backup_blob.metadata, "sha256": stats["sha256"], "raw_bytes": str(stats["raw_bytes"])}
+    try:
+        backup_blob.patch()
+    except Exception:
+        # A backup without its checksum cannot be verified, so do not leave it to become the newest one.
+        storage_service.delete(backup_blob.name)
+        raise
+    return backup_blob, stats
+
+
+# --- Retention ---
+# Grandfather-father-son: the newest backup of each of the last KEEP_DAILY
+# days, KEEP_WEEKLY ISO weeks and KEEP_MONTHLY months is kept, plus the newest
+# backup overall; everything else is deleted in batched requests. Only month
+# prefixes old enough to hold something deletable are listed, so the cost
+# stays proportional to the handful of backups near the window edges rather
+# than to the whole history. Flat legacy names (database_backups/db_backup_<timestamp>.dump)
+# are included so they age out under the same policy.
+KEEP_DAILY = int(os.environ.get("BACKUP_KEEP_DAILY", "7"))
+KEEP_WEEKLY = int(os.environ.get("BACKUP_KEEP_WEEKLY", "4"))
+KEEP_MONTHLY = int(os.environ.get("BACKUP_KEEP_MONTHLY", "12"))
+DELETE_BATCH_SIZE = 100  # GCS batch request limit
+
+BACKUP_NAME_PATTERNS = [
+    re.compile(r"^database_backups/(?P<date>\d{4}/\d{2}/\d{2})/db_backup_(?P<time>\d{2}-\d{2}-\d{2})\."),
+    re.compile(r"^database_backups/db_backup_(?P<date>\d{4}-\d{2}-\d{2})_(?P<time>\d{2}-\d{2}-\d{2})\."),
+]
+
+def backup_time(blob_name):
+    """When a backup was taken, parsed from its name, or None for anything else under the prefix."""
+    for pattern in BACKUP_NAME_PATTERNS:
+        match = pattern.match(blob_name)
+        if match:
+            date = match.group("date").replace("/", "-")
+            return datetime.strptime(f"{date} {match.group('time')}", "%Y-%m-%d %H-%M-%S")
+    return None
+
+
+def list_prefixes(bucket, prefix):
+    """The immediate "sub-directories" of prefix, plus the names of the objects directly inside it."""
+    iterator = bucket.list_blobs(prefix=prefix, delimiter="/")
+    names, prefixes = [], set()
+    for page in iterator.pages:
+        names.extend(blob.name for blob in page)
+        prefixes.update(page.prefixes)
+    return sorted(prefixes), names
+
+
+def list_backup_candidates(bucket, now, keep_daily):
+    """
+    {blob name: backup time} for every backup that is old enough to be
+    deleted under some policy. Month prefixes that start within the daily
+    window are skipped without being listed.
+    """
+    newest_listed_month = (now - timedelta(days=keep_daily)).strftime("%Y/%m")
+    years, legacy_names = list_prefixes(bucket, BACKUP_PREFIX)
+    names = list(legacy_names)
+    for year_prefix in years:
+        months, _ = list_prefixes(bucket, year_prefix)
+        for month_prefix in months:
+            if month_prefix[len(BACKUP_PREFIX):].rstrip("/") > newest_listed_month:
+                continue
+            names.extend(blob.name for blob in bucket.list_blobs(prefix=month_prefix, fields="items(name),nextPageToken"))
+    return {name: taken for name in names if (taken := backup_time(name)) is not None}
+
+
+def select_backups_to_keep(backups, now, keep_daily, keep_weekly, keep_monthly):
+    """GFS selection over {name: time}. Returns the set of names to keep."""
+    keep = set()
+    newest_per_period = {}
+    for name, taken in sorted(backups.items(), key=lambda item: item[1]):
+        age_days = (now - taken).days
+        periods = []
+        if age_days < keep_daily:
+            periods.append(("day", taken.date()))
+        if age_days < keep_weekly * 7:
+            periods.append(("week", taken.isocalendar()[:2]))
+        if age_days < keep_monthly * 31:
+            periods.append(("month", (taken.year, taken.month)))
+        for period in periods:
+            newest_per_period[period] = name  # sorted oldest first, so the last one wins
+    keep.update(newest_per_period.values())
+    if backups:
+        keep.add(max(backups, key=backups.get))
+    return keep
+
+
+def delete_in_batches(storage_service, names):
+    """
+    Deletes names DELETE_BATCH_SIZE at a time. A batch that reports any error
+    is retried one object at a time to find which deletes failed (an object
+    that is already gone counts as deleted). Returns {name: error} for failures.
+    """
+    bucket = storage_service.bucket()
+    client = storage_service.client()
+    failures = {}
+    for i in range(0, len(names), DELETE_BATCH_SIZE):
+        batch_names = names[i:i + DELETE_BATCH_SIZE]
+        try:
+            with client.batch(raise_exception=True):
+                for name in batch_names:
+                    bucket.blob(name).delete()
+        except Exception:
+            for name in batch_names:
+                try:
+                    storage_service.delete(name)
+                except Exception as e:
+                    failures[name] = e
+    return failures
+
+
+def cleanup_old_backups(storage_service, keep_daily=KEEP_DAILY, keep_weekly=KEEP_WEEKLY, keep_monthly=KEEP_MONTHLY, dry_run=False):
+    """
+    Applies the GFS retention policy to the backups under 'database_backups/'.
+    """
+    print(f"--- Running cleanup task: keeping {keep_daily} daily, {keep_weekly} weekly and {keep_monthly} monthly backups ---")
     try:
-        blobs = bucket.list_blobs(prefix="database_backups/")
         now = datetime.utcnow()
-        for blob in blobs:
-            if blob.time_created:
-                # GCS time_created is timezone-aware, so make 'now' offset-aware for comparison.
-                blob_age = datetime.now(blob.time_created.tzinfo) - blob.time_created
-                if blob_age.days > days_to_keep:
-                    print(f"Deleting old backup: {blob.name} (Age: {blob_age.days} days)")
-                    blob.delete()
-        print("--- Cleanup task complete ---")
+        backups = list_backup_candidates(storage_service.bucket(), now, keep_daily)
+        keep = select_backups_to_keep(backups, now, keep_daily, keep_weekly, keep_monthly)
+        to_delete = sorted(name for name in backups if name not in keep)
+        for name in to_delete:
+            print(f"{'Would delete' if dry_run else 'Deleting'} old backup: {name} (taken {backups[name]:%Y-%m-%d %H:%M})")
+        failures = {} if dry_run else delete_in_batches(storage_service, to_delete)
+        for name, error in sorted(failures.items()):
+            print(f"[WARNING] Could not delete old backup {name}: {error}")
+        deleted = len(to_delete) - len(failures)
+        print(f"--- Cleanup task complete: {len(backups)} backups examined, "
+              f"{deleted} {'would be deleted' if dry_run else 'deleted'}, {len(failures)} failed ---")
     except Exception as e:
         print(f"[WARNING] An error occurred during backup cleanup: {e}")
 
 
+def main():
+    """
+    Main function to run the database backup and upload process.
+    """
+    parser = argparse.ArgumentParser(description="Stream a pg_dump of DATABASE_URL to GCS and apply the retention policy.")
+    parser.add_argument("--format", choices=["custom", "directory"], default=os.environ.get("BACKUP_FORMAT", "custom"),
+                        help="custom: one pg_dump process streamed directly; directory: parallel pg_dump (--jobs) uploaded as a tar.")
+    parser.add_argument("--jobs", type=int, default=int(os.environ.get("BACKUP_JOBS", str(os.cpu_count() or 1))),
+                        help="Parallel pg_dump workers for --format=directory (default: CPU count).")
+    parser.add_argument("--compress", choices=sorted(COMPRESSION_EXTENSIONS), default=os.environ.get("BACKUP_COMPRESSION", "none"),
+                        help="Client-side compression of the dump (default: none, pg_dump compresses its output itself).")
+    parser.add_argument("--level", type=int, help="Compression level for gzip (0-9) or zstd (1-22).")
+    parser.add_argument("--skip-backup", action="store_true", help="Only apply the retention policy.")
+    parser.add_argument("--skip-cleanup", action="store_true", help="Do not apply the retention policy.")
+    parser.add_argument("--dry-run-cleanup", action="store_true", help="List the backups the retention policy would delete.")
+    args = parser.parse_args()
+
+    print("--- Starting database backup process ---")
+
+    # 1. Validate environment variables
+    storage_service = StorageService(GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON)
+    if not DB_URL or not storage_service.configured:
+        print("[ERROR] Missing one or more required environment variables (DATABASE_URL, GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON).")
+        return 1
+
+    try:
+        # 2. Dump and upload in one streaming pass
+        if not args.skip_backup:
+            try:
+                backup_blob, stats = run_backup(storage_service, args.format, args.compress, args.level, max(1, args.jobs))
+            except RuntimeError as e:
+                print(f"[ERROR] {e}")
+                return 1
+
+            seconds = max(stats["seconds"], 1e-6)
+            print(f"--- Successfully uploaded backup to GCS: {backup_blob.name} ---")
+            print(f"pg_dump output: {format_bytes(stats['raw_bytes'])}, stored: {format_bytes(stats['stored_bytes'])}, "
+                  f"sha256: {stats['sha256']}")
+            if "dump_seconds" in stats:
+                print(f"pg_dump took {stats['dump_seconds']:.1f}s, upload {seconds - stats['dump_seconds']:.1f}s")
+            print(f"Took {seconds:.1f}s ({format_bytes(stats['raw_bytes'] / seconds)}/s)")
+
+        # 3. Retention policy
+        if not args.skip_cleanup:
+            cleanup_old_backups(storage_service, dry_run=args.dry_run_cleanup)
+        return 0
+
+    except Exception as e:
+        print(f"[CRITICAL] An unexpected error occurred during the backup process: {e}")
+        return 1
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from search import SEARCH_CONFIG, build_prefix_tsquery
+
+# --- Configuration ---
+# Compares the old five-way ILIKE collection search with the tsvector/GIN
+# search added in migration 2, on a synthetic collection built in a throwaway
+# schema (dropped afterwards, so the real antiques table is never touched).
+DB_URL = os.environ.get("DATABASE_URL")
+NUM_ITEMS = int(os.environ.get("BENCH_NUM_ITEMS", "100000"))
+NUM_RUNS = int(os.environ.get("BENCH_NUM_RUNS", "20"))
+BENCH_SCHEMA = "bench_collection_search"
+
+# Typed one keystroke at a time, as the collection search box sends them.
+SEARCH_TERMS = ["ir", "iron", "iron cro", "victorian clock", "oak", "porcelain vase", "georgian silver"]
+
+WORDS = {
+    "name": ["Iron", "Oak", "Silver", "Brass", "Porcelain", "Mahogany", "Pewter", "Glass", "Walnut", "Copper"],
+    "noun": ["Cross", "Clock", "Vase", "Chair", "Candlestick", "Mirror", "Chest", "Teapot", "Bureau", "Lamp"],
+    "item_type": ["Furniture", "Ceramics", "Metalware", "Clocks", "Glassware", "Textiles", "Jewellery", "Books"],
+    "period": ["Georgian", "Victorian", "Edwardian", "Regency", "Art Deco", "Tudor", "Stuart", "Mid-century"],
+}
+
+ILIKE_SQL = f"""
+    SELECT id FROM {BENCH_SCHEMA}.antiques
+    WHERE user_id = 1 AND (name ILIKE %(term)s OR description ILIKE %(term)s OR item_type ILIKE %(term)s
+                           OR period ILIKE %(term)s OR provenance ILIKE %(term)s)
+    ORDER BY created_at DESC
+"""
+TSVECTOR_SQL = f"""
+    SELECT id FROM {BENCH_SCHEMA}.antiques
+    WHERE user_id = 1 AND search_vector @@ to_tsquery('{SEARCH_CONFIG}', %(tsquery)s)
+    ORDER BY ts_rank(search_vector, to_tsquery('{SEARCH_CONFIG}', %(tsquery)s)) DESC, created_at DESC
+"""
+
+
+def array_literal(words):
+    return "ARRAY[" + ", ".join(f"'{word}'" for word in words) + "]"
+
+
+def create_synthetic_collection(cur):
+    cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    cur.execute(f"""
+        CREATE TABLE {BENCH_SCHEMA}.antiques (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            description TEXT,
+            item_type VARCHAR(100),
+            period VARCHAR(100),
+            provenance TEXT,
+            user_id INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    names, nouns = array_literal(WORDS["name"]), array_literal(WORDS["noun"])
+    types, periods = array_literal(WORDS["item_type"]), array_literal(WORDS["period"])
+    cur.execute(f"""
+        INSERT INTO {BENCH_SCHEMA}.antiques (name, description, item_type, period, provenance, created_at)
+        SELECT
+            ({names})[1 + i % 10] || ' ' || ({nouns})[1 + (i / 10) % 10] || ' #' || i,
+            'A ' || lower(({periods})[1 + (i / 7) % 8]) || ' ' || lower(({nouns})[1 + (i / 3) % 10])
+                || ' in good condition with light wear consistent with age. Lot ' || md5(i::text),
+            ({types})[1 + i % 8],
+            ({periods})[1 + (i / 7) % 8],
+            'Acquired at auction, estate of ' || md5((i * 31)::text),
+            NOW() - (i || ' minutes')::interval
+        FROM generate_series(1, %s) AS i
+    """, (NUM_ITEMS,))
+    # Same definition as migration 2 in migrate.py.
+    cur.execute(f"""
+        ALTER TABLE {BENCH_SCHEMA}.antiques ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(item_type, '') || ' ' || coalesce(period, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(description, '') || ' ' || coalesce(provenance, '')), 'C')
+        ) STORED
+    """)
+    cur.execute(f"CREATE INDEX ON {BENCH_SCHEMA}.antiques (user_id, created_at DESC)")
+    cur.execute(f"CREATE INDEX ON {BENCH_SCHEMA}.antiques USING GIN (search_vector)")
+    cur.execute(f"ANALYZE {BENCH_SCHEMA}.antiques")
+
+
+def time_query(cur, sql, params):
+    samples = []
+    rows = 0
+    for _ in range(NUM_RUNS):
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        rows = len(cur.fetchall())
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), rows
+
+
+def main():
+    if not DB_URL:
+        print("[ERROR] DATABASE_URL environment variable is not set.")
+        return 1
+
+    conn = psycopg2.connect(DB_URL)
+    try:
+        with conn.cursor() as cur:
+            print(f"--- Building synthetic collection of {NUM_ITEMS} items in schema '{BENCH_SCHEMA}' ---")
+            started = time.perf_counter()
+            create_synthetic_collection(cur)
+            conn.commit()
+            print(f"Built in {time.perf_counter() - started:.1f}s")
+
+            print(f"--- Median of {NUM_RUNS} runs per term ---")
+            print(f"{'term':<18} {'ilike':>10} {'rows':>7} {'tsvector':>10} {'rows':>7} {'speedup':>8}")
+            for term in SEARCH_TERMS:
+                ilike_ms, ilike_rows = time_query(cur, ILIKE_SQL, {"term": f"%{term}%"})
+                ts_ms, ts_rows = time_query(cur, TSVECTOR_SQL, {"tsquery": build_prefix_tsquery(term)})
+                print(f"{term:<18} {ilike_ms:>8.2f}ms {ilike_rows:>7} {ts_ms:>8.2f}ms {ts_rows:>7} {ilike_ms / ts_ms:>7.1f}x")
+            # Row counts differ by design: ILIKE matches substrings anywhere (and
+            # the whole phrase), the tsvector path matches word prefixes in any order.
+    finally:
+        with conn.cursor() as cur:
+            conn.rollback()
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import io
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import rsa
+from google.cloud import storage
+
+from gcs_storage import StorageService
+
+# --- Configuration ---
+# Compares the per-call cost of the old GCS helpers (a new storage.Client,
+# parsed from the service account JSON, for every upload/exists/delete/sign)
+# with the shared StorageService. Both run against a small in-process fake of
+# the GCS JSON API and OAuth token endpoint, so no bucket or network access is
+# needed; the numbers show client construction, token fetches and connection
+# setup rather than GCS latency. Set BENCH_GCS_EMULATOR_HOST to send the storage
+# calls to an external emulator such as fake-gcs-server instead (it must accept
+# any bearer token); the fake server then only issues tokens.
+NUM_RUNS = int(os.environ.get("BENCH_NUM_RUNS", "50"))
+PAYLOAD_BYTES = int(os.environ.get("BENCH_PAYLOAD_BYTES", str(64 * 1024)))
+EXTERNAL_EMULATOR_HOST = os.environ.get("BENCH_GCS_EMULATOR_HOST")
+BUCKET_NAME = "bench-gcs-client"
+
+OPERATIONS = ["upload", "exists", "signed_url", "delete"]
+
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    """Just enough of the GCS JSON API for resumable uploads, object metadata and deletes."""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.counters["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _resource(self, name):
+        size = len(self.server.objects[name])
+        return {"kind": "storage#object", "bucket": BUCKET_NAME, "name": name, "size": str(size), "generation": "1"}
+
+    def _object_name(self, path):
+        match = re.match(r"^/storage/v1/b/[^/]+/o/(.+)$", path)
+        return unquote(match.group(1)) if match else None
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        if url.path == "/token":
+            with self.server.lock:
+                self.server.counters["token_requests"] += 1
+            return self._reply(200, {"access_token": uuid.uuid4().hex, "expires_in": 3600, "token_type": "Bearer"})
+        if url.path.startswith("/upload/storage/v1/b/") and parse_qs(url.query).get("uploadType") == ["resumable"]:
+            name = json.loads(body or b"{}").get("name") or parse_qs(url.query).get("name", [""])[0]
+            session_id = uuid.uuid4().hex
+            self.server.sessions[session_id] = name
+            host = self.headers.get("Host")
+            return self._reply(200, headers={"Location": f"http://{host}/upload/session/{session_id}"})
+        self._reply(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        session_id = url.path.rsplit("/", 1)[-1]
+        name = self.server.sessions.pop(session_id, None)
+        if name is None:
+            return self._reply(404, {"error": {"code": 404, "message": "No such upload"}})
+        self.server.objects[name] = body
+        self._reply(200, self._resource(name))
+
+    def do_GET(self):
+        name = self._object_name(urlparse(self.path).path)
+        if name in self.server.objects:
+            return self._reply(200, self._resource(name))
+        self._reply(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_DELETE(self):
+        name = self._object_name(urlparse(self.path).path)
+        if self.server.objects.pop(name, None) is None:
+            return self._reply(404, {"error": {"code": 404, "message": "Not Found"}})
+        self._reply(204)
+
+
+def start_fake_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGCSHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.objects, server.sessions = {}, {}
+    server.counters = {"connections": 0, "token_requests": 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def fake_service_account_json(token_uri):
+    """A throwaway service account whose key is generated locally, so signing and token refresh run for real."""
+    _, private_key = rsa.newkeys(2048)
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "bench-project",
+        "private_key_id": uuid.uuid4().hex,
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": "bench@bench-project.iam.gserviceaccount.com",
+        "client_id": "1",
+        "token_uri": token_uri,
+    })
+
+
+class PerCallClient:
+    """The old helpers: every call builds its own client from the service account JSON."""
+    def __init__(self, credentials_json, emulator_host):
+        self.credentials_json = credentials_json
+        self.emulator_host = emulator_host
+
+    def _blob(self, blob_name):
+        client = storage.Client.from_service_account_info(
+            json.loads(self.credentials_json), client_options={"api_endpoint": self.emulator_host}
+        )
+        return client.bucket(BUCKET_NAME).blob(blob_name)
+
+    def upload_file(self, file_obj, blob_name, content_type=None):
+        self._blob(blob_name).upload_from_file(file_obj, content_type=content_type)
+
+    def exists(self, blob_name):
+        return self._blob(blob_name).exists()
+
+    def signed_url(self, blob_name):
+        return self._blob(blob_name).generate_signed_url(version="v4", expiration=900, method="GET")
+
+    def delete(self, blob_name):
+        blob = self._blob(blob_name)
+        if blob.exists():
+            blob.delete()
+
+
+def run(service, payload):
+    timings = {operation: [] for operation in OPERATIONS}
+    for _ in range(NUM_RUNS):
+        blob_name = f"{uuid.uuid4().hex}.bin"
+        for operation in OPERATIONS:
+            started = time.perf_counter()
+            if operation == "upload":
+                service.upload_file(io.BytesIO(payload), blob_name, content_type="application/octet-stream")
+            else:
+                getattr(service, operation)(blob_name)
+            timings[operation].append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(label, timings, counters):
+    print(f"{label}:")
+    for operation in OPERATIONS:
+        samples = sorted(timings[operation])
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        print(f"  {operation:<11} median {statistics.median(samples):7.2f} ms   p95 {p95:7.2f} ms")
+    print(f"  {counters['connections']} connections, {counters['token_requests']} token requests")
+
+
+def main():
+    server, fake_host = start_fake_server()
+    emulator_host = EXTERNAL_EMULATOR_HOST.rstrip("/") if EXTERNAL_EMULATOR_HOST else fake_host
+    token_uri = f"{fake_host}/token"
+    print(f"--- Storage calls go to {emulator_host} ---")
+
+    credentials_json = fake_service_account_json(token_uri)
+    payload = os.urandom(PAYLOAD_BYTES)
+    print(f"{NUM_RUNS} runs of upload ({PAYLOAD_BYTES} bytes), exists, signed_url and delete per mode")
+
+    def snapshot():
+        with server.lock:
+            return dict(server.counters)
+
+    def delta(before):
+        after = snapshot()
+        return {key: after[key] - before[key] for key in after}
+
+    try:
+        before = snapshot()
+        per_call = run(PerCallClient(credentials_json, emulator_host), payload)
+        report("New client per call", per_call, delta(before))
+
+        before = snapshot()
+        shared = run(StorageService(BUCKET_NAME, credentials_json, emulator_host=emulator_host), payload)
+        report("Shared StorageService", shared, delta(before))
+    finally:
+        server.shutdown()
+
+    total_before = sum(statistics.median(per_call[operation]) for operation in OPERATIONS)
+    total_after = sum(statistics.median(shared[operation]) for operation in OPERATIONS)
+    print(f"--- Median per upload/exists/sign/delete cycle: {total_before:.2f} ms -> {total_after:.2f} ms "
+          f"({total_before / total_after:.1f}x) ---")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from job_store import MemoryJobStore, SQLiteJobStore, PostgresJobStore
+
+# --- Configuration ---
+# Benchmarks status-poll latency (JobStore.get) for each backend.
+# The Postgres backend is only measured when DATABASE_URL is set and the
+# oracle_jobs table exists (see create_tables.py).
+DB_URL = os.environ.get("DATABASE_URL")
+NUM_JOBS = int(os.environ.get("BENCH_NUM_JOBS", "1000"))
+NUM_POLLS = int(os.environ.get("BENCH_NUM_POLLS", "5000"))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def bench_store(name, store):
+    job_ids = [str(uuid.uuid4()) for _ in range(NUM_JOBS)]
+    for job_id in job_ids:
+        store.create(job_id)
+    for job_id in job_ids[::2]:
+        store.update(job_id, "complete", "The Oracle has spoken. " * 20)
+
+    samples = []
+    for i in range(NUM_POLLS):
+        job_id = job_ids[i % NUM_JOBS]
+        started = time.perf_counter()
+        store.get(job_id)
+        samples.append((time.perf_counter() - started) * 1000)
+
+    for job_id in job_ids:
+        store.delete(job_id)
+
+    print(f"{name:<10} polls={NUM_POLLS:<6} mean={statistics.mean(samples):.3f}ms "
+          f"p50={percentile(samples, 50):.3f}ms p95={percentile(samples, 95):.3f}ms p99={percentile(samples, 99):.3f}ms")
+
+
+def main():
+    print(f"--- Oracle job store status-poll benchmark ({NUM_JOBS} jobs) ---")
+    ttl_seconds, max_jobs = 3600, NUM_JOBS * 2
+
+    bench_store("memory", MemoryJobStore(ttl_seconds, max_jobs))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench_store("sqlite", SQLiteJobStore(os.path.join(tmp_dir, "jobs.sqlite3"), ttl_seconds, max_jobs))
+
+    if not DB_URL:
+        print("DATABASE_URL not set; skipping the Postgres backend.")
+        return
+    try:
+        import psycopg2
+        conn = psycopg2.connect(DB_URL)
+    except Exception as e:
+        print(f"[WARNING] Could not connect to Postgres, skipping: {e}")
+        return
+    try:
+        bench_store("postgres", PostgresJobStore(lambda: conn, lambda _conn: None, ttl_seconds, max_jobs))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from search import SEARCH_CONFIG, HEADLINE_OPTIONS, build_prefix_tsquery
+
+# --- Configuration ---
+# Times the note full-text search query used by /api/notes/fulltext (ranking
+# plus ts_headline snippets for one page) against a synthetic set of Editor.js
+# notes built in a throwaway schema. Requires migration 3 (for the
+# note_plain_text() function); run `python migrate.py up` first.
+DB_URL = os.environ.get("DATABASE_URL")
+NUM_NOTES = int(os.environ.get("BENCH_NUM_NOTES", "30000"))
+NUM_RUNS = int(os.environ.get("BENCH_NUM_RUNS", "20"))
+PAGE_SIZE = 20
+TARGET_MS = 50
+BENCH_SCHEMA = "bench_note_search"
+
+SEARCH_TERMS = ["garden", "roses prun", "tomato", "winter bulb", "compost heap", "ledger"]
+
+TOPICS = ["garden", "roses", "tomatoes", "compost", "orchard", "greenhouse", "ledger", "workshop", "library", "kitchen"]
+VERBS = ["pruning", "planting", "repairing", "cataloguing", "harvesting", "sorting", "mending", "recording"]
+SEASONS = ["spring", "summer", "autumn", "winter"]
+
+SEARCH_SQL = f"""
+    WITH query AS (SELECT to_tsquery('{SEARCH_CONFIG}', %(tsquery)s) AS q),
+    hits AS (
+        SELECT n.id, n.title, n.content, n.updated_at, ts_rank_cd(n.search_vector, query.q) AS rank
+        FROM {BENCH_SCHEMA}.notes n, query
+        WHERE n.user_id = 1 AND n.search_vector @@ query.q
+        ORDER BY rank DESC, n.updated_at DESC
+        LIMIT %(limit)s
+    )
+    SELECT hits.id, hits.title, ts_headline('{SEARCH_CONFIG}', note_plain_text(hits.content), query.q, %(options)s)
+    FROM hits, query
+    ORDER BY hits.rank DESC, hits.updated_at DESC
+"""
+
+
+def array_literal(words):
+    return "ARRAY[" + ", ".join(f"'{word}'" for word in words) + "]"
+
+
+def create_synthetic_notes(cur):
+    cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    # Same search_vector definition as migration 3 in migrate.py.
+    cur.execute(f"""
+        CREATE TABLE {BENCH_SCHEMA}.notes (
+            id SERIAL PRIMARY KEY,
+            title VARCHAR(255) NOT NULL,
+            content JSONB,
+            user_id INTEGER NOT NULL DEFAULT 1,
+            updated_at TIMESTAMPTZ DEFAULT NOW(),
+            search_vector tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', note_plain_text(content)), 'B')
+            ) STORED
+        )
+    """)
+    topics, verbs, seasons = array_literal(TOPICS), array_literal(VERBS), array_literal(SEASONS)
+    cur.execute(f"""
+        INSERT INTO {BENCH_SCHEMA}.notes (title, content, updated_at)
+        SELECT
+            initcap(({topics})[1 + i % 10]) || ' notes ' || i,
+            jsonb_build_object('time', 0, 'version', '2.28.0', 'blocks', jsonb_build_array(
+                jsonb_build_object('type', 'header', 'data', jsonb_build_object(
+                    'level', 2, 'text', initcap(({seasons})[1 + i % 4]) || ' ' || ({topics})[1 + (i / 10) % 10])),
+                jsonb_build_object('type', 'paragraph', 'data', jsonb_build_object(
+                    'text', 'Spent the morning <b>' || ({verbs})[1 + i % 8] || '</b> in the ' || ({topics})[1 + (i / 3) % 10]
+                            || '. Reference ' || md5(i::text) || ' &amp; more to follow.')),
+                jsonb_build_object('type', 'list', 'data', jsonb_build_object('style', 'unordered', 'items', jsonb_build_array(
+                    ({verbs})[1 + (i / 5) % 8] || ' the ' || ({topics})[1 + (i / 7) % 10],
+                    'check the ' || ({seasons})[1 + (i / 11) % 4] || ' bulbs')))
+            )),
+            NOW() - (i || ' minutes')::interval
+        FROM generate_series(1, %s) AS i
+    """, (NUM_NOTES,))
+    cur.execute(f"CREATE INDEX ON {BENCH_SCHEMA}.notes USING GIN (search_vector)")
+    cur.execute(f"ANALYZE {BENCH_SCHEMA}.notes")
+
+
+def main():
+    if not DB_URL:
+        print("[ERROR] DATABASE_URL environment variable is not set.")
+        return 1
+
+    conn = psycopg2.connect(DB_URL)
+    slow_terms = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regprocedure('note_plain_text(jsonb)') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                print("[ERROR] note_plain_text() is missing; run `python migrate.py up` first.")
+                return 1
+
+            print(f"--- Building {NUM_NOTES} synthetic notes in schema '{BENCH_SCHEMA}' ---")
+            started = time.perf_counter()
+            create_synthetic_notes(cur)
+            conn.commit()
+            print(f"Built in {time.perf_counter() - started:.1f}s")
+
+            print(f"--- Median / p95 of {NUM_RUNS} runs per term (page of {PAGE_SIZE}, target {TARGET_MS}ms) ---")
+            for term in SEARCH_TERMS:
+                params = {"tsquery": build_prefix_tsquery(term), "limit": PAGE_SIZE, "options": HEADLINE_OPTIONS}
+                samples = []
+                for _ in range(NUM_RUNS):
+                    started = time.perf_counter()
+                    cur.execute(SEARCH_SQL, params)
+                    rows = len(cur.fetchall())
+                    samples.append((time.perf_counter() - started) * 1000)
+                p95 = sorted(samples)[int(0.95 * (len(samples) - 1))]
+                slow_terms += p95 > TARGET_MS
+                print(f"{term:<14} rows={rows:<3} median={statistics.median(samples):7.2f}ms p95={p95:7.2f}ms "
+                      f"{'OK' if p95 <= TARGET_MS else 'SLOW'}")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+    return 1 if slow_terms else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import io
+import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import matplotlib
+matplotlib.use('Agg') # Use a non-interactive backend
+import matplotlib.dates as mdates
+import matplotlib.style
+from matplotlib.figure import Figure
+from cachetools import LRUCache
+from PIL import Image, ImageDraw
+
+# --- Chart Rendering ---
+# Each renderer takes plain Python data and returns PNG bytes, so the output
+# can be cached and served from its own image endpoint. They use the
+# object-oriented Figure API rather than pyplot's global state, and normally
+# run inside ChartRenderer's worker processes.
+
+BG_COLOR, TEXT_COLOR, BAR_COLOR, LINE_COLOR, GRID_COLOR = '#FDFDF6', '#2d3748', '#4B0082', '#C59B08', '#e2e8f0'
+CHART_STYLE = 'seaborn-v0_8-whitegrid'
+
+def render_calorie_chart(dates, calories):
+    """Bar chart of total calories per day with the 2000 kcal target line."""
+    with matplotlib.style.context(CHART_STYLE):
+        fig = Figure(figsize=(12, 6))
+        ax = fig.subplots()
+        fig.patch.set_facecolor(BG_COLOR)
+        ax.set_facecolor(BG_COLOR)
+        ax.bar(dates, calories, color=BAR_COLOR, width=0.6, label='Total Daily Calories')
+        ax.axhline(y=2000, color=LINE_COLOR, linestyle='--', linewidth=2, label='2000 Calorie Target')
+        ax.set_title('Total Daily Calories for the Last 30 Days', fontsize=16, fontweight='bold', color=TEXT_COLOR, pad=20)
+        ax.set_xlabel('Date', fontsize=12, color=TEXT_COLOR, labelpad=10)
+        ax.set_ylabel('Total Calories', fontsize=12, color=TEXT_COLOR, labelpad=10)
+        ax.tick_params(axis='x', colors=TEXT_COLOR, rotation=45)
+        ax.tick_params(axis='y', colors=TEXT_COLOR)
+        ax.grid(color=GRID_COLOR)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
+        ax.xaxis.set_major_locator(mdates.DayLocator(interval=3))
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+        ax.spines['top'].set_visible(False); ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_color(GRID_COLOR); ax.spines['bottom'].set_color(GRID_COLOR)
+        ax.legend(frameon=False, loc='upper left', bbox_to_anchor=(0, 1.1))
+        fig.tight_layout()
+
+        img = io.BytesIO()
+        fig.savefig(img, format='png')
+    return img.getvalue()
+
+def render_value_chart(labels, values, title, ylabel):
+    """Horizontal bar chart of approximate collection value per category."""
+    with matplotlib.style.context(CHART_STYLE):
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
+        fig.patch.set_facecolor(BG_COLOR)
+        ax.set_facecolor(BG_COLOR)
+        ax.barh(labels, values, color=BAR_COLOR)
+        ax.set_title(title, fontsize=16, color=TEXT_COLOR, pad=20)
+        ax.set_xlabel('Total Approximate Value (£)', color=TEXT_COLOR)
+        ax.set_ylabel(ylabel, color=TEXT_COLOR)
+        ax.tick_params(colors=TEXT_COLOR)
+        ax.spines['top'].set_visible(False); ax.spines['right'].set_visible(False)
+        fig.tight_layout()
+
+        img = io.BytesIO()
+        fig.savefig(img, format='png', bbox_inches='tight')
+    return img.getvalue()
+
+def render_placeholder(message="Chart is busy rendering. Refresh in a moment."):
+    """Small PNG served when a chart cannot be rendered in time."""
+    image = Image.new('RGB', (600, 120), BG_COLOR)
+    ImageDraw.Draw(image).text((20, 50), message, fill=TEXT_COLOR)
+    img = io.BytesIO()
+    image.save(img, format='PNG')
+    return img.getvalue()
+
+
+# --- Chart Renderer ---
+class ChartRenderer:
+    """
+    Runs chart renderers in a small process pool so Matplotlib work neither
+    holds the web worker's GIL nor shares pyplot state between threads.
+    At most max_pending renders may be queued or running; beyond that, and
+    whenever a render exceeds the timeout, the placeholder image is returned.
+    """
+    def __init__(self, max_workers, max_pending, timeout):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._pid = None
+        self._placeholder = None
+        self._counters = {"rendered": 0, "timeouts": 0, "rejected": 0, "failed": 0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # 'spawn' keeps the renderer processes independent of the threaded web worker's state.
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+    def placeholder(self):
+        if self._placeholder is None:
+            self._placeholder = render_placeholder()
+        return self._placeholder
+
+    def render(self, renderer, *args):
+        """Returns (png_bytes, rendered); rendered is False when the placeholder was used."""
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            return self.placeholder(), False
+        try:
+            future = self._get_executor().submit(renderer, *args)
+        except Exception:
+            self._slots.release()
+            self._reset_executor()
+            self._count("failed")
+            return self.placeholder(), False
+        # The slot stays taken until the process finishes, even if we stop waiting for it.
+        future.add_done_callback(lambda _future: self._slots.release())
+
+        try:
+            png = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._count("timeouts")
+            return self.placeholder(), False
+        except BrokenProcessPool:
+            self._reset_executor()
+            self._count("failed")
+            return self.placeholder(), False
+        self._count("rendered")
+        return png, True
+
+    def shutdown(self):
+        if self._pid == os.getpid():
+            self._reset_executor()
+
+    def stats(self):
+        with self._lock:
+            return {"max_workers": self.max_workers, "max_pending": self.max_pending, "timeout_seconds": self.timeout, **self._counters}
+
+
+# --- Chart Cache ---
+class ChartCache:
+    """
+    LRU cache of rendered PNGs, bounded by total bytes. Keys are
+    (chart_name, fingerprint) pairs where the fingerprint summarises the rows
+    the chart was drawn from, so changed data never hits a stale image.
+    """
+    def __init__(self, max_bytes):
+        self._lock = threading.Lock()
+        self._cache = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self._counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, chart_name, fingerprint):
+        with self._lock:
+            png = self._cache.get((chart_name, fingerprint))
+            self._counters["hits" if png is not None else "misses"] += 1
+            return png
+
+    def put(self, chart_name, fingerprint, png):
+        with self._lock:
+            try:
+                self._cache[(chart_name, fingerprint)] = png
+            except ValueError:
+                pass # Larger than the whole cache; serve it uncached.
+
+    def invalidate(self, prefix):
+        """Drops every cached chart whose name starts with prefix (e.g. 'food_log')."""
+        with self._lock:
+            for key in [key for key in self._cache if key[0].startswith(prefix)]:
+                del self._cache[key]
+            self._counters["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._cache), "bytes": self._cache.currsize, "max_bytes": self._cache.maxsize, **self._counters}
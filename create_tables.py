@@ -89,6 +89,10 @@ try:
     cur.execute(create_food_log_script)
     print("Table 'food_log' created successfully.")
 
+    # food_log rows are edited in place; updated_at lets cached charts detect it.
+    cur.execute("ALTER TABLE food_log ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();")
+    print("Column 'food_log.updated_at' checked/added successfully.")
+
     create_antiques_script = """
     CREATE TABLE IF NOT EXISTS antiques (
         id SERIAL PRIMARY KEY,
@@ -155,6 +159,16 @@ try:
     cur.execute(create_log_attachments_script)
     print("Table 'log_attachments' created successfully.")
 
+    # Keyset pagination on the logs page walks (log_time, id) newest first,
+    # optionally filtered by log_type; attachments are looked up per page.
+    create_logs_indexes_script = """
+    CREATE INDEX IF NOT EXISTS idx_logs_user_time_id ON logs (user_id, log_time DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_logs_user_type_time_id ON logs (user_id, log_type, log_time DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_log_attachments_log_id ON log_attachments (log_id);
+    """
+    cur.execute(create_logs_indexes_script)
+    print("Indexes for 'logs' pagination created successfully.")
+
     # --- NEW: Table for generic file uploads ---
     create_files_script = """
     CREATE TABLE IF NOT EXISTS files (
@@ -171,6 +185,20 @@ try:
     cur.execute(create_files_script)
     print("Table 'files' created successfully.")
 
+    # --- NEW: Shared status store for background Oracle chat jobs ---
+    create_oracle_jobs_script = """
+    CREATE TABLE IF NOT EXISTS oracle_jobs (
+        job_id TEXT PRIMARY KEY,
+        status VARCHAR(20) NOT NULL,
+        reply TEXT,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_oracle_jobs_expires_at ON oracle_jobs (expires_at);
+    """
+    cur.execute(create_oracle_jobs_script)
+    print("Table 'oracle_jobs' created successfully.")
+
 
     conn.commit()
     cur.close()
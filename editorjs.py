@@ -0,0 +1,241 @@
+import html
+import re
+import threading
+from html.parser import HTMLParser
+
+from cachetools import LRUCache
+
+# --- Editor.js Document Helpers ---
+# Notes store Editor.js output ({"time", "blocks", "version"}) in notes.content.
+# Older notes may still hold a bare Markdown string, so every helper here
+# accepts either form.
+
+REFERENCE_PATTERN = re.compile(r'\[\[(.*?)\]\]')
+SNQL_REF_PATTERN = re.compile(r'snql-ref:([0-9a-fA-F\-]{36})')
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+
+def iter_block_text(content):
+    """
+    Yields every piece of user-written text in a note: block text, captions,
+    list items (including nested lists and checklists) and table cells.
+    Mirrors the note_plain_text() SQL function used for full-text search.
+    """
+    if isinstance(content, str):
+        yield content
+        return
+    if not isinstance(content, dict):
+        return
+    for block in content.get('blocks') or []:
+        data = block.get('data') if isinstance(block, dict) else None
+        if not isinstance(data, dict):
+            continue
+        for key in ('text', 'caption'):
+            if isinstance(data.get(key), str):
+                yield data[key]
+        for key in ('items', 'content'):
+            yield from _iter_strings(data.get(key))
+
+def _iter_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, list):
+        for item in value:
+            yield from _iter_strings(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _iter_strings(item)
+
+def extract_references(content):
+    """Returns (titles, guids): the [[Title]] and snql-ref:<guid> targets linked from a note."""
+    titles, guids = set(), set()
+    for text in iter_block_text(content):
+        for title in REFERENCE_PATTERN.findall(text):
+            # Block text is HTML, so "[[Tea &amp; <b>Cake</b>]]" refers to the note "Tea & Cake".
+            title = html.unescape(HTML_TAG_PATTERN.sub('', title)).strip()
+            if title:
+                titles.add(title)
+        guids.update(guid.lower() for guid in SNQL_REF_PATTERN.findall(text))
+    return titles, guids
+
+
+# --- HTML Rendering ---
+# Server-side counterpart of the Editor.js read view, for read-only pages and
+# exports. Block text is Editor.js inline HTML (<b>, <i>, <a>, <mark>, ...).
+# Stored content is not trusted to come from the editor, so it is reduced to
+# INLINE_TAGS, without attributes except a link's href (checked by safe_url);
+# everything else (code, URLs, structure) is escaped here.
+
+SAFE_URL_PATTERN = re.compile(r'^(https?:|mailto:|/|#)', re.IGNORECASE)
+SNQL_REF_HREF_PATTERN = re.compile(r'href="snql-ref:([0-9a-fA-F\-]{36})"')
+INLINE_TAGS = {'b', 'i', 'u', 'mark', 'code', 'br', 'a'}
+# Tags dropped together with their content rather than just unwrapped.
+DROPPED_CONTENT_TAGS = {'script', 'style', 'template', 'textarea', 'title', 'iframe', 'object', 'noscript'}
+
+def safe_url(url):
+    url = (url or '').strip()
+    return html.escape(url) if SAFE_URL_PATTERN.match(url) else '#'
+
+class _InlineHTMLSanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.open_tags = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_CONTENT_TAGS:
+            self.skip_depth += 1
+        elif self.skip_depth or tag not in INLINE_TAGS:
+            return
+        elif tag == 'br':
+            self.parts.append('<br>')
+        else:
+            if tag == 'a':
+                href = (dict(attrs).get('href') or '').strip()
+                # snql-ref:<guid> links are rewritten to note URLs by render_references.
+                href = href if SNQL_REF_PATTERN.fullmatch(href) else safe_url(href)
+                self.parts.append(f'<a href="{href}">')
+            else:
+                self.parts.append(f'<{tag}>')
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_CONTENT_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif not self.skip_depth and tag in self.open_tags:
+            while self.open_tags:
+                open_tag = self.open_tags.pop()
+                self.parts.append(f'</{open_tag}>')
+                if open_tag == tag:
+                    break
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(html.escape(data, quote=False))
+
+def sanitize_inline_html(text):
+    """Keeps only INLINE_TAGS (a with a safe href, nothing else with attributes); other tags are dropped."""
+    sanitizer = _InlineHTMLSanitizer()
+    sanitizer.feed(text or '')
+    sanitizer.close()
+    return ''.join(sanitizer.parts) + ''.join(f'</{tag}>' for tag in reversed(sanitizer.open_tags))
+
+def render_references(text, resolve_reference):
+    """
+    Turns [[Title]] and snql-ref:<guid> references into links to the notes they
+    name. resolve_reference(kind, key) with kind 'title' or 'guid' returns
+    (url, title) or None; unresolved references are marked as broken.
+    """
+    def link_or_broken(target, label):
+        if target is None:
+            return f'<span class="note-link-broken">[[{label}]]</span>'
+        return f'<a class="note-link" href="{html.escape(target[0])}">{html.escape(target[1])}</a>'
+
+    def replace_href(match):
+        target = resolve_reference('guid', match.group(1).lower())
+        return f'href="{html.escape(target[0])}"' if target else 'href="#"'
+
+    def replace_title(match):
+        title = html.unescape(HTML_TAG_PATTERN.sub('', match.group(1))).strip()
+        return link_or_broken(resolve_reference('title', title), html.escape(title))
+
+    def replace_guid(match):
+        return link_or_broken(resolve_reference('guid', match.group(1).lower()), 'Unknown Note')
+
+    text = SNQL_REF_HREF_PATTERN.sub(replace_href, text)
+    text = REFERENCE_PATTERN.sub(replace_title, text)
+    return SNQL_REF_PATTERN.sub(replace_guid, text)
+
+def _render_list_items(items, tag, resolve):
+    parts = [f'<{tag}>']
+    for item in items or []:
+        if isinstance(item, str):
+            parts.append(f'<li>{resolve(item)}</li>')
+            continue
+        if not isinstance(item, dict):
+            continue
+        text = item.get('content', item.get('text', ''))
+        checked = (item.get('meta') or {}).get('checked', item.get('checked'))
+        box = '' if checked is None else f'<input type="checkbox" disabled{" checked" if checked else ""}> '
+        nested = _render_list_items(item['items'], tag, resolve) if item.get('items') else ''
+        parts.append(f'<li>{box}{resolve(text)}{nested}</li>')
+    parts.append(f'</{tag}>')
+    return ''.join(parts)
+
+def render_block(block, resolve):
+    block_type, data = block.get('type'), block.get('data') or {}
+    if block_type == 'header':
+        level = data.get('level') if data.get('level') in (1, 2, 3, 4, 5, 6) else 2
+        return f'<h{level}>{resolve(data.get("text", ""))}</h{level}>'
+    if block_type == 'paragraph':
+        return f'<p>{resolve(data.get("text", ""))}</p>'
+    if block_type in ('list', 'checklist'):
+        tag = 'ol' if data.get('style') == 'ordered' else 'ul'
+        return _render_list_items(data.get('items'), tag, resolve)
+    if block_type == 'quote':
+        caption = f'<figcaption>{resolve(data["caption"])}</figcaption>' if data.get('caption') else ''
+        return f'<figure class="note-quote"><blockquote>{resolve(data.get("text", ""))}</blockquote>{caption}</figure>'
+    if block_type == 'code':
+        return f'<pre><code>{html.escape(data.get("code", ""))}</code></pre>'
+    if block_type == 'table':
+        rows = data.get('content') or []
+        parts = ['<table>']
+        for index, row in enumerate(rows):
+            cell = 'th' if index == 0 and data.get('withHeadings') else 'td'
+            parts.append('<tr>' + ''.join(f'<{cell}>{resolve(value if isinstance(value, str) else "")}</{cell}>' for value in row) + '</tr>')
+        parts.append('</table>')
+        return ''.join(parts)
+    if block_type == 'delimiter':
+        return '<hr>'
+    if block_type == 'linkTool':
+        meta = data.get('meta') or {}
+        title = html.escape(meta.get('title') or data.get('link', ''))
+        return f'<p class="note-link-card"><a href="{safe_url(data.get("link"))}" rel="noopener">{title}</a></p>'
+    if block_type == 'image':
+        url = (data.get('file') or {}).get('url') or data.get('url')
+        caption = f'<figcaption>{resolve(data["caption"])}</figcaption>' if data.get('caption') else ''
+        return f'<figure><img src="{safe_url(url)}" alt="" loading="lazy">{caption}</figure>'
+    # Unknown block types fall back to whatever text they carry.
+    return f'<p>{resolve(data["text"])}</p>' if isinstance(data.get('text'), str) else ''
+
+def render_note_html(content, resolve_reference, render_markdown):
+    """
+    Renders a note's content to HTML. Editor.js documents are rendered block by
+    block; legacy notes stored as a Markdown string go through render_markdown.
+    """
+    if isinstance(content, str):
+        return render_references(render_markdown(content), resolve_reference)
+    if not isinstance(content, dict):
+        return ''
+    resolve = lambda text: render_references(sanitize_inline_html(text), resolve_reference)
+    return '\n'.join(render_block(block, resolve) for block in content.get('blocks') or [] if isinstance(block, dict))
+
+
+# --- Rendered Note Cache ---
+class RenderedNoteCache:
+    """
+    LRU cache of rendered note HTML, bounded by total characters. Callers key
+    entries by (note_id, updated_at, notes tree version), so an edited note,
+    or a renamed or deleted link target, never serves stale HTML.
+    """
+    def __init__(self, max_chars):
+        self._lock = threading.Lock()
+        self._cache = LRUCache(maxsize=max_chars, getsizeof=len)
+        self._counters = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        with self._lock:
+            rendered = self._cache.get(key)
+            self._counters["hits" if rendered is not None else "misses"] += 1
+            return rendered
+
+    def put(self, key, rendered):
+        with self._lock:
+            try:
+                self._cache[key] = rendered
+            except ValueError:
+                pass # Larger than the whole cache; serve it uncached.
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._cache), "chars": self._cache.currsize, "max_chars": self._cache.maxsize, **self._counters}
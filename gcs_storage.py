@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import quote
+
+import requests
+import requests.adapters
+from cachetools import TTLCache
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from google.oauth2 import service_account
+
+# --- GCS Storage Service ---
+# One storage.Client per process, created on first use and shared by every
+# thread, so credentials are parsed once, access tokens are reused until they
+# expire and uploads/deletes/signing reuse pooled HTTPS connections.
+# When STORAGE_EMULATOR_HOST is set (e.g. a local fake GCS server), requests
+# go there instead; credentials are optional in that mode.
+
+STORAGE_EMULATOR_HOST = os.environ.get("STORAGE_EMULATOR_HOST")
+GCS_HTTP_POOL_SIZE = int(os.environ.get("GCS_HTTP_POOL_SIZE", "16"))
+SIGNED_URL_EXPIRATION = timedelta(minutes=15)
+
+# Uploads of known size above 8 MiB are sent as resumable uploads in chunks of
+# GCS_UPLOAD_CHUNK_SIZE (rounded to the 256 KiB multiple GCS requires), so
+# memory use stays flat however large the file. Files of at least
+# GCS_PARALLEL_UPLOAD_THRESHOLD bytes that exist on disk are instead sent as
+# parallel parts (transfer_manager.upload_chunks_concurrently) and assembled by
+# GCS once all parts are in.
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+GCS_UPLOAD_CHUNK_SIZE = int(os.environ.get("GCS_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+GCS_PARALLEL_UPLOAD_THRESHOLD = int(os.environ.get("GCS_PARALLEL_UPLOAD_THRESHOLD", str(64 * 1024 * 1024)))
+GCS_PARALLEL_UPLOAD_PART_SIZE = int(os.environ.get("GCS_PARALLEL_UPLOAD_PART_SIZE", str(32 * 1024 * 1024)))
+GCS_PARALLEL_UPLOAD_WORKERS = int(os.environ.get("GCS_PARALLEL_UPLOAD_WORKERS", "4"))
+# Cached URLs are dropped a minute before they expire, so every URL handed
+# out is still valid for at least that long.
+SIGNED_URL_CACHE_TTL = SIGNED_URL_EXPIRATION - timedelta(minutes=1)
+SIGNED_URL_CACHE_SIZE = int(os.environ.get("SIGNED_URL_CACHE_SIZE", "5000"))
+# URLs written into pages (or API responses) may be used long after they are
+# served, e.g. from a tab left open or a lazily loaded image, so those are
+# re-signed once older than this and stay valid for at least 10 minutes.
+SIGNED_URL_EMBED_MAX_AGE = timedelta(minutes=5)
+
+class SignedUrlCache:
+    """
+    LRU cache of signed GET URLs keyed by (bucket, blob name), with entries
+    expiring after ttl. get() can ask for a URL no older than max_age.
+    """
+    def __init__(self, max_entries, ttl=SIGNED_URL_CACHE_TTL):
+        self._lock = threading.Lock()
+        self._cache = TTLCache(maxsize=max_entries, ttl=ttl.total_seconds())
+        self._counters = {"hits": 0, "misses": 0}
+
+    def get(self, key, max_age=None):
+        with self._lock:
+            url, signed_at = self._cache.get(key, (None, None))
+            if url is not None and max_age is not None and time.monotonic() - signed_at > max_age.total_seconds():
+                url = None
+            self._counters["hits" if url is not None else "misses"] += 1
+            return url
+
+    def put(self, key, url):
+        with self._lock:
+            self._cache[key] = (url, time.monotonic())
+
+    def discard(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._cache), "max_entries": self._cache.maxsize, "ttl_seconds": self._cache.ttl, **self._counters}
+
+
+class StorageService:
+    def __init__(self, bucket_name, credentials_json=None, emulator_host=STORAGE_EMULATOR_HOST, pool_size=GCS_HTTP_POOL_SIZE,
+                 url_cache_size=SIGNED_URL_CACHE_SIZE, chunk_size=GCS_UPLOAD_CHUNK_SIZE,
+                 parallel_threshold=GCS_PARALLEL_UPLOAD_THRESHOLD):
+        self.bucket_name = bucket_name
+        self.emulator_host = emulator_host.rstrip('/') if emulator_host else None
+        self.pool_size = pool_size
+        self.chunk_size = max(UPLOAD_CHUNK_ALIGNMENT, chunk_size // UPLOAD_CHUNK_ALIGNMENT * UPLOAD_CHUNK_ALIGNMENT)
+        self.parallel_threshold = parallel_threshold
+        self._credentials_json = credentials_json
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._buckets = {}
+        self.url_cache = SignedUrlCache(url_cache_size)
+        self._counters = {"clients_created": 0, "uploads": 0, "parallel_uploads": 0, "upload_sessions": 0, "deletes": 0, "signed_urls": 0, "errors": 0}
+
+    @property
+    def configured(self):
+        return bool(self.bucket_name and (self._credentials_json or self.emulator_host))
+
+    def _create_client(self):
+        if self._credentials_json:
+            credentials = service_account.Credentials.from_service_account_info(
+                json.loads(self._credentials_json), scopes=["https://www.googleapis.com/auth/devstorage.full_control"]
+            )
+            session = AuthorizedSession(credentials)
+            project = credentials.project_id
+        else:
+            # Only reachable with an emulator: the real API needs credentials.
+            credentials, project = AnonymousCredentials(), "local-emulator"
+            session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        client_options = {"api_endpoint": self.emulator_host} if self.emulator_host else None
+        return storage.Client(project=project, credentials=credentials, _http=session, client_options=client_options)
+
+    def client(self):
+        with self._lock:
+            # Re-create after a fork: the parent's HTTP connections must not be shared.
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._create_client()
+                self._pid = os.getpid()
+                self._buckets = {}
+                self._counters["clients_created"] += 1
+            return self._client
+
+    def bucket(self, bucket_name=None):
+        bucket_name = bucket_name or self.bucket_name
+        client = self.client()
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = client.bucket(bucket_name)
+            return self._buckets[bucket_name]
+
+    def blob(self, blob_name, bucket_name=None):
+        return self.bucket(bucket_name).blob(blob_name)
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+    def upload_file(self, file_obj, blob_name, content_type=None, size=None, bucket_name=None):
+        """
+        Uploads from a file object without reading it into memory. Pass size
+        when known: it picks single-request, chunked resumable or (for large
+        files backed by a path on disk) parallel part uploads.
+        """
+        blob = self.blob(blob_name, bucket_name)
+        blob.chunk_size = self.chunk_size
+        path = getattr(file_obj, "name", None)
+        try:
+            if size and size >= self.parallel_threshold and isinstance(path, str) and os.path.isfile(path):
+                transfer_manager.upload_chunks_concurrently(
+                    path, blob, content_type=content_type, chunk_size=GCS_PARALLEL_UPLOAD_PART_SIZE,
+                    max_workers=GCS_PARALLEL_UPLOAD_WORKERS, worker_type=transfer_manager.THREAD,
+                )
+                self._count("parallel_uploads")
+            else:
+                blob.upload_from_file(file_obj, content_type=content_type, size=size)
+        except Exception:
+            self._count("errors")
+            raise
+        self._count("uploads")
+        return blob_name
+
+    def create_upload_session(self, blob_name, content_type, size=None, origin=None, bucket_name=None):
+        """
+        Starts a resumable upload and returns its session URL, to which a
+        browser can PUT the file directly (origin enables CORS for it; the
+        bucket's CORS policy must also allow that origin).
+        """
+        url = self.blob(blob_name, bucket_name).create_resumable_upload_session(content_type=content_type, size=size, origin=origin)
+        self._count("upload_sessions")
+        return url
+
+    def get_blob(self, blob_name, bucket_name=None):
+        """The blob with its metadata (size, content type) loaded, or None if it does not exist."""
+        return self.bucket(bucket_name).get_blob(blob_name)
+
+    def delete(self, blob_name, bucket_name=None):
+        """Deletes a blob. Returns False if it did not exist (one request, instead of exists() then delete())."""
+        self.url_cache.discard((bucket_name or self.bucket_name, blob_name))
+        try:
+            self.blob(blob_name, bucket_name).delete()
+        except NotFound:
+            return False
+        except Exception:
+            self._count("errors")
+            raise
+        self._count("deletes")
+        return True
+
+    def exists(self, blob_name, bucket_name=None):
+        return self.blob(blob_name, bucket_name).exists()
+
+    def sign(self, blob_name, bucket_name=None):
+        """Signs a fresh GET URL, valid for SIGNED_URL_EXPIRATION, and caches it."""
+        bucket_name = bucket_name or self.bucket_name
+        self._count("signed_urls")
+        if self.emulator_host and not self._credentials_json:
+            # Anonymous emulator credentials cannot sign; emulators serve objects directly.
+            url = f"{self.emulator_host}/download/storage/v1/b/{bucket_name}/o/{quote(blob_name, safe='')}?alt=media"
+        else:
+            url = self.blob(blob_name, bucket_name).generate_signed_url(version="v4", expiration=SIGNED_URL_EXPIRATION, method="GET")
+        self.url_cache.put((bucket_name, blob_name), url)
+        return url
+
+    def cached_signed_url(self, blob_name, bucket_name=None, max_age=None):
+        """A previously signed URL that is still valid (and signed within max_age, if given), or None."""
+        return self.url_cache.get((bucket_name or self.bucket_name, blob_name), max_age)
+
+    def signed_url(self, blob_name, bucket_name=None, max_age=None):
+        return self.cached_signed_url(blob_name, bucket_name, max_age) or self.sign(blob_name, bucket_name)
+
+    def signed_urls(self, blob_names, bucket_name=None, max_age=SIGNED_URL_EMBED_MAX_AGE):
+        """
+        Signed URLs for many blobs, keyed by name, for embedding: cached ones
+        older than max_age are re-signed. Signing is local (no request per blob).
+        """
+        return {blob_name: self.signed_url(blob_name, bucket_name, max_age) for blob_name in dict.fromkeys(blob_names) if blob_name}
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {"bucket": self.bucket_name, "emulator": self.emulator_host, "pool_size": self.pool_size,
+                "signed_url_cache": self.url_cache.stats(), **counters}
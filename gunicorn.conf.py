@@ -0,0 +1,30 @@
+import os
+
+# --- Gunicorn configuration ---
+# Gunicorn picks this file up automatically from the working directory.
+bind = f"0.0.0.0:{os.environ.get('PORT', '5167')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+
+# Each worker process owns its own database pool (see get_db_pool in app.py).
+# Give every worker thread a connection of its own, plus one for the
+# background activity log writer, unless overridden.
+os.environ.setdefault("DB_POOL_MAX_CONN", str(threads + 1))
+
+# Every open Oracle reply stream (Server-Sent Events) holds one of these
+# threads for as long as the reply takes, up to ORACLE_REQUEST_TIMEOUT. Let
+# streams take at most half of them so the rest keep serving pages (none with
+# the sync worker); further chat tabs fall back to polling. Raise
+# GUNICORN_THREADS for more streams.
+os.environ.setdefault("ORACLE_MAX_STREAMS", str(threads // 2))
+
+
+def worker_exit(server, worker):
+    """Flush buffered activity log events before the worker process goes away."""
+    try:
+        from app import activity_log_writer
+    except Exception:
+        return
+    activity_log_writer.shutdown()
@@ -0,0 +1,237 @@
+import io
+import os
+import queue
+import threading
+import traceback
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from psycopg2.extras import RealDictCursor, execute_values
+
+# --- Image Derivatives ---
+# Resized WebP and JPEG copies of uploaded photos (collection items and
+# gardening log attachments), stored next to the original under
+# derivatives/ and recorded in image_derivatives (migration 7). Templates
+# build srcset from them so browsers fetch a thumbnail-sized file instead of
+# the full-resolution original. New uploads are processed by a background
+# DerivativeWorker; backfill_image_derivatives.py covers existing images.
+
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+DERIVATIVE_FORMATS = {
+    # format: (file extension, content type, Pillow save options)
+    'webp': ('webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff'}
+DERIVATIVE_PREFIX = "derivatives/"
+# Highest device pixel ratio that fixed-size thumbnails are served for.
+MAX_PIXEL_RATIO = 3
+
+def is_image_blob(blob_name):
+    return bool(blob_name) and os.path.splitext(blob_name)[1].lower() in IMAGE_EXTENSIONS
+
+def derivative_blob_name(source_blob_name, width, fmt):
+    stem = os.path.splitext(source_blob_name)[0]
+    return f"{DERIVATIVE_PREFIX}{stem}-{width}w.{DERIVATIVE_FORMATS[fmt][0]}"
+
+def _flatten(image):
+    """RGB copy of image for JPEG, with any transparency composited onto white."""
+    if image.mode == 'RGB':
+        return image
+    if 'A' not in image.getbands():
+        return image.convert('RGB')
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+def render_derivatives(data, widths=DERIVATIVE_WIDTHS, formats=tuple(DERIVATIVE_FORMATS)):
+    """
+    Resizes the image in data to each width narrower than the original (or
+    to the original width if none is) and encodes it in each format.
+    Returns [(width, height, format, bytes)]. Raises UnidentifiedImageError
+    for data Pillow cannot read.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        # For JPEGs, decode at the smallest DCT scale that is still at least
+        # the largest target size: far less work than decoding a full photo.
+        source.draft('RGB', (max(widths), max(widths)))
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        targets = sorted({width for width in widths if width < image.width} or {image.width}, reverse=True)
+        results = []
+        current = image
+        for width in targets:
+            height = max(1, round(image.height * width / image.width))
+            # Each size is scaled down from the previous one, not from the original.
+            current = current.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            for fmt in formats:
+                out = io.BytesIO()
+                frame = _flatten(current) if fmt == 'jpeg' else current
+                frame.save(out, fmt.upper(), **DERIVATIVE_FORMATS[fmt][2])
+                results.append((width, height, fmt, out.getvalue()))
+        return results
+
+def build_derivatives(storage_service, source_blob_name):
+    """
+    Downloads one original and uploads its derivatives. Returns the rows for
+    record_derivatives(); [] if the original is missing. Needs no database
+    connection, so callers only borrow one afterwards for the short write.
+    """
+    blob = storage_service.get_blob(source_blob_name)
+    if blob is None:
+        return []
+    rows = []
+    for width, height, fmt, data in render_derivatives(blob.download_as_bytes()):
+        blob_name = derivative_blob_name(source_blob_name, width, fmt)
+        storage_service.upload_file(io.BytesIO(data), blob_name, content_type=DERIVATIVE_FORMATS[fmt][1], size=len(data))
+        rows.append((source_blob_name, blob_name, fmt, width, height, len(data)))
+    return rows
+
+def record_derivatives(conn, source_blob_name, rows):
+    """Replaces the recorded derivatives of one original with rows, in the caller's transaction."""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM image_derivatives WHERE source_blob_name = %s", (source_blob_name,))
+        execute_values(cur, """
+            INSERT INTO image_derivatives (source_blob_name, blob_name, format, width, height, size_bytes)
+            VALUES %s
+        """, rows)
+
+def delete_derivatives(storage_service, conn, source_blob_names):
+    """Removes the derivatives of the given originals from GCS and (in the caller's transaction) the table."""
+    source_blob_names = [name for name in source_blob_names if name]
+    if not source_blob_names:
+        return 0
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM image_derivatives WHERE source_blob_name = ANY(%s) RETURNING blob_name", (source_blob_names,))
+        blob_names = [row[0] for row in cur.fetchall()]
+    for blob_name in blob_names:
+        storage_service.delete(blob_name)
+    return len(blob_names)
+
+def load_derivatives(cursor, source_blob_names):
+    """{source blob name: [derivative rows, narrowest first]} for the given originals."""
+    source_blob_names = list({name for name in source_blob_names if name})
+    derivatives = {}
+    if not source_blob_names:
+        return derivatives
+    with cursor.connection.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            SELECT source_blob_name, blob_name, format, width, height FROM image_derivatives
+            WHERE source_blob_name = ANY(%s) ORDER BY width
+        """, (source_blob_names,))
+        for row in cur.fetchall():
+            derivatives.setdefault(row['source_blob_name'], []).append(row)
+    return derivatives
+
+def trim_for_display(derivatives, display_width):
+    """
+    Narrows load_derivatives() output to the widths a browser could pick for
+    an image shown display_width CSS pixels wide: everything up to the first
+    width covering MAX_PIXEL_RATIO times that. Every URL in a srcset has to be
+    signed, so a 64px thumbnail then costs two signatures rather than six.
+    """
+    trimmed = {}
+    for source_blob_name, rows in derivatives.items():
+        widths = sorted({row['width'] for row in rows})
+        cutoff = next((width for width in widths if width >= display_width * MAX_PIXEL_RATIO), widths[-1])
+        trimmed[source_blob_name] = [row for row in rows if row['width'] <= cutoff]
+    return trimmed
+
+def build_srcsets(derivatives, urls):
+    """
+    Turns load_derivatives() output plus {blob name: URL} into, per original,
+    {"webp": srcset, "jpeg": srcset, "src": URL of the narrowest JPEG}.
+    Originals without derivatives (or unsigned URLs) are left out.
+    """
+    srcsets = {}
+    for source_blob_name, rows in derivatives.items():
+        variants = {}
+        for fmt in DERIVATIVE_FORMATS:
+            candidates = [(urls[row['blob_name']], row['width']) for row in rows if row['format'] == fmt and row['blob_name'] in urls]
+            if candidates:
+                variants[fmt] = ", ".join(f"{url} {width}w" for url, width in candidates)
+                if fmt == 'jpeg':
+                    variants['src'] = candidates[0][0]
+        if 'src' in variants:
+            srcsets[source_blob_name] = variants
+    return srcsets
+
+
+class DerivativeWorker:
+    """
+    Builds derivatives for newly uploaded images on a background thread fed
+    by a bounded queue, so uploads return without waiting on Pillow. Jobs that
+    do not fit in the queue (or fail) are left for the backfill script.
+    """
+    def __init__(self, storage_service, get_pool, max_queued):
+        self.storage_service = storage_service
+        self.get_pool = get_pool
+        self.max_queued = max(1, max_queued)
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self._counters = {"submitted": 0, "rejected": 0, "completed": 0, "skipped": 0, "failed": 0, "derivatives": 0}
+
+    def _ensure_started_locked(self):
+        # The thread does not survive a fork, so each gunicorn worker starts its own.
+        if self._queue is not None and self._pid == os.getpid():
+            return
+        self._queue = queue.Queue(maxsize=self.max_queued)
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="image-derivatives", daemon=True).start()
+
+    def submit(self, source_blob_name):
+        """Queues an uploaded blob. Returns False if it is not an image or the queue is full."""
+        if not is_image_blob(source_blob_name):
+            return False
+        with self._lock:
+            self._ensure_started_locked()
+            try:
+                self._queue.put_nowait(source_blob_name)
+            except queue.Full:
+                self._counters["rejected"] += 1
+                return False
+            self._counters["submitted"] += 1
+        return True
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+
+    def _process(self, source_blob_name):
+        rows = build_derivatives(self.storage_service, source_blob_name)
+        if rows:
+            pool = self.get_pool()
+            conn = pool.getconn()
+            try:
+                record_derivatives(conn, source_blob_name, rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                pool.putconn(conn)
+        self._count("derivatives", len(rows))
+        self._count("completed" if rows else "skipped")
+
+    def _run(self):
+        # Any error (including a pool timeout or database outage) fails only
+        # the current job: the thread is not restarted until the next fork.
+        while True:
+            source_blob_name = self._queue.get()
+            try:
+                self._process(source_blob_name)
+            except UnidentifiedImageError:
+                self._count("skipped")
+            except Exception:
+                traceback.print_exc()
+                self._count("failed")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "max_queued": self.max_queued,
+                **self._counters,
+            }
@@ -0,0 +1,273 @@
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# --- Oracle Job Store ---
+# Status records for background Oracle chat jobs. Every backend evicts jobs
+# once their TTL has passed and caps the number of jobs retained, so abandoned
+# jobs cannot accumulate. The SQLite and Postgres backends are shared between
+# gunicorn workers, so a status poll can land on any worker.
+
+class JobStore(ABC):
+    def __init__(self, ttl_seconds, max_jobs):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._stats_lock = threading.Lock()
+        self._counters = {"created": 0, "hits": 0, "misses": 0, "evicted": 0}
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._counters[key] += amount
+
+    @abstractmethod
+    def create(self, job_id, status="pending", reply=None):
+        """Adds (or resets) a job that expires after ttl_seconds."""
+
+    @abstractmethod
+    def get(self, job_id):
+        """Returns {"status": ..., "reply": ...} or None if the job is unknown or expired."""
+
+    @abstractmethod
+    def update(self, job_id, status, reply=None, only_if_not_in=()):
+        """
+        Sets the job's status and reply, unless its current status is in
+        only_if_not_in (checked atomically, so e.g. a cancel written by another
+        worker is not overwritten). Returns True if the job was updated.
+        """
+
+    @abstractmethod
+    def delete(self, job_id):
+        """Removes a job; unknown ids are ignored."""
+
+    @abstractmethod
+    def evict_expired(self):
+        """Removes jobs past their TTL and the oldest beyond max_jobs."""
+
+    @abstractmethod
+    def size(self):
+        """Number of jobs currently stored."""
+
+    def stats(self):
+        with self._stats_lock:
+            counters = dict(self._counters)
+        return {"backend": self.backend_name, "size": self.size(), "ttl_seconds": self.ttl_seconds, "max_jobs": self.max_jobs, **counters}
+
+
+class MemoryJobStore(JobStore):
+    """Per-process store. Only suitable for a single gunicorn worker."""
+    backend_name = "memory"
+
+    def __init__(self, ttl_seconds, max_jobs):
+        super().__init__(ttl_seconds, max_jobs)
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # job_id -> (expires_at, record), oldest first
+
+    def create(self, job_id, status="pending", reply=None):
+        with self._lock:
+            self._evict_expired_locked()
+            self._jobs[job_id] = (time.monotonic() + self.ttl_seconds, {"status": status, "reply": reply})
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+                self._count("evicted")
+        self._count("created")
+
+    def get(self, job_id):
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._count("misses")
+                return None
+            self._count("hits")
+            return dict(entry[1])
+
+    def update(self, job_id, status, reply=None, only_if_not_in=()):
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[1]["status"] in only_if_not_in:
+                return False
+            self._jobs[job_id] = (entry[0], {"status": status, "reply": reply})
+            return True
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _evict_expired_locked(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, (expires_at, _) in self._jobs.items() if expires_at < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if expired:
+            self._count("evicted", len(expired))
+
+    def evict_expired(self):
+        with self._lock:
+            self._evict_expired_locked()
+
+    def size(self):
+        with self._lock:
+            return len(self._jobs)
+
+
+class SQLiteJobStore(JobStore):
+    """Local-file store shared by all workers on a single machine."""
+    backend_name = "sqlite"
+
+    def __init__(self, path, ttl_seconds, max_jobs):
+        super().__init__(ttl_seconds, max_jobs)
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS oracle_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    reply TEXT,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_oracle_jobs_expires_at ON oracle_jobs (expires_at)")
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared across threads, so keep one per thread (and per process).
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, job_id, status="pending", reply=None):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO oracle_jobs (job_id, status, reply, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (job_id, status, reply, now, now + self.ttl_seconds)
+        )
+        self._count("created")
+        self.evict_expired()
+
+    def get(self, job_id):
+        row = self._connection().execute(
+            "SELECT status, reply FROM oracle_jobs WHERE job_id = ? AND expires_at >= ?", (job_id, time.time())
+        ).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return {"status": row[0], "reply": row[1]}
+
+    def update(self, job_id, status, reply=None, only_if_not_in=()):
+        sql = "UPDATE oracle_jobs SET status = ?, reply = ? WHERE job_id = ?"
+        if only_if_not_in:
+            sql += f" AND status NOT IN ({', '.join('?' * len(only_if_not_in))})"
+        return self._connection().execute(sql, (status, reply, job_id, *only_if_not_in)).rowcount > 0
+
+    def delete(self, job_id):
+        self._connection().execute("DELETE FROM oracle_jobs WHERE job_id = ?", (job_id,))
+
+    def evict_expired(self):
+        conn = self._connection()
+        expired = conn.execute("DELETE FROM oracle_jobs WHERE expires_at < ?", (time.time(),)).rowcount
+        overflow = conn.execute("""
+            DELETE FROM oracle_jobs WHERE job_id IN (
+                SELECT job_id FROM oracle_jobs ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_jobs,)).rowcount
+        if expired + overflow:
+            self._count("evicted", expired + overflow)
+
+    def size(self):
+        return self._connection().execute("SELECT COUNT(*) FROM oracle_jobs").fetchone()[0]
+
+
+class PostgresJobStore(JobStore):
+    """
+    Store backed by the oracle_jobs table (see create_tables.py), shared by
+    every worker and machine that talks to the database. `getconn` and
+    `putconn` borrow and return psycopg2 connections, e.g. from the app pool.
+    """
+    backend_name = "postgres"
+
+    # Evicting on every create would add a DELETE to each chat message; do it periodically instead.
+    EVICT_EVERY = 50
+
+    def __init__(self, getconn, putconn, ttl_seconds, max_jobs):
+        super().__init__(ttl_seconds, max_jobs)
+        self._getconn = getconn
+        self._putconn = putconn
+        self._creates_since_evict = 0
+
+    def _execute(self, sql, params=(), fetch=False):
+        conn = self._getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                result = cur.fetchone() if fetch else cur.rowcount
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._putconn(conn)
+
+    def create(self, job_id, status="pending", reply=None):
+        self._execute("""
+            INSERT INTO oracle_jobs (job_id, status, reply, created_at, expires_at)
+            VALUES (%s, %s, %s, NOW(), NOW() + make_interval(secs => %s))
+            ON CONFLICT (job_id) DO UPDATE SET status = EXCLUDED.status, reply = EXCLUDED.reply, expires_at = EXCLUDED.expires_at
+        """, (job_id, status, reply, self.ttl_seconds))
+        self._count("created")
+        self._creates_since_evict += 1
+        if self._creates_since_evict >= self.EVICT_EVERY:
+            self._creates_since_evict = 0
+            self.evict_expired()
+
+    def get(self, job_id):
+        row = self._execute(
+            "SELECT status, reply FROM oracle_jobs WHERE job_id = %s AND expires_at >= NOW()", (job_id,), fetch=True
+        )
+        if row is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return {"status": row[0], "reply": row[1]}
+
+    def update(self, job_id, status, reply=None, only_if_not_in=()):
+        return self._execute(
+            "UPDATE oracle_jobs SET status = %s, reply = %s WHERE job_id = %s AND status <> ALL(%s)",
+            (status, reply, job_id, list(only_if_not_in))
+        ) > 0
+
+    def delete(self, job_id):
+        self._execute("DELETE FROM oracle_jobs WHERE job_id = %s", (job_id,))
+
+    def evict_expired(self):
+        expired = self._execute("DELETE FROM oracle_jobs WHERE expires_at < NOW()")
+        overflow = self._execute("""
+            DELETE FROM oracle_jobs WHERE job_id IN (
+                SELECT job_id FROM oracle_jobs ORDER BY created_at DESC OFFSET %s
+            )
+        """, (self.max_jobs,))
+        if expired + overflow:
+            self._count("evicted", expired + overflow)
+
+    def size(self):
+        return self._execute("SELECT COUNT(*) FROM oracle_jobs", fetch=True)[0]
+
+
+def create_job_store(backend, ttl_seconds, max_jobs, sqlite_path=None, getconn=None, putconn=None):
+    if backend == "memory":
+        return MemoryJobStore(ttl_seconds, max_jobs)
+    if backend == "sqlite":
+        return SQLiteJobStore(sqlite_path, ttl_seconds, max_jobs)
+    if backend == "postgres":
+        return PostgresJobStore(getconn, putconn, ttl_seconds, max_jobs)
+    raise ValueError(f"Unknown Oracle job store backend: {backend}")
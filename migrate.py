@@ -0,0 +1,334 @@
+import os
+import sys
+import time
+import argparse
+import psycopg2
+
+# --- Configuration ---
+# Run create_tables.py once to create the base schema, then this script to
+# bring it up to date:
+#   python migrate.py status
+#   python migrate.py up [--to VERSION]
+#   python migrate.py down --to VERSION
+#   python migrate.py check       # EXPLAIN the hot queries and confirm they use their indexes
+DB_URL = os.environ.get("DATABASE_URL")
+
+# Arbitrary key for pg_advisory_lock so two deploys cannot migrate at once.
+MIGRATION_LOCK_KEY = 727274001
+
+# --- Migrations ---
+# Each entry is (version, name, up, down). `up` and `down` are SQL strings or
+# callables that take a cursor. Every migration runs in its own transaction
+# and must be safe to re-run against a schema that already has its objects.
+# Only ever append new versions.
+MIGRATIONS = [
+    (1, "indexes for hot queries", """
+        CREATE INDEX IF NOT EXISTS idx_notes_user_updated_at ON notes (user_id, updated_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_notes_folder_id ON notes (folder_id);
+        CREATE INDEX IF NOT EXISTS idx_folders_user_parent ON folders (user_id, parent_folder_id);
+        CREATE INDEX IF NOT EXISTS idx_food_log_user_log_time ON food_log (user_id, log_time);
+        CREATE INDEX IF NOT EXISTS idx_activity_log_timestamp ON activity_log (timestamp DESC);
+        CREATE INDEX IF NOT EXISTS idx_activity_log_user_id ON activity_log (user_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_note_references_target ON note_references (target_note_id);
+        CREATE INDEX IF NOT EXISTS idx_antiques_user_created_at ON antiques (user_id, created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_tasks_user_open_due ON tasks (user_id, due_date NULLS FIRST, created_at) WHERE is_completed = FALSE;
+        CREATE INDEX IF NOT EXISTS idx_files_user_created_at ON files (user_id, created_at DESC);
+    """, """
+        DROP INDEX IF EXISTS idx_notes_user_updated_at;
+        DROP INDEX IF EXISTS idx_notes_folder_id;
+        DROP INDEX IF EXISTS idx_folders_user_parent;
+        DROP INDEX IF EXISTS idx_food_log_user_log_time;
+        DROP INDEX IF EXISTS idx_activity_log_timestamp;
+        DROP INDEX IF EXISTS idx_activity_log_user_id;
+        DROP INDEX IF EXISTS idx_note_references_target;
+        DROP INDEX IF EXISTS idx_antiques_user_created_at;
+        DROP INDEX IF EXISTS idx_tasks_user_open_due;
+        DROP INDEX IF EXISTS idx_files_user_created_at;
+    """),
+    (2, "full-text search vector for antiques", """
+        ALTER TABLE antiques ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(item_type, '') || ' ' || coalesce(period, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(description, '') || ' ' || coalesce(provenance, '')), 'C')
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS idx_antiques_search_vector ON antiques USING GIN (search_vector);
+    """, """
+        DROP INDEX IF EXISTS idx_antiques_search_vector;
+        ALTER TABLE antiques DROP COLUMN IF EXISTS search_vector;
+    """),
+    (3, "full-text search over note bodies and trigram index on note titles", """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+        -- Plain text of an Editor.js document: block text, captions, list items
+        -- and table cells, with inline HTML and snql-ref GUIDs stripped. Legacy
+        -- notes whose content is a bare JSON string are returned as-is. Must stay
+        -- IMMUTABLE because notes.search_vector is generated from it.
+        CREATE OR REPLACE FUNCTION note_plain_text(content jsonb) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE jsonb_typeof(content)
+                WHEN 'string' THEN content #>> '{}'
+                WHEN 'object' THEN coalesce((
+                    SELECT string_agg(
+                        replace(regexp_replace(regexp_replace(part, '<[^>]*>', ' ', 'g'), 'snql-ref:[0-9a-fA-F-]{36}', ' ', 'g'), '&nbsp;', ' '),
+                        ' ' ORDER BY block_no, part_no)
+                    FROM jsonb_array_elements(CASE WHEN jsonb_typeof(content -> 'blocks') = 'array' THEN content -> 'blocks' ELSE '[]' END)
+                         WITH ORDINALITY AS blocks(block, block_no),
+                         LATERAL (
+                             SELECT value #>> '{}', 0 FROM jsonb_path_query(block, '$.data.text ? (@.type() == "string")') AS value
+                             UNION ALL
+                             SELECT value #>> '{}', 1 FROM jsonb_path_query(block, '$.data.caption ? (@.type() == "string")') AS value
+                             UNION ALL
+                             SELECT value #>> '{}', 2 FROM jsonb_path_query(
+                                 jsonb_build_array(block -> 'data' -> 'items', block -> 'data' -> 'content'),
+                                 'strict $.** ? (@.type() == "string")') AS value
+                         ) AS parts(part, part_no)
+                ), '')
+                ELSE ''
+            END
+        $$;
+
+        ALTER TABLE notes ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', note_plain_text(content)), 'B')
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS idx_notes_search_vector ON notes USING GIN (search_vector);
+        CREATE INDEX IF NOT EXISTS idx_notes_title_trgm ON notes USING GIN (title gin_trgm_ops);
+    """, """
+        DROP INDEX IF EXISTS idx_notes_title_trgm;
+        DROP INDEX IF EXISTS idx_notes_search_vector;
+        ALTER TABLE notes DROP COLUMN IF EXISTS search_vector;
+        DROP FUNCTION IF EXISTS note_plain_text(jsonb);
+    """),
+    (4, "cache version counters", """
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        INSERT INTO cache_versions (name) VALUES ('notes_tree') ON CONFLICT (name) DO NOTHING;
+    """, """
+        DROP TABLE IF EXISTS cache_versions;
+    """),
+    (5, "note versions and unique note titles", """
+        ALTER TABLE notes ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+        -- Fails if duplicate titles already exist; rename them first.
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notes_user_title ON notes (user_id, title);
+    """, """
+        DROP INDEX IF EXISTS idx_notes_user_title;
+        ALTER TABLE notes DROP COLUMN IF EXISTS version;
+    """),
+    (6, "private file blob name lookups", """
+        -- files.gcs_blob_name is already UNIQUE (and so indexed).
+        CREATE INDEX IF NOT EXISTS idx_antiques_image_url ON antiques (image_url) WHERE image_url IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_log_attachments_file_name ON log_attachments (file_name);
+    """, """
+        DROP INDEX IF EXISTS idx_antiques_image_url;
+        DROP INDEX IF EXISTS idx_log_attachments_file_name;
+    """),
+    (7, "image derivatives", """
+        CREATE TABLE IF NOT EXISTS image_derivatives (
+            id SERIAL PRIMARY KEY,
+            source_blob_name TEXT NOT NULL,
+            blob_name TEXT NOT NULL UNIQUE,
+            format TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            UNIQUE (source_blob_name, format, width)
+        );
+    """, """
+        DROP TABLE IF EXISTS image_derivatives;
+    """),
+]
+
+# --- Index usage checks ---
+# (description, query, index the plan must use). Sequential scans are disabled
+# while explaining, so the check proves the index is usable even on the small
+# tables of a fresh database where the planner would rightly prefer a seq scan.
+INDEX_CHECKS = [
+    ("dashboard: recent notes",
+     "SELECT id, title, updated_at FROM notes WHERE user_id = 1 ORDER BY updated_at DESC LIMIT 4",
+     "idx_notes_user_updated_at"),
+    ("dashboard: calories today",
+     """SELECT SUM(calories) FROM food_log WHERE user_id = 1
+        AND log_time >= (CURRENT_DATE)::timestamp AT TIME ZONE 'Europe/London'
+        AND log_time < (CURRENT_DATE + 1)::timestamp AT TIME ZONE 'Europe/London'""",
+     "idx_food_log_user_log_time"),
+    ("dashboard: recent activity",
+     "SELECT activity_type, timestamp FROM activity_log WHERE user_id = 1 ORDER BY id DESC LIMIT 5",
+     "idx_activity_log_user_id"),
+    ("dashboard: open tasks",
+     """SELECT id, title, is_completed, due_date FROM tasks WHERE user_id = 1 AND is_completed = FALSE
+        ORDER BY due_date ASC NULLS FIRST, created_at ASC""",
+     "idx_tasks_user_open_due"),
+    ("activity log page",
+     "SELECT id FROM activity_log ORDER BY timestamp DESC LIMIT 100",
+     "idx_activity_log_timestamp"),
+    ("food log: last 30 days",
+     "SELECT * FROM food_log WHERE user_id = 1 AND log_time >= NOW() - INTERVAL '30 days' ORDER BY log_time DESC",
+     "idx_food_log_user_log_time"),
+    ("note view: backlinks",
+     "SELECT source_note_id FROM note_references WHERE target_note_id = 1",
+     "idx_note_references_target"),
+    ("collection page",
+     "SELECT * FROM antiques WHERE user_id = 1 ORDER BY created_at DESC",
+     "idx_antiques_user_created_at"),
+    ("collection search",
+     "SELECT id FROM antiques WHERE user_id = 1 AND search_vector @@ to_tsquery('english', 'iron:* & cross:*')",
+     "idx_antiques_search_vector"),
+    ("note search",
+     "SELECT id FROM notes WHERE user_id = 1 AND search_vector @@ to_tsquery('english', 'garden:*')",
+     "idx_notes_search_vector"),
+    ("note title autocomplete",
+     "SELECT title FROM notes WHERE user_id = 1 AND title ILIKE '%garden%'",
+     "idx_notes_title_trgm"),
+    ("private file: collection image lookup",
+     "SELECT image_url FROM antiques WHERE image_url = ANY(ARRAY['a.jpg'])",
+     "idx_antiques_image_url"),
+    ("private file: log attachment lookup",
+     "SELECT file_name FROM log_attachments WHERE file_name = ANY(ARRAY['a.jpg'])",
+     "idx_log_attachments_file_name"),
+    ("logs page",
+     "SELECT * FROM logs WHERE user_id = 1 ORDER BY log_time DESC, id DESC LIMIT 21",
+     "idx_logs_user_time_id"),
+]
+
+
+def run_step(cur, step):
+    if callable(step):
+        step(cur)
+    else:
+        cur.execute(step)
+
+
+def ensure_migrations_table(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        """)
+    conn.commit()
+
+
+def applied_versions(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM schema_migrations ORDER BY version")
+        return [row[0] for row in cur.fetchall()]
+
+
+def migrate_up(conn, target=None):
+    applied = set(applied_versions(conn))
+    pending = [m for m in MIGRATIONS if m[0] not in applied and (target is None or m[0] <= target)]
+    if not pending:
+        print("Database schema is up to date.")
+        return
+    for version, name, up, _ in pending:
+        started = time.monotonic()
+        print(f"Applying migration {version}: {name} ...")
+        try:
+            with conn.cursor() as cur:
+                run_step(cur, up)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"  done in {time.monotonic() - started:.2f}s")
+
+
+def migrate_down(conn, target):
+    applied = set(applied_versions(conn))
+    to_revert = [m for m in reversed(MIGRATIONS) if m[0] in applied and m[0] > target]
+    if not to_revert:
+        print(f"Nothing to revert above version {target}.")
+        return
+    for version, name, _, down in to_revert:
+        print(f"Reverting migration {version}: {name} ...")
+        try:
+            with conn.cursor() as cur:
+                run_step(cur, down)
+                cur.execute("DELETE FROM schema_migrations WHERE version = %s", (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def print_status(conn):
+    applied = set(applied_versions(conn))
+    for version, name, _, _ in MIGRATIONS:
+        state = "applied" if version in applied else "pending"
+        print(f"{version:>4}  {state:<8} {name}")
+
+
+def plan_index_names(node):
+    names = set()
+    if 'Index Name' in node:
+        names.add(node['Index Name'])
+    for child in node.get('Plans', []):
+        names |= plan_index_names(child)
+    return names
+
+
+def check_indexes(conn):
+    """EXPLAINs each hot query and reports whether its plan uses the expected index."""
+    failures = 0
+    with conn.cursor() as cur:
+        for description, sql, expected_index in INDEX_CHECKS:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+            plan = cur.fetchone()[0][0]['Plan']
+            used = plan_index_names(plan)
+            ok = expected_index in used
+            failures += 0 if ok else 1
+            print(f"[{'OK' if ok else 'FAIL'}] {description}: expected {expected_index}, plan uses {sorted(used) or 'no index'}")
+    conn.rollback()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply, revert or verify database schema migrations.")
+    parser.add_argument("command", choices=["status", "up", "down", "check"])
+    parser.add_argument("--to", type=int, help="Target version (required for 'down').")
+    args = parser.parse_args()
+
+    if not DB_URL:
+        print("[ERROR] DATABASE_URL environment variable is not set.")
+        return 1
+    if args.command == "down" and args.to is None:
+        print("[ERROR] 'down' requires --to VERSION (use 0 to revert everything).")
+        return 1
+
+    conn = psycopg2.connect(DB_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        ensure_migrations_table(conn)
+
+        if args.command == "status":
+            print_status(conn)
+        elif args.command == "up":
+            migrate_up(conn, args.to)
+        elif args.command == "down":
+            migrate_down(conn, args.to)
+        elif args.command == "check":
+            failures = check_indexes(conn)
+            if failures:
+                print(f"--- {failures} quer{'y' if failures == 1 else 'ies'} not using the expected index ---")
+                return 1
+            print("--- All checked queries use their indexes ---")
+        return 0
+    except Exception as e:
+        print(f"[ERROR] Migration failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
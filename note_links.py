@@ -0,0 +1,64 @@
+import uuid
+
+from editorjs import extract_references
+
+# --- SNQL Link Index ---
+# note_references holds one row per (source note -> target note) link found in
+# a note's content. It backs the backlinks and outgoing-links panels on the
+# note page, and is kept current incrementally each time a note is saved.
+# reindex_note_links.py rebuilds it for every note in one pass.
+
+def valid_guids(guids):
+    """Drops strings that match SNQL_REF_PATTERN but are not real UUIDs, so the ::uuid[] cast cannot fail."""
+    valid = set()
+    for guid in guids:
+        try:
+            valid.add(str(uuid.UUID(guid)))
+        except ValueError:
+            pass
+    return valid
+
+def find_link_targets(cursor, titles, guids, user_id=1):
+    """Looks up the notes named by [[Title]] and snql-ref GUID references with a single query. Returns (id, title, guid) rows."""
+    guids = valid_guids(guids)
+    if not titles and not guids:
+        return []
+    with cursor.connection.cursor() as cur:
+        cur.execute(
+            "SELECT id, title, guid::text FROM notes WHERE user_id = %s AND (title = ANY(%s) OR guid = ANY(%s::uuid[]))",
+            (user_id, list(titles), list(guids))
+        )
+        return cur.fetchall()
+
+def resolve_link_targets(cursor, titles, guids, user_id=1):
+    """Resolves [[Title]] and snql-ref GUID targets to note ids."""
+    return {row[0] for row in find_link_targets(cursor, titles, guids, user_id)}
+
+def update_note_links(cursor, note_id, content, user_id=1):
+    """
+    Re-indexes the links of one note. Diffs the targets found in content
+    against the stored rows and applies only the difference, with at most one
+    DELETE and one INSERT. Runs in the caller's transaction.
+    Returns (added, removed) target id sets.
+    """
+    titles, guids = extract_references(content)
+    targets = resolve_link_targets(cursor, titles, guids, user_id)
+    targets.discard(note_id)
+
+    with cursor.connection.cursor() as cur:
+        cur.execute("SELECT target_note_id FROM note_references WHERE source_note_id = %s", (note_id,))
+        existing = {row[0] for row in cur.fetchall()}
+
+        added, removed = targets - existing, existing - targets
+        if removed:
+            cur.execute(
+                "DELETE FROM note_references WHERE source_note_id = %s AND target_note_id = ANY(%s)",
+                (note_id, list(removed))
+            )
+        if added:
+            cur.execute("""
+                INSERT INTO note_references (source_note_id, target_note_id)
+                SELECT %s, unnest(%s::integer[])
+                ON CONFLICT (source_note_id, target_note_id) DO NOTHING
+            """, (note_id, list(added)))
+    return added, removed
@@ -0,0 +1,169 @@
+import threading
+
+from psycopg2.extras import RealDictCursor
+
+# --- Notes Tree Cache ---
+# A snapshot of every folder (id and name), used for the "move to folder"
+# list; the sidebar itself loads lazily (see below). Each worker keeps the
+# latest result in memory, tagged with the 'notes_tree' counter from the
+# cache_versions table (migration 4). Every write that changes the shape of
+# the tree calls bump_notes_tree_version() in its own transaction, so the next
+# request on any worker sees a new version and reloads.
+
+NOTES_TREE_VERSION_KEY = 'notes_tree'
+
+class NotesTree:
+    """Read-only snapshot of the folder list at one version."""
+    def __init__(self, version, folders):
+        self.version = version
+        self.folders = folders  # [{'id', 'name'}], sorted by name
+
+
+def get_notes_tree_version(cursor):
+    with cursor.connection.cursor() as cur:
+        cur.execute("SELECT version FROM cache_versions WHERE name = %s", (NOTES_TREE_VERSION_KEY,))
+        row = cur.fetchone()
+    return row[0] if row else 0
+
+def bump_notes_tree_version(cursor):
+    """Marks every worker's cached tree stale. Call inside the transaction that changes notes or folders."""
+    with cursor.connection.cursor() as cur:
+        cur.execute("""
+            INSERT INTO cache_versions (name, version, updated_at) VALUES (%s, 1, NOW())
+            ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1, updated_at = NOW()
+        """, (NOTES_TREE_VERSION_KEY,))
+
+
+class NotesTreeCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tree = None
+        self._counters = {"hits": 0, "misses": 0}
+
+    def get(self, cursor):
+        # Read the version before the data: a write that lands in between then
+        # only makes the cached copy look older than it is, never newer.
+        version = get_notes_tree_version(cursor)
+        with self._lock:
+            tree = self._tree
+            if tree is not None and tree.version == version:
+                self._counters["hits"] += 1
+                return tree
+            self._counters["misses"] += 1
+
+        with cursor.connection.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT id, name FROM folders WHERE user_id = 1 ORDER BY name")
+            folders = cur.fetchall()
+        tree = NotesTree(version, folders)
+
+        with self._lock:
+            if self._tree is None or self._tree.version <= version:
+                self._tree = tree
+        return tree
+
+    def stats(self):
+        with self._lock:
+            version = self._tree.version if self._tree is not None else None
+            return {"version": version, **self._counters}
+
+
+# --- Folder Ancestry ---
+# Recursive CTEs over folders.parent_folder_id, so walking up or down the
+# hierarchy costs one query and touches only the folders involved (O(depth)
+# up, O(subtree) down) instead of loading every folder into Python.
+
+# Guards both walks against a parent_folder_id cycle.
+MAX_FOLDER_DEPTH = 100
+
+# Takes (folder_id, MAX_FOLDER_DEPTH); yields folder_id itself and every folder beneath it.
+DESCENDANTS_CTE = """
+    WITH RECURSIVE descendants AS (
+        SELECT id, 0 AS depth FROM folders WHERE id = %s AND user_id = 1
+        UNION ALL
+        SELECT f.id, d.depth + 1
+        FROM folders f JOIN descendants d ON f.parent_folder_id = d.id
+        WHERE f.user_id = 1 AND d.depth < %s
+    )
+"""
+
+def get_folder_path(cursor, folder_id):
+    """Folders from the root down to folder_id (inclusive)."""
+    if not folder_id:
+        return []
+    with cursor.connection.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            WITH RECURSIVE ancestors AS (
+                SELECT id, name, parent_folder_id, 0 AS depth
+                FROM folders WHERE id = %s AND user_id = 1
+                UNION ALL
+                SELECT f.id, f.name, f.parent_folder_id, a.depth + 1
+                FROM folders f JOIN ancestors a ON f.id = a.parent_folder_id
+                WHERE a.depth < %s
+            )
+            SELECT id, name, parent_folder_id FROM ancestors ORDER BY depth DESC
+        """, (folder_id, MAX_FOLDER_DEPTH))
+        return cur.fetchall()
+
+def get_folder_descendant_ids(cursor, folder_id):
+    """Ids of folder_id and every folder beneath it."""
+    with cursor.connection.cursor() as cur:
+        cur.execute(DESCENDANTS_CTE + "SELECT id FROM descendants", (folder_id, MAX_FOLDER_DEPTH))
+        return [row[0] for row in cur.fetchall()]
+
+def get_folder_deletion_stats(cursor, folder_id):
+    """How many subfolders and notes deleting folder_id would remove; both cascade from the folder."""
+    with cursor.connection.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(DESCENDANTS_CTE + """
+            SELECT (SELECT COUNT(*) FROM descendants) - 1 AS subfolder_count,
+                   (SELECT COUNT(*) FROM notes WHERE folder_id IN (SELECT id FROM descendants)) AS note_count
+        """, (folder_id, MAX_FOLDER_DEPTH))
+        return cur.fetchone()
+
+
+# --- Lazy Tree Levels ---
+# The notes sidebar renders only the folders on the path to the current note;
+# every other folder is fetched one level at a time from /api/notes/tree when
+# it is expanded.
+
+def load_tree_levels(cursor, folder_ids, include_root=False):
+    """
+    Loads the direct child folders (with their folder and note counts) and
+    notes of each folder in folder_ids, plus the root level when include_root
+    is set, in two queries. Returns {folder_id or None: {"folders": [...], "notes": [...]}}.
+    """
+    folder_ids = [folder_id for folder_id in folder_ids if folder_id]
+    levels = {folder_id: {"folders": [], "notes": []} for folder_id in folder_ids}
+    if include_root:
+        levels[None] = {"folders": [], "notes": []}
+    if not levels:
+        return levels
+
+    with cursor.connection.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            SELECT f.id, f.name, f.parent_folder_id,
+                   (SELECT COUNT(*) FROM folders c WHERE c.user_id = 1 AND c.parent_folder_id = f.id) AS folder_count,
+                   (SELECT COUNT(*) FROM notes n WHERE n.folder_id = f.id) AS note_count
+            FROM folders f
+            WHERE f.user_id = 1 AND (f.parent_folder_id = ANY(%s::integer[]) OR (%s AND f.parent_folder_id IS NULL))
+            ORDER BY f.name
+        """, (folder_ids, include_root))
+        for folder in cur.fetchall():
+            levels[folder['parent_folder_id']]["folders"].append(folder)
+
+        cur.execute("""
+            SELECT id, title, folder_id FROM notes
+            WHERE user_id = 1 AND (folder_id = ANY(%s::integer[]) OR (%s AND folder_id IS NULL))
+            ORDER BY title
+        """, (folder_ids, include_root))
+        for note in cur.fetchall():
+            levels[note['folder_id']]["notes"].append(note)
+    return levels
+
+def build_sidebar_tree(cursor, folder_path):
+    """Root level of the sidebar with each folder on folder_path expanded in place."""
+    levels = load_tree_levels(cursor, [folder['id'] for folder in folder_path], include_root=True)
+    for level in levels.values():
+        for folder in level["folders"]:
+            if folder['id'] in levels:
+                folder['level'] = levels[folder['id']]
+    return levels[None]
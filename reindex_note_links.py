@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import psycopg2
+
+from editorjs import extract_references
+from note_links import valid_guids
+
+# --- Configuration ---
+# Rebuilds the whole note_references link graph from note content, e.g. after
+# importing notes or after titles were renamed in bulk:
+#   python reindex_note_links.py [--dry-run]
+# Notes are streamed with a server-side cursor, links are resolved in memory
+# and bulk-loaded with COPY into a staging table, and note_references is then
+# brought in line with one DELETE and one INSERT, so unchanged links keep
+# their original created_at.
+DB_URL = os.environ.get("DATABASE_URL")
+FETCH_SIZE = 500
+
+
+def load_link_targets(conn):
+    """Maps (user_id, title) and (user_id, guid) to note ids for every note."""
+    by_title, by_guid = {}, {}
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, user_id, title, guid FROM notes")
+        for note_id, user_id, title, guid in cur:
+            by_title[(user_id, title)] = note_id
+            by_guid[(user_id, str(guid))] = note_id
+    return by_title, by_guid
+
+
+def write_links(conn, out, by_title, by_guid):
+    """Writes one tab-separated "source target" line per link to out and returns (notes, links)."""
+    notes = links = 0
+    with conn.cursor(name="reindex_note_links") as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute("SELECT id, user_id, content FROM notes")
+        for note_id, user_id, content in cur:
+            notes += 1
+            titles, guids = extract_references(content)
+            targets = {by_title[(user_id, title)] for title in titles if (user_id, title) in by_title}
+            targets |= {by_guid[(user_id, guid)] for guid in valid_guids(guids) if (user_id, guid) in by_guid}
+            targets.discard(note_id)
+            for target_id in targets:
+                out.write(f"{note_id}\t{target_id}\n")
+            links += len(targets)
+    return notes, links
+
+
+def apply_links(conn, staged):
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE note_links_staging (source_note_id INTEGER, target_note_id INTEGER) ON COMMIT DROP")
+        cur.copy_expert("COPY note_links_staging (source_note_id, target_note_id) FROM STDIN", staged)
+        cur.execute("""
+            DELETE FROM note_references nr
+            WHERE NOT EXISTS (
+                SELECT 1 FROM note_links_staging s
+                WHERE s.source_note_id = nr.source_note_id AND s.target_note_id = nr.target_note_id
+            )
+        """)
+        removed = cur.rowcount
+        cur.execute("""
+            INSERT INTO note_references (source_note_id, target_note_id)
+            SELECT source_note_id, target_note_id FROM note_links_staging
+            ON CONFLICT (source_note_id, target_note_id) DO NOTHING
+        """)
+        added = cur.rowcount
+    return added, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the note_references link graph from note content.")
+    parser.add_argument("--dry-run", action="store_true", help="Report the changes without committing them.")
+    args = parser.parse_args()
+
+    if not DB_URL:
+        print("[ERROR] DATABASE_URL environment variable is not set.")
+        return 1
+
+    started = time.monotonic()
+    conn = psycopg2.connect(DB_URL)
+    try:
+        by_title, by_guid = load_link_targets(conn)
+        with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024, mode="w+") as staged:
+            notes, links = write_links(conn, staged, by_title, by_guid)
+            staged.seek(0)
+            added, removed = apply_links(conn, staged)
+
+        print(f"Scanned {notes} notes and found {links} links: {added} added, {removed} removed.")
+        if args.dry_run:
+            conn.rollback()
+            print("--- Dry run: no changes committed ---")
+        else:
+            conn.commit()
+            print(f"--- Link index rebuilt in {time.monotonic() - started:.1f}s ---")
+        return 0
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] Reindex failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,376 @@
+import os
+import sys
+import time
+import zlib
+import hashlib
+import argparse
+import tarfile
+import tempfile
+import subprocess
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+from backup_db import (BACKUP_NAME_PATTERNS, BACKUP_PREFIX, READ_SIZE, StderrReader, backup_time, format_bytes,
+                       list_prefixes)
+from gcs_storage import StorageService
+
+# --- Configuration ---
+# Counterpart to backup_db.py:
+#   python restore_db.py list
+#   python restore_db.py restore [BACKUP|latest] --target-url URL [--jobs N]
+#   python restore_db.py verify [BACKUP|latest] [--jobs N] [--keep]
+# Backups are read from GCS in READ_SIZE pieces, decompressed and checked
+# against the SHA-256 recorded at backup time on the fly. Custom-format dumps
+# are piped straight into pg_restore's stdin (pg_restore cannot run parallel
+# jobs on a pipe, so they restore with one job). Directory-format tars are
+# unpacked as they download into a scratch directory (RESTORE_WORK_DIR), which
+# pg_restore --jobs then restores in parallel.
+# verify restores into a throwaway database on the same server as
+# DATABASE_URL, compares every table's row count and content checksum with
+# the live database and reports how long each step took, i.e. the measured
+# recovery time.
+DB_URL = os.environ.get("DATABASE_URL")
+GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
+GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+
+
+class StreamDecompressor:
+    """Incremental counterpart of backup_db.StreamCompressor."""
+    def __init__(self, kind):
+        if kind == "gzip":
+            self._decompressor = zlib.decompressobj(31)
+        elif kind == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd backups need the 'zstandard' package (pip install zstandard).")
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif kind == "none":
+            self._decompressor = None
+        else:
+            raise ValueError(f"Unknown compression: {kind}")
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data) if self._decompressor else data
+
+    def flush(self):
+        return self._decompressor.flush() if self._decompressor and hasattr(self._decompressor, "flush") else b""
+
+
+def is_legacy_backup(blob_name):
+    """Flat database_backups/db_backup_<timestamp> names, from before backups recorded a checksum."""
+    return bool(BACKUP_NAME_PATTERNS[1].match(blob_name))
+
+
+class BackupReader:
+    """
+    Read-only file-like view of a backup blob: streams it from GCS, hashes
+    the stored bytes and yields them decompressed. verify_checksum() compares
+    the hash with the one backup_db.py recorded once everything has been read.
+    Only legacy backups may lack that hash: for a dated backup it is written
+    last, so its absence means the backup never completed, and the reader
+    refuses it before anything is downloaded.
+    """
+    def __init__(self, blob, chunk_size=None):
+        metadata = blob.metadata or {}
+        self.blob = blob
+        self.format = metadata.get("format") or ("directory" if ".dir.tar" in blob.name else "custom")
+        self.expected_sha256 = metadata.get("sha256")
+        if not self.expected_sha256 and not is_legacy_backup(blob.name):
+            raise RuntimeError(f"No checksum recorded for {blob.name}: the backup is incomplete.")
+        self.stored_bytes = 0
+        self.raw_bytes = 0
+        self._digest = hashlib.sha256()
+        self._reader = blob.open("rb", chunk_size=chunk_size)
+        self._decompressor = StreamDecompressor(metadata.get("compression") or compression_from_name(blob.name))
+        self._buffer = b""
+        self._eof = False
+
+    def _fill(self):
+        data = self._reader.read(READ_SIZE)
+        if not data:
+            self._eof = True
+            self._buffer += self._decompressor.flush()
+            return
+        self._digest.update(data)
+        self.stored_bytes += len(data)
+        self._buffer += self._decompressor.decompress(data)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.raw_bytes += len(data)
+        return data
+
+    def drain(self):
+        """Reads to the end (e.g. past tar padding) so the checksum covers the whole object."""
+        while self.read(READ_SIZE):
+            pass
+
+    def verify_checksum(self):
+        """True if it matches, None for a legacy backup without one, False on mismatch."""
+        if not self.expected_sha256:
+            return None
+        return self._digest.hexdigest() == self.expected_sha256
+
+
+def compression_from_name(blob_name):
+    if blob_name.endswith(".gz"):
+        return "gzip"
+    if blob_name.endswith(".zst"):
+        return "zstd"
+    return "none"
+
+
+# --- Finding backups ---
+
+def list_backups(bucket):
+    """Every backup under the prefix, newest first, as (time, blob)."""
+    backups = [(backup_time(blob.name), blob) for blob in bucket.list_blobs(prefix=BACKUP_PREFIX)]
+    return sorted([(taken, blob) for taken, blob in backups if taken], key=lambda item: item[0], reverse=True)
+
+
+def find_latest_backup(bucket):
+    """Newest backup, listing only the most recent non-empty month instead of the whole history."""
+    years, legacy_names = list_prefixes(bucket, BACKUP_PREFIX)
+    for year_prefix in reversed(years):
+        months, _ = list_prefixes(bucket, year_prefix)
+        for month_prefix in reversed(months):
+            names = [blob.name for blob in bucket.list_blobs(prefix=month_prefix, fields="items(name),nextPageToken")]
+            dated = [name for name in names if backup_time(name)]
+            if dated:
+                return max(dated, key=backup_time)
+    dated = [name for name in legacy_names if backup_time(name)]
+    return max(dated, key=backup_time) if dated else None
+
+
+def resolve_backup(bucket, name):
+    if name == "latest":
+        name = find_latest_backup(bucket)
+        if name is None:
+            raise RuntimeError("No backups found.")
+    elif not name.startswith(BACKUP_PREFIX):
+        name = BACKUP_PREFIX + name
+    blob = bucket.get_blob(name)
+    if blob is None:
+        raise RuntimeError(f"Backup not found: {name}")
+    return blob
+
+
+# --- Restoring ---
+
+def pg_restore_command(target_url, jobs=1, clean=False, directory=None):
+    command = ['pg_restore', '--no-owner', f'--dbname={target_url}']
+    if clean:
+        command += ['--clean', '--if-exists']
+    if directory:
+        command += ['--format=directory', f'--jobs={jobs}', directory]
+    return command
+
+
+def restore_backup(storage_service, blob, target_url, jobs=1, clean=False):
+    """
+    Streams blob into pg_restore against target_url. Returns timings and
+    sizes. Raises RuntimeError if pg_restore fails or the checksum does not
+    match.
+    """
+    reader = BackupReader(blob, chunk_size=storage_service.chunk_size)
+    started = time.monotonic()
+    stats = {"format": reader.format}
+
+    if reader.format == "directory":
+        with tempfile.TemporaryDirectory(prefix="db_restore_", dir=os.environ.get("RESTORE_WORK_DIR")) as work_dir:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                tar.extractall(work_dir, filter="data")
+            reader.drain()
+            stats["download_seconds"] = time.monotonic() - started
+            # The whole archive is local by now, so a corrupt one is caught before anything is restored.
+            if reader.verify_checksum() is False:
+                raise RuntimeError(f"Checksum mismatch for {blob.name}: the backup is corrupt.")
+            result = subprocess.run(pg_restore_command(target_url, jobs, clean, os.path.join(work_dir, "dump")),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                error = result.stderr.decode("utf-8", errors="replace").strip()
+                raise RuntimeError(f"pg_restore failed with return code {result.returncode}: {error}")
+    else:
+        process = subprocess.Popen(pg_restore_command(target_url, clean=clean), stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = StderrReader(process.stderr)
+        try:
+            while True:
+                data = reader.read(READ_SIZE)
+                if not data:
+                    break
+                process.stdin.write(data)
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError(f"pg_restore failed with return code {process.returncode}: {stderr.text()}")
+        except BrokenPipeError:
+            process.wait()
+            raise RuntimeError(f"pg_restore exited early with return code {process.returncode}: {stderr.text()}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    stats.update(seconds=time.monotonic() - started, stored_bytes=reader.stored_bytes, raw_bytes=reader.raw_bytes)
+    checksum = reader.verify_checksum()
+    if checksum is False:
+        raise RuntimeError(f"Checksum mismatch for {blob.name}: the backup is corrupt.")
+    stats["checksum"] = "ok" if checksum else "not recorded"
+    return stats
+
+
+# --- Verification ---
+
+TABLES_SQL = """
+    SELECT table_schema, table_name FROM information_schema.tables
+    WHERE table_type = 'BASE TABLE' AND table_schema NOT IN ('pg_catalog', 'information_schema')
+      AND left(table_schema, 6) <> 'bench_'
+    ORDER BY table_schema, table_name
+"""
+
+def table_fingerprints(conn, counts_only=False):
+    """{(schema, table): (row count, checksum)}. The checksum is order-independent: md5 over the sorted row md5s."""
+    fingerprints = {}
+    with conn.cursor() as cur:
+        cur.execute(TABLES_SQL)
+        tables = cur.fetchall()
+        for schema, table in tables:
+            name = sql.Identifier(schema, table)
+            if counts_only:
+                cur.execute(sql.SQL("SELECT COUNT(*), NULL FROM {}").format(name))
+            else:
+                cur.execute(sql.SQL("SELECT COUNT(*), md5(string_agg(md5(t::text), '' ORDER BY md5(t::text))) FROM {} t").format(name))
+            fingerprints[(schema, table)] = cur.fetchone()
+    conn.rollback()
+    return fingerprints
+
+
+def compare_fingerprints(source, restored):
+    """Prints one line per table; returns the number of tables that differ or are missing."""
+    problems = 0
+    for key in sorted(set(source) | set(restored)):
+        label = ".".join(key)
+        if key not in restored:
+            print(f"[FAIL] {label}: missing from the restore")
+        elif key not in source:
+            print(f"[INFO] {label}: only in the restore (dropped since the backup?)")
+            continue
+        elif source[key] != restored[key]:
+            print(f"[DIFF] {label}: live {source[key][0]} rows, restored {restored[key][0]} rows"
+                  f"{'' if source[key][0] != restored[key][0] else ' (contents differ)'}")
+        else:
+            print(f"[OK]   {label}: {restored[key][0]} rows")
+            continue
+        problems += 1
+    return problems
+
+
+def verify_backup(storage_service, blob, jobs, keep=False, counts_only=False):
+    """
+    Restores blob into a scratch database next to DATABASE_URL, compares it
+    table by table with the live database and prints the timings. Tables
+    written to since the backup was taken will show up as differences.
+    """
+    scratch_name = f"restore_verify_{datetime.utcnow():%Y%m%d_%H%M%S}"
+    scratch_url = psycopg2.extensions.make_dsn(DB_URL, dbname=scratch_name)
+
+    admin = psycopg2.connect(DB_URL)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(scratch_name)))
+        print(f"Restoring into scratch database '{scratch_name}'...")
+
+        timings = {}
+        started = time.monotonic()
+        stats = restore_backup(storage_service, blob, scratch_url, jobs)
+        timings["restore"] = time.monotonic() - started
+        print(f"Checksum: {stats['checksum']}")
+
+        started = time.monotonic()
+        restored_conn = psycopg2.connect(scratch_url)
+        try:
+            restored = table_fingerprints(restored_conn, counts_only)
+        finally:
+            restored_conn.close()
+        source_conn = psycopg2.connect(DB_URL)
+        try:
+            source = table_fingerprints(source_conn, counts_only)
+        finally:
+            source_conn.close()
+        problems = compare_fingerprints(source, restored)
+        timings["compare"] = time.monotonic() - started
+
+        print(f"--- Verified {blob.name}: {len(restored)} tables, {problems} with differences ---")
+        print(f"Restore (download + pg_restore, {stats['format']} format, "
+              f"{jobs if stats['format'] == 'directory' else 1} jobs): {timings['restore']:.1f}s "
+              f"for {format_bytes(stats['stored_bytes'])} stored / {format_bytes(stats['raw_bytes'])} dump")
+        if "download_seconds" in stats:
+            print(f"  of which download and unpack: {stats['download_seconds']:.1f}s")
+        print(f"Comparison: {timings['compare']:.1f}s")
+        return problems
+    finally:
+        if keep:
+            print(f"Keeping scratch database '{scratch_name}'.")
+        else:
+            with admin.cursor() as cur:
+                cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(scratch_name)))
+        admin.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List, restore or verify database backups stored in GCS.")
+    parser.add_argument("command", choices=["list", "restore", "verify"])
+    parser.add_argument("backup", nargs="?", default="latest", help="Backup blob name (with or without the database_backups/ prefix) or 'latest'.")
+    parser.add_argument("--target-url", default=os.environ.get("RESTORE_DATABASE_URL"),
+                        help="Database to restore into (required for 'restore'; defaults to RESTORE_DATABASE_URL).")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Parallel pg_restore jobs for directory-format backups.")
+    parser.add_argument("--clean", action="store_true", help="Drop existing objects in the target before restoring them.")
+    parser.add_argument("--keep", action="store_true", help="verify: keep the scratch database afterwards.")
+    parser.add_argument("--counts-only", action="store_true", help="verify: compare row counts only, not table checksums.")
+    args = parser.parse_args()
+
+    storage_service = StorageService(GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON)
+    if not storage_service.configured:
+        print("[ERROR] Missing one or more required environment variables (GCS_BUCKET_NAME, GOOGLE_CREDENTIALS_JSON).")
+        return 1
+    bucket = storage_service.bucket()
+
+    try:
+        if args.command == "list":
+            for taken, blob in list_backups(bucket):
+                metadata = blob.metadata or {}
+                print(f"{taken:%Y-%m-%d %H:%M:%S}  {format_bytes(blob.size or 0):>10}  "
+                      f"{metadata.get('format', 'custom'):<9}  {blob.name}")
+            return 0
+
+        blob = resolve_backup(bucket, args.backup)
+        if args.command == "restore":
+            if not args.target_url:
+                print("[ERROR] 'restore' needs --target-url (or RESTORE_DATABASE_URL).")
+                return 1
+            print(f"--- Restoring {blob.name} ({format_bytes(blob.size or 0)}) ---")
+            stats = restore_backup(storage_service, blob, args.target_url, max(1, args.jobs), args.clean)
+            print(f"--- Restore complete in {stats['seconds']:.1f}s (checksum: {stats['checksum']}) ---")
+            return 0
+
+        if not DB_URL:
+            print("[ERROR] 'verify' needs DATABASE_URL (the live database to compare against).")
+            return 1
+        problems = verify_backup(storage_service, blob, max(1, args.jobs), args.keep, args.counts_only)
+        return 1 if problems else 0
+    except RuntimeError as e:
+        print(f"[ERROR] {e}")
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
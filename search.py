@@ -0,0 +1,39 @@
+import html
+import re
+
+from markupsafe import Markup, escape
+
+# --- Full-text Search Helpers ---
+# Shared by the app's search endpoints and the search benchmarks.
+
+SEARCH_CONFIG = 'english'
+SEARCH_WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def build_prefix_tsquery(text):
+    """
+    Turns free text typed into a search box into a to_tsquery() expression in
+    which every word must match as a prefix, so results appear while the user
+    is still typing ("iron cro" -> 'iron':* & 'cro':*).
+    Returns None when the text has no searchable words.
+    """
+    words = SEARCH_WORD_PATTERN.findall(text.lower())
+    if not words:
+        return None
+    return ' & '.join(f"'{word}':*" for word in words)
+
+def escape_like(text):
+    """Escapes LIKE/ILIKE wildcards so user input only ever matches literally."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# ts_headline wraps matches in these markers; render_headline turns them into
+# <mark> tags only after the rest of the snippet has been HTML-escaped.
+HEADLINE_START, HEADLINE_STOP = '[[[mark]]]', '[[[/mark]]]'
+HEADLINE_OPTIONS = f'StartSel="{HEADLINE_START}", StopSel="{HEADLINE_STOP}", MaxFragments=2, MinWords=8, MaxWords=20, FragmentDelimiter=" … "'
+
+def render_headline(headline):
+    """Returns a ts_headline() snippet as safe HTML with matches wrapped in <mark>."""
+    if not headline:
+        return Markup('')
+    # Editor.js stores entities (&amp;, &lt;) in block text; decode them so they are escaped exactly once.
+    escaped = escape(html.unescape(headline))
+    return Markup(str(escaped).replace(HEADLINE_START, '<mark>').replace(HEADLINE_STOP, '</mark>'))